@@ -99,9 +99,11 @@ def extract_beams_from_flt(root, bucket, id, clean=True, silent=False):
 
     files += [obj.key for obj in bkt.objects.filter(Prefix='Pipeline/{0}/Extractions/fit_args.npy'.format(root))]
     
+    files += [obj.key for obj in bkt.objects.filter(Prefix='Pipeline/{0}/Extractions/{0}.footprints.fits'.format(root))]
+    
     download_files = []
     for file in np.unique(files):
-        if ('cat.fits' in file) | ('fit_args' in file):
+        if ('cat.fits' in file) | ('fit_args' in file) | ('footprints' in file):
             if os.path.exists(os.path.basename(file)):
                 continue
             
@@ -126,6 +128,19 @@ def extract_beams_from_flt(root, bucket, id, clean=True, silent=False):
         if 'GrismFLT.fits' in file:
             flt_files.append(file)
     
+    # Skip exposures whose padded footprints in the index don't contain 
+    # the object.  The remaining ones are still checked with the detector
+    # footprint in the wcs.fits files below.
+    fp_file = '{0}.footprints.fits'.format(root)
+    if os.path.exists(fp_file):
+        fp_index = utils.FootprintIndex(file=fp_file)
+        in_index = fp_index.query(*object_rd)[0]
+        has_id = [fp_index.labels[j] for j in np.where(in_index)[0]]
+        
+        flt_files = [file for file in flt_files 
+                     if (os.path.basename(file) in has_id) | 
+                        (os.path.basename(file) not in fp_index.labels)]
+        
     if not silent:
         print('Read {0} GrismFLT files'.format(len(flt_files)))
     
@@ -32,15 +32,124 @@ PLINE = {'kernel': 'point', 'pixfrac': 0.2, 'pixscale': 0.1, 'size': 8, 'wcs': N
 BOUNDED_DEFAULTS = {'method':'bvls', 'tol':1.e-8, 'verbose':0}
 LINE_BOUNDS = [-1.e-16, 1.e-13] # erg/s/cm2
 
-# IGM from eazy-py
-try:
-    import eazy.igm
-    IGM = eazy.igm.Inoue14()
-except:
-    IGM = None
+# IGM from eazy-py, interpolated from a lookup table
+IGM = utils.get_igm_table()
 
+# Arguments read by `load_fit_args`, cached for repeated fits in the same 
+# process
+FIT_ARGS_CACHE = {}
+
+def load_fit_args(args_file='fit_args.npy', use_cache=True):
+    """Read the `run_all` arguments saved by `~grizli.pipeline.auto_script.generate_fit_params`
+    
+    Template filenames (`~grizli.utils.TemplateBank` files) and missing 
+    templates are resolved when the file is read.  With `use_cache`, the 
+    result is stored in `FIT_ARGS_CACHE` and only read again if 
+    `args_file` changes.  Make a copy with `copy_fit_args` before 
+    modifying it.
+    
+    Parameters
+    ----------
+    args_file : str
+        Filename of the saved arguments.
+    
+    use_cache : bool
+        Use arguments already read from `args_file`.
+        
+    Returns
+    -------
+    args : dict
+        Keyword arguments for `run_all`.
+    """
+    key = (os.path.abspath(args_file), os.path.getmtime(args_file))
+    if use_cache & (key in FIT_ARGS_CACHE):
+        return FIT_ARGS_CACHE[key]
+        
+    try:
+        args = np.load(args_file)[0]
+    except:
+        args = np.load(args_file, allow_pickle=True)[0]
+    
+    fwhm = args['fwhm'] if 'fwhm' in args else 1200
+    for k, complexes in zip(['t0', 't1'], [True, False]):
+        if k not in args:
+            args[k] = None
+            
+        if args[k] is None:
+            args[k] = utils.load_templates(line_complexes=complexes, 
+                                           fsps_templates=True, fwhm=fwhm)
+        elif isinstance(args[k], str):
+            args[k] = utils.TemplateBank(file=args[k])
+    
+    if use_cache:
+        FIT_ARGS_CACHE.clear()
+        FIT_ARGS_CACHE[key] = args
+        
+    return args
+
+def copy_fit_args(args):
+    """Copy of the `run_all` arguments with new copies of the mutable 
+    `dict` arguments, sharing the templates and photometry objects
+    """
+    args_copy = args.copy()
+    for k in args:
+        if isinstance(args[k], dict) & (k not in ['t0', 't1']):
+            args_copy[k] = args[k].copy()
+            
+    return args_copy
+    
+def init_fit_worker(args_file='fit_args.npy'):
+    """Load the state shared by all fits in a process
+    
+    Reads `args_file` (`load_fit_args`), builds the IGM lookup table and 
+    enables the `~grizli.grismconf.CONFIG_CACHE` so that each 
+    configuration file is only read once.
+    """
+    from . import grismconf
+    
+    grismconf.CACHE_CONFIG = True
+    utils.get_igm_table()
+    
+    args = load_fit_args(args_file)
+    return args
+    
+def fit_worker(ids, args_file='fit_args.npy', skip_existing=True, get_output_data=False, **kwargs):
+    """Fit a list of objects in a single persistent process
+    
+    The shared state is loaded once with `init_fit_worker`, and results 
+    are yielded as each fit finishes.
+    
+    Parameters
+    ----------
+    ids : iterable
+        Object IDs to fit, e.g., a list or a generator pulling from a 
+        work queue.
+    
+    args_file : str
+        Arguments for `run_all`.
+    
+    skip_existing : bool
+        Skip objects where the ``{group_name}_{id:05d}.full.fits`` output 
+        file already exists.
+    
+    get_output_data, kwargs : 
+        Passed to `run_all_parallel`.
+        
+    Returns
+    -------
+    Generator of ``(id, status, time)`` tuples from `run_all_parallel`.
+    """
+    args = init_fit_worker(args_file)
+    
+    for id in ids:
+        full_file = '{0}_{1:05d}.full.fits'.format(args['group_name'], id)
+        if skip_existing & os.path.exists(full_file):
+            continue
+        
+        yield run_all_parallel(id, get_output_data=get_output_data,
+                               args_file=args_file, **kwargs)
+        
 def run_all_parallel(id, get_output_data=False, args_file='fit_args.npy', **kwargs):
-    import numpy as np
     from grizli.fitting import run_all
     from grizli import multifit
     import traceback
@@ -48,11 +157,10 @@ def run_all_parallel(id, get_output_data=False, args_file='fit_args.npy', **kwar
     t0 = time.time()
 
     print('Run id={0} with {1}'.format(id, args_file))
-    try:
-        args = np.load(args_file)[0]
-    except:
-        args = np.load(args_file, allow_pickle=True)[0]
-        
+    
+    # Cached if already read in this process
+    args = copy_fit_args(load_fit_args(args_file))
+    
     args['verbose'] = False
     for k in kwargs:
         args[k] = kwargs[k]
@@ -78,7 +186,7 @@ def run_all_parallel(id, get_output_data=False, args_file='fit_args.npy', **kwar
     
     return id, status, t1-t0
         
-def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002], fitter=['nnls','bounded'], group_name='grism', fit_stacks=True, only_stacks=False, prior=None, fcontam=0.2, pline=PLINE, min_line_sn=4, mask_sn_limit=np.inf, fit_only_beams=False, fit_beams=True, root='*', fit_trace_shift=False, phot=None, use_phot_obj=True, phot_obj=None, verbose=True, scale_photometry=False, show_beams=True, scale_on_stacked_1d=True, use_cached_templates=True, loglam_1d=True, overlap_threshold=5, MW_EBV=0., sys_err=0.03, huber_delta=4, get_student_logpdf=False, get_dict=False, bad_pa_threshold=1.6, units1d='flam', redshift_only=False, line_size=1.6, use_psf=False, get_line_width=False, sed_args={'bin':1, 'xlim':[0.3, 9]}, get_ir_psfs=True, min_mask=0.01, min_sens=0.02, mask_resid=True, save_stack=True,  get_line_deviations=True, bounded_kwargs=BOUNDED_DEFAULTS, write_fits_files=True, save_figures=True, fig_type='png', **kwargs):
+def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002], fitter=['nnls','bounded'], group_name='grism', fit_stacks=True, only_stacks=False, prior=None, fcontam=0.2, pline=PLINE, min_line_sn=4, mask_sn_limit=np.inf, fit_only_beams=False, fit_beams=True, root='*', fit_trace_shift=False, phot=None, use_phot_obj=True, phot_obj=None, verbose=True, scale_photometry=False, show_beams=True, scale_on_stacked_1d=True, use_cached_templates=True, loglam_1d=True, overlap_threshold=5, MW_EBV=0., sys_err=0.03, huber_delta=4, get_student_logpdf=False, get_dict=False, bad_pa_threshold=1.6, units1d='flam', redshift_only=False, line_size=1.6, use_psf=False, get_line_width=False, sed_args={'bin':1, 'xlim':[0.3, 9]}, get_ir_psfs=True, min_mask=0.01, min_sens=0.02, mask_resid=True, save_stack=True,  get_line_deviations=True, bounded_kwargs=BOUNDED_DEFAULTS, write_fits_files=True, save_figures=True, fig_type='png', use_response_matrix=False, adaptive_zgrid=False, **kwargs):
     """Run the full procedure
     
     1) Load MultiBeam and stack files 
@@ -222,9 +330,13 @@ def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002],
             
     if t0 is None:
         t0 = utils.load_templates(line_complexes=True, fsps_templates=True, fwhm=fwhm)
-    
+    elif isinstance(t0, str):
+        t0 = utils.TemplateBank(file=t0)
+        
     if t1 is None:
         t1 = utils.load_templates(line_complexes=False, fsps_templates=True, fwhm=fwhm)
+    elif isinstance(t1, str):
+        t1 = utils.TemplateBank(file=t1)
         
     # Fit on stacked spectra or individual beams
     if fit_only_beams:
@@ -249,7 +361,7 @@ def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002],
     
     # First pass
     fit_obj.Asave = {}
-    fit = fit_obj.xfit_redshift(templates=t0, zr=zr, dz=dz, prior=prior, fitter=fitter[0], verbose=verbose, bounded_kwargs=bounded_kwargs, huber_delta=huber_delta, get_student_logpdf=get_student_logpdf)
+    fit = fit_obj.xfit_redshift(templates=t0, zr=zr, dz=dz, prior=prior, fitter=fitter[0], verbose=verbose, bounded_kwargs=bounded_kwargs, huber_delta=huber_delta, get_student_logpdf=get_student_logpdf, use_response_matrix=use_response_matrix, adaptive=adaptive_zgrid)
      
     fit_hdu = pyfits.table_to_hdu(fit)
     fit_hdu.header['EXTNAME'] = 'ZFIT_STACK'
@@ -296,7 +408,9 @@ def run_all(id, t0=None, t1=None, fwhm=1200, zr=[0.65, 1.6], dz=[0.004, 0.0002],
                                   prior=prior, fitter=fitter[0], 
                                   verbose=verbose, huber_delta=huber_delta, 
                                   get_student_logpdf=get_student_logpdf, 
-                                  bounded_kwargs=bounded_kwargs)
+                                  bounded_kwargs=bounded_kwargs,
+                                  use_response_matrix=use_response_matrix,
+                                  adaptive=adaptive_zgrid)
                                    
         mb_fit_hdu = pyfits.table_to_hdu(mb_fit)
         mb_fit_hdu.header['EXTNAME'] = 'ZFIT_BEAM'
@@ -892,8 +1006,8 @@ def make_summary_catalog(target='pg0117+213', sextractor='pg0117+213-f140w.cat',
         if filter_bandpasses:
             tfit = utils.GTable.gread(full['TEMPL'])
             sp = utils.SpectrumTemplate(wave=tfit['wave'], flux=tfit['full'])
-            mags = [sp.integrate_filter(bp, abmag=True) 
-                        for bp in filter_bandpasses]
+            mags = list(sp.integrate_filter_list(filter_bandpasses, 
+                                                 abmag=True))
             
             template_mags.append(mags)
             
@@ -1444,6 +1558,8 @@ class GroupFitter(object):
         
         # eazypy tempfilt for faster interpolation
         self.tempfilt = tempfilt
+        self.photom_grid = None
+        self.photom_grid_templates = None
         
         self.TEF = TEF
         
@@ -1473,13 +1589,18 @@ class GroupFitter(object):
         self.Nspec = self.Nmask - self.Nphot
 
         self.tempfilt = None
+        self.photom_grid = None
+        self.photom_grid_templates = None
         
     def _interpolate_photometry(self, z=0., templates=[]):
         """
         Interpolate templates through photometric filters
         
-        xx: TBD better handling of emission line templates and use eazpy tempfilt
-        object for huge speedup
+        Uses the eazypy `tempfilt` object if it has the same number of 
+        templates, or the `~grizli.utils.TemplateFilterGrid` set with 
+        `init_photometry_grid` if it was computed for `templates` and `z` is
+        within its redshift grid.  Otherwise the templates are redshifted and
+        integrated through the filters directly.
         
         """
         NTEMP = len(templates)
@@ -1493,19 +1614,62 @@ class GroupFitter(object):
                 A_phot *= 3.e18/self.photom_pivot**2*(1+z)
                 A_phot[~np.isfinite(A_phot)] = 0
                 return A_phot[:,mask]
+        
+        grid = self.photom_grid
+        if grid is not None:
+            # Compare the template contents unless they are the same 
+            # objects as the ones last checked
+            last = getattr(self, 'photom_grid_templates', None)
+            same = (last is not None) and (len(last) == NTEMP)
+            if same:
+                same = np.all([(k0 == k) & (t0 is templates[k]) 
+                               for (k0, t0), k in zip(last, templates)])
+            
+            if not same:
+                if utils.templates_hash(templates) == grid.templates_hash:
+                    self.photom_grid_templates = list(templates.items())
+                else:
+                    grid = None
+                    
+        if grid is not None:
+            if grid.in_range(z):
+                A_phot[self.N:,:] = grid(z)*3.e18/self.photom_pivot**2
+                return A_phot[:,mask]
 
-        for it, key in enumerate(templates):
-            #print(key)
-            tz = templates[key].zscale(z, scalar=1)
-            for ifilt, filt in enumerate(self.photom_filters):
-                A_phot[self.N+it, ifilt] = tz.integrate_filter(filt)*3.e18/self.photom_pivot[ifilt]**2#*(1+z)
-            
-            # pl = plt.plot(tz.wave, tz.flux)
-            # plt.scatter(self.photom_pivot, A_phot[self.N+it,:], color=pl[0].get_color())
+        fnu = utils.integrate_templates(templates, self.photom_filters, z=z)
+        A_phot[self.N:,:] = fnu*3.e18/self.photom_pivot**2
             
         return A_phot[:,mask]
         
-    def xfit_at_z(self, z=0, templates=[], fitter='nnls', fit_background=True, get_uncertainties=False, get_design_matrix=False, pscale=None, COEFF_SCALE=1.e-19, get_components=False, huber_delta=4, get_residuals=False, include_photometry=True, use_cached_templates=False, bounded_kwargs=BOUNDED_DEFAULTS, apply_sensitivity=True):
+    def init_photometry_grid(self, templates, zgrid):
+        """Precompute template fluxes through the photometric filters
+        
+        Sets `photom_grid` to the shared 
+        `~grizli.utils.TemplateFilterGrid` of `templates` and the filters 
+        in `photom_filters` on `zgrid`, which `_interpolate_photometry` 
+        then interpolates rather than integrating the templates at every 
+        redshift.  The grid is only used for templates with the same 
+        contents (`~grizli.utils.templates_hash`) and for redshifts within 
+        `zgrid`.
+        
+        Parameters
+        ----------
+        templates : dict
+            Dictionary of `~grizli.utils.SpectrumTemplate` objects.
+        
+        zgrid : array-like
+            Redshift grid.
+            
+        """
+        if self.Nphot == 0:
+            return None
+            
+        self.photom_grid = utils.get_template_filter_grid(templates, 
+                                         self.photom_filters, zgrid, 
+                                         apply_igm=True)
+        self.photom_grid_templates = list(templates.items())
+        
+    def xfit_at_z(self, z=0, templates=[], fitter='nnls', fit_background=True, get_uncertainties=False, get_design_matrix=False, pscale=None, COEFF_SCALE=1.e-19, get_components=False, huber_delta=4, get_residuals=False, include_photometry=True, use_cached_templates=False, bounded_kwargs=BOUNDED_DEFAULTS, apply_sensitivity=True, use_response_matrix=False, design_matrix=None, warm_start=None):
         """Fit the 2D spectra with a set of templates at a specified redshift.
         
         Parameters
@@ -1539,6 +1703,28 @@ class GroupFitter(object):
         huber_delta : float
             Use the Huber loss function (`~scipy.special.huber`) rather than
             direct chi-squared.  If `huber_delta` < 0, then fall back to chi2.
+        
+        use_response_matrix : bool
+            Compute the 2D template models with the precomputed sparse 
+            dispersion response matrices of the beams 
+            (`~grizli.model.BeamCutout.compute_masked_model`) rather than 
+            dispersing each template from scratch.  The matrices are computed
+            on the first call and cached on the beam objects.
+        
+        design_matrix : `~np.ndarray` or None
+            Precomputed (unweighted) design matrix for redshift `z`, e.g., 
+            from `xfit_design_zgrid`.  If provided, the template models 
+            aren't recomputed and the array is modified in place.
+        
+        warm_start : dict or None
+            If a dictionary is provided, compute the 'nnls' fits from the 
+            normal equations with `~grizli.utils.normal_equations_lsq`, 
+            starting from the active set of a previous fit stored in the 
+            dictionary, e.g., at a neighboring redshift.  The dictionary is 
+            updated with the new solution.  Falls back to the standard 
+            solver if the normal equations are singular or 
+            ill-conditioned.  The 'bounded' fits
+            always use `~scipy.optimize.lsq_linear` with `bounded_kwargs`.
             
         Returns
         -------
@@ -1557,12 +1743,14 @@ class GroupFitter(object):
         from scipy.special import huber
         
         NTEMP = len(templates)
-        if (self.Nphot > 0) & include_photometry:
+        if design_matrix is not None:
+            A = design_matrix
+        elif (self.Nphot > 0) & include_photometry:
             A = np.zeros((self.N+NTEMP, self.Nmask))
         else:
             A = np.zeros((self.N+NTEMP, self.Nspec))
             
-        if fit_background:
+        if fit_background & (design_matrix is None):
             A[:self.N,:self.Nspec] = self.A_bgm
         
         lower_bound = np.zeros(self.N+NTEMP)
@@ -1572,6 +1760,17 @@ class GroupFitter(object):
         lower_bound[:self.N] = -0.05
         upper_bound[:self.N] = 0.05
         
+        # Template models already in the precomputed design matrix
+        if design_matrix is not None:
+            for i, t in enumerate(templates):
+                if t.startswith('line'):
+                    lower_bound[self.N+i] = LINE_BOUNDS[0]/COEFF_SCALE
+                    upper_bound[self.N+i] = LINE_BOUNDS[1]/COEFF_SCALE
+            
+            compute_templates = []
+        else:
+            compute_templates = templates
+        
         # A = scipy.sparse.csr_matrix((self.N+NTEMP, self.Ntot))
         # bg_sp = scipy.sparse.csc_matrix(self.A_bg)
         
@@ -1583,7 +1782,8 @@ class GroupFitter(object):
                                   (self.wavef.min()-200)/1216.-1)
         
         # compute IGM directly for spectrum wavelengths
-        if use_cached_templates & ('spline' not in fitter):
+        if (use_cached_templates & ('spline' not in fitter) & 
+            (design_matrix is None)):
             if z > obj_IGM_MINZ:
                 if IGM is None:
                     wigmz = 1.
@@ -1599,13 +1799,13 @@ class GroupFitter(object):
             wigmz = 1.
         
         # Cached first    
-        for i, t in enumerate(templates):
+        for i, t in enumerate(compute_templates):
             if use_cached_templates:
                 if t in self.Asave:
                     #print('\n\nUse saved: ',t)
                     A[self.N+i,:] += self.Asave[t]*wigmz                                           
         
-        for i, t in enumerate(templates):
+        for i, t in enumerate(compute_templates):
             if use_cached_templates:
                 if t in self.Asave:
                     continue
@@ -1645,7 +1845,10 @@ class GroupFitter(object):
                     continue
 
                 sl = self.mslices[j]
-                if t in beam.thumbs:
+                if (use_response_matrix & (t not in beam.thumbs) & 
+                    hasattr(beam, 'compute_masked_model')):
+                    A[self.N+i, sl] = beam.compute_masked_model(spectrum_1d=s, is_cgs=True, apply_sensitivity=apply_sensitivity)*COEFF_SCALE
+                elif t in beam.thumbs:
                     #print('Use thumbnail!', t)
                     A[self.N+i, sl] = beam.compute_model(thumb=beam.thumbs[t], spectrum_1d=s, in_place=False, is_cgs=True, apply_sensitivity=apply_sensitivity)[beam.fit_mask]*COEFF_SCALE
                 else:
@@ -1735,9 +1938,43 @@ class GroupFitter(object):
             return AxT, data
             
         # Run the minimization
-        if fitter.split()[0] == 'nnls':
+        AtA = None
+        solved = False
+        
+        fit_type = fitter.split()[0]
+        if (warm_start is not None) & (fit_type == 'nnls'):
+            AtA = np.dot(Ax, AxT)
+            Atb = np.dot(Ax, data)
+            
+            x0 = warm_start.get('coeffs')
+            if x0 is not None:
+                x0 = x0 if len(x0) == len(oktemp) else None
+                
+            if x0 is not None:
+                # Previous solution for the templates that overlap now
+                x0 = x0[oktemp]
+                free0 = warm_start['free'][oktemp]
+            else:
+                x0 = free0 = None
+                
+            try:
+                coeffs_i, free_i = utils.normal_equations_lsq(AtA, Atb,
+                                                    x0=x0, free=free0)
+                solved = True
+            except (np.linalg.LinAlgError, ValueError):
+                warm_start['coeffs'] = None
+            
+            if solved:
+                warm_start['coeffs'] = np.zeros(len(oktemp))
+                warm_start['coeffs'][oktemp] = coeffs_i
+                warm_start['free'] = np.zeros(len(oktemp), dtype=bool)
+                warm_start['free'][oktemp] = free_i
+                
+        if solved:
+            pass
+        elif fit_type == 'nnls':
             coeffs_i, rnorm = scipy.optimize.nnls(AxT, data)            
-        elif fitter.split()[0] == 'lstsq':
+        elif fit_type == 'lstsq':
             coeffs_i, residuals, rank, s = np.linalg.lstsq(AxT, data,
                                                            rcond=None)
         else:
@@ -1793,7 +2030,10 @@ class GroupFitter(object):
         if get_uncertainties:
             try:
                 # Covariance is inverse of AT.A
-                covar_i = np.matrix(np.dot(AxT.T, AxT)).I.A
+                if AtA is None:
+                    AtA = np.dot(AxT.T, AxT)
+                    
+                covar_i = np.matrix(AtA).I.A
                 covar = utils.fill_masked_covar(covar_i, oktemp)
                 covard = np.sqrt(covar.diagonal())
                 
@@ -1837,6 +2077,324 @@ class GroupFitter(object):
            
         return chi2, coeffs, coeffs_err, covar
     
+    def xfit_design_zgrid(self, zgrid, templates=[], fit_background=True, include_photometry=True, COEFF_SCALE=1.e-19, use_cached_templates=False, apply_sensitivity=True):
+        """Compute the `xfit_at_z` design matrices for many redshifts at once
+        
+        The 2D template models are computed for all redshifts together with
+        the sparse dispersion response matrices of the beams 
+        (`~grizli.model.BeamCutout.get_masked_response`) and the vectorized
+        template interpolation `~grizli.utils.interp_conserve_zgrid`, so 
+        there is only one sparse matrix product per template per beam.
+        
+        Parameters
+        ----------
+        zgrid : array-like
+            Redshifts.  The output array has 
+            ``len(zgrid)*(N+NTEMP)*Nmask`` elements, so long redshift grids
+            should be split into chunks (see `batch_size` in 
+            `xfit_redshift`).
+        
+        templates, fit_background, include_photometry, COEFF_SCALE, use_cached_templates, apply_sensitivity : 
+            See `xfit_at_z`.
+        
+        Returns
+        -------
+        A : `~np.ndarray`, (NZ, N+NTEMP, Nmask)
+            Unweighted design matrices, to be passed to `xfit_at_z` with 
+            the `design_matrix` keyword.  The last dimension is `Nspec` if 
+            there is no photometry or `include_photometry` is False.  The 
+            photometry columns are filled later by `xfit_at_z`.
+        """
+        zgrid = np.atleast_1d(zgrid)
+        NZ = len(zgrid)
+        NTEMP = len(templates)
+        if (self.Nphot > 0) & include_photometry:
+            A = np.zeros((NZ, self.N+NTEMP, self.Nmask))
+        else:
+            A = np.zeros((NZ, self.N+NTEMP, self.Nspec))
+        
+        if fit_background:
+            A[:,:self.N,:self.Nspec] = self.A_bgm
+            
+        try:
+            obj_IGM_MINZ = np.maximum(IGM_MINZ, 
+                                  (self.wave_mask.min()-200)/1216.-1)
+        except:
+            obj_IGM_MINZ = np.maximum(IGM_MINZ, 
+                                  (self.wavef.min()-200)/1216.-1)
+        
+        has_igm = (zgrid > obj_IGM_MINZ) & (IGM is not None)
+        
+        # IGM at the pixel wavelengths for cached templates
+        wigmz = np.ones((NZ, A.shape[2]))
+        if use_cached_templates:
+            wavem = self.wavef[self.fit_mask][:A.shape[2]]
+            for iz in np.where(has_igm)[0]:
+                lylim = wavem/(1+zgrid[iz]) < 1250
+                wigmz[iz, lylim] = IGM.full_IGM(zgrid[iz], wavem[lylim])
+        
+        # Wavelengths and scaled sensitivities of the beams
+        beam_data = []
+        for j, beam in enumerate(self.beams):
+            mask_i = beam.fit_mask.reshape(beam.sh)
+            clip = mask_i.sum(axis=0) > 0        
+            if clip.sum() == 0:
+                beam_data.append(None)
+                continue
+            
+            lam_clip = beam.wave[clip]
+            so = beam.beam.lam_sort
+            scale = beam.beam.scale/beam.beam.total_flux*COEFF_SCALE
+            if apply_sensitivity:
+                scale = scale*beam.beam.sensitivity_beam[so]
+                
+            beam_data.append([lam_clip.min(), lam_clip.max(), 
+                              beam.beam.lam_beam[so], so, scale,
+                              beam.get_masked_response()])
+        
+        for i, t in enumerate(templates):
+            if use_cached_templates & (t in self.Asave):
+                A[:,self.N+i,:] += self.Asave[t]*wigmz
+                continue
+            
+            ti = templates[t]
+            rest_template = ti.name.split()[0] in ['bspl', 'step', 'poly']
+            
+            # Don't redshift spline templates
+            if rest_template:
+                zi = np.zeros(1)
+                flux = ti.flux
+            else:
+                zi = zgrid
+                flux = ti.flux
+                if has_igm.sum() > 0:
+                    lylim = ti.wave < 1250
+                    flux = np.ones((NZ, len(ti.wave)))*ti.flux
+                    for iz in np.where(has_igm)[0]:
+                        igmz = IGM.full_IGM(zgrid[iz],
+                                            ti.wave[lylim]*(1+zgrid[iz]))
+                        flux[iz, lylim] *= igmz
+                            
+            for j, beam in enumerate(self.beams):
+                if beam_data[j] is None:
+                    continue
+                
+                lmin, lmax, lam_beam, so, scale, A_resp = beam_data[j]
+                
+                # Template doesn't overlap with the spectrum
+                ok = ((ti.wave.min()*(1+zi) <= lmax) & 
+                      (ti.wave.max()*(1+zi) >= lmin))
+                if ok.sum() == 0:
+                    continue
+                
+                spec = np.zeros((len(zi), len(so)))
+                spec[:,so] = utils.interp_conserve_zgrid(lam_beam, ti.wave,
+                                                         flux, zi)*scale
+                spec[~ok,:] = 0
+                
+                A[:,self.N+i,self.mslices[j]] = A_resp.dot(spec.T).T
+            
+            # Save step templates for faster computation
+            if rest_template and use_cached_templates:
+                self.Asave[t] = A[0,self.N+i,:]*1
+                
+        return A
+    
+    def xfit_zgrid(self, zgrid, templates={}, fitter='nnls', fit_background=True, get_uncertainties=True, huber_delta=4, use_cached_templates=True, bounded_kwargs=BOUNDED_DEFAULTS, use_response_matrix=False, batch_size=0, warm_start=False, student_t_pars=None, verbose=True, label='  '):
+        """Template fits on a grid of redshifts with `xfit_at_z`
+        
+        Parameters
+        ----------
+        zgrid : array-like
+            Redshifts.
+        
+        templates, fitter, fit_background, get_uncertainties, huber_delta, use_cached_templates, bounded_kwargs, use_response_matrix : 
+            See `xfit_at_z`.
+        
+        batch_size : int
+            If > 0, compute the design matrices for `batch_size` redshifts 
+            at a time with `xfit_design_zgrid`.
+        
+        warm_start : bool
+            Warm-start the 'nnls' fits at each redshift with the active set
+            of the previous grid point (see `xfit_at_z`).
+        
+        student_t_pars : list or None
+            If specified, compute the Student-t log-likelihood of the 
+            residuals with parameters `student_t_pars`.
+        
+        verbose : bool
+            Print status messages, prefixed with `label`.
+            
+        Returns
+        -------
+        chi2, logpdf : (NZ) `~numpy.ndarray`
+            Chi-squared (or Huber loss) and Student-t log-likelihood of the
+            fits.
+        
+        coeffs : (NZ, N+NTEMP) `~numpy.ndarray`
+            Template coefficients.
+        
+        covar : (NZ, N+NTEMP, N+NTEMP) `~numpy.ndarray`
+            Covariance matrices.
+        """
+        from scipy.stats import t as student_t
+        from scipy.special import huber
+        
+        zgrid = np.atleast_1d(zgrid)
+        NZ = len(zgrid)
+        NPARAM = self.N+len(templates)
+        
+        chi2 = np.zeros(NZ)
+        logpdf = np.zeros(NZ)
+        coeffs = np.zeros((NZ, NPARAM))
+        covar = np.zeros((NZ, NPARAM, NPARAM))
+        
+        design_kwargs = {'templates':templates, 
+                         'fit_background':fit_background,
+                         'use_cached_templates':use_cached_templates}
+        
+        if warm_start:
+            solver_state = {}
+        else:
+            solver_state = None
+            
+        chi2min = 1e30
+        iz = 0
+        for i in range(NZ):
+            if batch_size > 0:
+                if i % batch_size == 0:
+                    A_batch = self.xfit_design_zgrid(zgrid[i:i+batch_size],
+                                                     **design_kwargs)
+                design_i = A_batch[i % batch_size]
+            else:
+                design_i = None
+                
+            out = self.xfit_at_z(z=zgrid[i], templates=templates,
+                                fitter=fitter, fit_background=fit_background,
+                                get_uncertainties=get_uncertainties, 
+                                get_residuals=True, 
+                                use_cached_templates=use_cached_templates,
+                                bounded_kwargs=bounded_kwargs,
+                                use_response_matrix=use_response_matrix,
+                                design_matrix=design_i, 
+                                warm_start=solver_state)
+            
+            fit_resid, coeffs[i,:], coeffs_err, covar[i,:,:] = out
+
+            if huber_delta > 0:
+                chi2[i] = (huber(huber_delta, fit_resid)*2.).sum()
+            else:
+                chi2[i] = (fit_resid**2).sum()
+            
+            if student_t_pars is not None:
+                logpdf[i] = student_t.logpdf(fit_resid, *student_t_pars).sum()
+            
+            if chi2[i] < chi2min:
+                iz = i
+                chi2min = chi2[i]
+
+            if verbose:                    
+                print(utils.NO_NEWLINE + label + '{0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid[i], chi2[i], zgrid[iz], i+1, NZ))
+        
+        return chi2, logpdf, coeffs, covar
+    
+    def xfit_zgrid_adaptive(self, zgrid, step=8, threshold=20, logprior=None, safety=2, verbose=True, **kwargs):
+        """Adaptive coarse-to-fine template fits on a redshift grid
+        
+        Fit every `step`-th point of `zgrid` and then bisect the intervals 
+        between the evaluated redshifts where the chi-squared could be 
+        within `threshold` of the current minimum.  The minimum within an
+        interval is bounded with a Lipschitz condition,
+        
+            chi2_min > (chi2_1 + chi2_2)/2 - L*dz/2, 
+        
+        where the slope `L` is `safety` times the largest chi-squared 
+        slope of the interval and its two neighbors.  The refinement stops 
+        when all such intervals are resolved on `zgrid`.  The bound assumes
+        that the chi-squared varies smoothly between the sparse points, so a
+        minimum narrower than ``step`` grid points can be missed entirely if
+        it is flat at the sampled redshifts around it.
+        
+        Parameters
+        ----------
+        zgrid : array-like
+            Full redshift grid.
+        
+        step : int
+            Sampling of the initial sparse grid.
+        
+        threshold : float
+            Refine intervals that could contain chi-squared values within 
+            `threshold` of the minimum, i.e., a posterior probability 
+            greater than ``exp(-threshold/2)`` relative to the peak.
+        
+        logprior : array-like or None
+            Log of the redshift prior evaluated on `zgrid`, added to the 
+            chi-squared as ``-2*logprior`` for the refinement criterion.
+        
+        safety : float
+            Factor multiplying the local chi-squared slopes.
+        
+        kwargs : dict
+            Passed to `xfit_zgrid`.
+            
+        Returns
+        -------
+        ix : array
+            Indices of the evaluated redshifts in `zgrid`.
+        
+        chi2, logpdf, coeffs, covar : 
+            `xfit_zgrid` outputs at ``zgrid[ix]``.
+        """
+        zgrid = np.atleast_1d(zgrid)
+        NZ = len(zgrid)
+        
+        if logprior is None:
+            penalty = np.zeros(NZ)
+        else:
+            penalty = -2*np.maximum(logprior, -1.e30)
+        
+        ix = np.unique(np.append(np.arange(0, NZ, step), NZ-1))
+        it = 0
+        results = []
+        
+        while len(ix) > 0:
+            out = self.xfit_zgrid(zgrid[ix], verbose=False, **kwargs)
+            results.append([ix, out])
+            
+            ev = np.hstack([r[0] for r in results])
+            chi2 = np.hstack([r[1][0] for r in results])
+            so = np.argsort(ev)
+            ev = ev[so]
+            c = chi2[so] + penalty[ev]
+            
+            if verbose:
+                print(utils.NO_NEWLINE + '  iter {0}: {1:d}/{2:d} z ({3:.4f})'.format(it, len(ev), NZ, zgrid[ev[np.argmin(c)]]))
+            
+            if len(ev) < 2:
+                break
+            
+            # Lower bound on chi2 within the intervals
+            gaps = np.diff(ev)
+            slope = np.abs(np.diff(c))/gaps
+            lslope = slope*1
+            lslope[1:] = np.maximum(lslope[1:], slope[:-1])
+            lslope[:-1] = np.maximum(lslope[:-1], slope[1:])
+            
+            lower = (c[:-1] + c[1:])/2 - safety*lslope*gaps/2
+            refine = (gaps > 1) & (lower < c.min() + threshold)
+            
+            ix = (ev[:-1] + gaps//2)[refine]
+            it += 1
+        
+        ix = np.hstack([r[0] for r in results])
+        so = np.argsort(ix)
+        out = [np.concatenate([r[1][j] for r in results])[so] 
+               for j in range(4)]
+        
+        return [ix[so]] + out
+    
     def xfit_redshift(self, prior=None, fwhm=1200,
                      make_figure=True, zr=[0.65, 1.6], dz=[0.005, 0.0004],
                      verbose=True, fit_background=True, fitter='nnls', 
@@ -1845,8 +2403,43 @@ class GroupFitter(object):
                      figsize=[8,5], use_cached_templates=True,
                      fsps_templates=False, get_uncertainties=True,
                      Rspline=30, huber_delta=4, get_student_logpdf=False,
-                     bounded_kwargs=BOUNDED_DEFAULTS):
+                     bounded_kwargs=BOUNDED_DEFAULTS, 
+                     use_response_matrix=False, batch_size=0, 
+                     warm_start=False, adaptive=False,
+                     adaptive_step=8, adaptive_threshold=20, 
+                     photometry_grid=True):
         """TBD
+        
+        use_response_matrix : bool
+            Passed to `xfit_at_z` for the template fits on the redshift grid.
+        
+        batch_size : int
+            If > 0, compute the design matrices for `batch_size` redshifts 
+            at a time with `xfit_design_zgrid`.  The memory needed for each 
+            batch is ``batch_size*(N+NTEMP)*Nmask*8`` bytes.  Falls back to 
+            computing the design matrix at each redshift for beams that 
+            don't provide dispersion response matrices (e.g., ePSF models or 
+            `~grizli.stack.StackFitter` objects) and for the spline fitters.
+        
+        warm_start : bool
+            Warm-start the 'nnls' fits, see `xfit_zgrid`.
+        
+        adaptive : bool
+            Evaluate the first-pass redshift grid adaptively with 
+            `xfit_zgrid_adaptive` (with `adaptive_step` and 
+            `adaptive_threshold`) rather than at every point.  The zoom 
+            grids with step `dz[1]` are then centered on the deepest local 
+            minima of the adaptive grid, including minima at the ends of 
+            the grid.  Minima narrower than ``adaptive_step*dz[0]`` that 
+            don't change the chi-squared at the sparse grid points can be 
+            missed, so `adaptive_step` should be small enough that the 
+            sparse grid resolves the line widths in redshift.
+        
+        photometry_grid : bool
+            If photometry is available and there is no matching `tempfilt`, 
+            integrate the templates through the filters on a grid with 
+            step `dz[0]` once with `init_photometry_grid` and interpolate 
+            it for the fits at each redshift.
         """
         from scipy import polyfit, polyval
         from scipy.stats import t as student_t
@@ -1926,45 +2519,71 @@ class GroupFitter(object):
         
         NTEMP = len(templates)
         
+        if (self.Nphot > 0) & photometry_grid:
+            if (self.tempfilt is None) or (self.tempfilt.NTEMP != NTEMP):
+                # Pad to include the zoom steps at the ends of the grid
+                zpad = np.exp(np.array([-2,2])*dz[0])
+                zr_phot = np.maximum((1+np.array([zgrid.min(), zgrid.max()]))*zpad-1, 0)
+                zgrid_phot = utils.log_zgrid(zr_phot, dz=dz[0])
+                self.init_photometry_grid(templates, zgrid_phot)
+                
         out = self.xfit_at_z(z=0., templates=templates, fitter=fitter,
                             fit_background=fit_background, 
                             get_uncertainties=False, 
                             use_cached_templates=use_cached_templates)
                             
-        chi2, coeffs, coeffs_err, covar = out
+        # Batched design matrices
+        use_batch = (batch_size > 0) & ('spline' not in fitter)
+        for beam in self.beams:
+            if not use_batch:
+                break
+            
+            if not hasattr(beam, 'get_masked_response'):
+                use_batch = False
+            elif hasattr(beam.beam, 'psf'):
+                use_batch = False
+            elif len(set(beam.thumbs).intersection(templates)) > 0:
+                use_batch = False
         
-        chi2 = np.zeros(NZ)
-        logpdf = np.zeros(NZ)
-
-        coeffs = np.zeros((NZ, coeffs.shape[0]))
-        covar = np.zeros((NZ, covar.shape[0], covar.shape[1]))
+        if (batch_size > 0) & (not use_batch) & verbose:
+            print('Batched design matrices not available for this object')
         
-        chi2min = 1e30
-        iz = 0
-        for i in range(NZ):
-            out = self.xfit_at_z(z=zgrid[i], templates=templates,
-                                fitter=fitter, fit_background=fit_background,
-                                get_uncertainties=get_uncertainties, 
-                                get_residuals=True, 
-                                use_cached_templates=use_cached_templates,
-                                bounded_kwargs=bounded_kwargs)
-            
-            fit_resid, coeffs[i,:], coeffs_err, covar[i,:,:] = out
-
-            if huber_delta > 0:
-                chi2[i] = (huber(huber_delta, fit_resid)*2.).sum()
-            else:
-                chi2[i] = (fit_resid**2).sum()
-            
-            if get_student_logpdf:
-                logpdf[i] = student_t.logpdf(fit_resid, *student_t_pars).sum()
+        if get_student_logpdf:
+            logpdf_pars = student_t_pars
+        else:
+            logpdf_pars = None
             
-            if chi2[i] < chi2min:
-                iz = i
-                chi2min = chi2[i]
-
-            if verbose:                    
-                print(utils.NO_NEWLINE + '  {0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid[i], chi2[i], zgrid[iz], i+1, NZ))
+        zgrid_kwargs = dict(templates=templates, fitter=fitter, 
+                            fit_background=fit_background, 
+                            get_uncertainties=get_uncertainties, 
+                            huber_delta=huber_delta,
+                            use_cached_templates=use_cached_templates,
+                            bounded_kwargs=bounded_kwargs,
+                            use_response_matrix=use_response_matrix,
+                            batch_size=batch_size*use_batch, 
+                            warm_start=warm_start,
+                            student_t_pars=logpdf_pars, verbose=verbose)
+        
+        # Prior on the full grid
+        if prior is not None:
+            pzi = np.interp(zgrid, prior[0], prior[1], left=0, right=0)
+            pzi /= np.maximum(np.trapz(pzi, zgrid), 1.e-10)
+            logpz = np.log(pzi)
+        else:
+            logpz = np.zeros(NZ)
+            
+        adaptive &= (NZ > 1)
+        if adaptive:
+            out = self.xfit_zgrid_adaptive(zgrid, step=adaptive_step, 
+                                           threshold=adaptive_threshold,
+                                           logprior=logpz, **zgrid_kwargs)
+            ix, chi2, logpdf, coeffs, covar = out
+            zgrid, logpz = zgrid[ix], logpz[ix]
+        else:
+            out = self.xfit_zgrid(zgrid, label='  ', **zgrid_kwargs)
+            chi2, logpdf, coeffs, covar = out
+        
+        iz = np.argmin(chi2)
         
         if verbose:
             print('First iteration: z_best={0:.4f}\n'.format(zgrid[iz]))
@@ -1976,13 +2595,7 @@ class GroupFitter(object):
         chi2_test = chi2_spline
         
         # Find peaks including the prior
-        if prior is not None:
-            pzi = np.interp(zgrid, prior[0], prior[1], left=0, right=0)
-            pzi /= np.maximum(np.trapz(pzi, zgrid), 1.e-10)
-            logpz = np.log(pzi)
-            chi2_i = chi2 - 2*logpz
-        else:
-            chi2_i = chi2
+        chi2_i = chi2 - 2*logpz
         
         if chi2_test > (chi2_i.min()+100):
             chi2_rev = (chi2_i.min() + 100 - chi2_i)/self.DoF
@@ -1991,7 +2604,17 @@ class GroupFitter(object):
         else:
             chi2_rev = (chi2_test - chi2_i)/self.DoF
                                        
-        if len(zgrid) > 1:
+        if adaptive:
+            # Local minima of the adaptive grid
+            # including minima at the ends of the grid
+            is_min = np.ones(len(zgrid), dtype=bool)
+            is_min[1:] &= chi2_i[1:] <= chi2_i[:-1]
+            is_min[:-1] &= chi2_i[:-1] <= chi2_i[1:]
+            is_min &= chi2_i < chi2_i.min() + adaptive_threshold
+            indexes = np.where(is_min)[0]
+            indexes = indexes[np.argsort(chi2_i[indexes])]
+            num_peaks = len(indexes)
+        elif len(zgrid) > 1:
             chi2_rev[chi2_rev < 0] = 0
             indexes = peakutils.indexes(chi2_rev, thres=0.4, min_dist=8)
             num_peaks = len(indexes)
@@ -2014,45 +2637,20 @@ class GroupFitter(object):
                     chi_i = polyval(c, zi)
                     zgrid_zoom.extend(np.arange(zi-2*dz[0], 
                                       zi+2*dz[0]+dz[1]/10., dz[1]))
+                elif adaptive:
+                    # Minimum at the edge of the grid
+                    zi = zgrid[ix]
+                    zgrid_zoom.extend(np.arange(max(zi-2*dz[0], zgrid[0]),
+                                      min(zi+2*dz[0], zgrid[-1])+dz[1]/10.,
+                                      dz[1]))
                     
             # zgrid_zoom = utils.zoom_zgrid(zgrid, chi2/self.DoF,
             #                               threshold=delta_chi2_threshold,
             #                               factor=dz[0]/dz[1])
-            NZOOM = len(zgrid_zoom)
-        
-            chi2_zoom = np.zeros(NZOOM)
-            logpdf_zoom = np.zeros(NZOOM)
-            coeffs_zoom = np.zeros((NZOOM, coeffs.shape[1]))
-            covar_zoom = np.zeros((NZOOM, coeffs.shape[1], covar.shape[2]))
-
-            iz = 0
-            chi2min = 1.e30
-            for i in range(NZOOM):
-                out = self.xfit_at_z(z=zgrid_zoom[i], templates=templates,
-                                    fitter=fitter,
-                                    fit_background=fit_background,
-                                    get_uncertainties=get_uncertainties,
-                                    get_residuals=True, 
-                                    use_cached_templates=use_cached_templates,
-                                    bounded_kwargs=bounded_kwargs)
-
-                fit_resid, coeffs_zoom[i,:], e, covar_zoom[i,:,:] = out
-                if huber_delta > 0:
-                    chi2_zoom[i] = (huber(huber_delta, fit_resid)*2.).sum()
-                else:
-                    chi2_zoom[i] = (fit_resid**2).sum()
-                
-                if get_student_logpdf:
-                    logpdf_zoom[i] = student_t.logpdf(fit_resid,
-                                                      *student_t_pars).sum()
-                                
-                #A, coeffs_zoom[i,:], chi2_zoom[i], model_2d = out
-                if chi2_zoom[i] < chi2min:
-                    chi2min = chi2_zoom[i]
-                    iz = i
-                
-                if verbose:
-                    print(utils.NO_NEWLINE+'- {0:.4f} {1:9.1f} ({2:.4f}) {3:d}/{4:d}'.format(zgrid_zoom[i], chi2_zoom[i], zgrid_zoom[iz], i+1, NZOOM))
+            zgrid_zoom = np.array(zgrid_zoom)
+        
+            out = self.xfit_zgrid(zgrid_zoom, label='- ', **zgrid_kwargs)
+            chi2_zoom, logpdf_zoom, coeffs_zoom, covar_zoom = out
         
             zgrid = np.append(zgrid, zgrid_zoom)
             chi2 = np.append(chi2, chi2_zoom)
@@ -2794,7 +3392,7 @@ class GroupFitter(object):
             else:
                 spec1 = utils.SpectrumTemplate(wave=oned[k]['wave'], flux=3.e18/oned[k]['wave']**2)
             
-            flux1 = np.array([spec1.integrate_filter(filt, use_wave='filter') for filt in filters]) 
+            flux1 = spec1.integrate_filter_list(filters, use_wave='filter')
             okfilt = flux1 > 0.98
             
             if okfilt.sum() == 0:
@@ -5,10 +5,20 @@ Initial code taken from `(Brammer, Pirzkal, & Ryan 2014) <https://github.com/WFC
 explanation how the grism configuration parameters and coefficients are defined and evaluated.
 """
 import os
+from collections import OrderedDict
+
 import numpy as np
 
 from . import GRIZLI_PATH
 
+# Maximum number of positions stored in `aXeConf.get_beam_coeffs` cache
+TRACE_CACHE_SIZE = 4096
+
+# Share configuration objects loaded by `load_grism_config`, e.g., in 
+# long-running fitting processes (`~grizli.fitting.init_fit_worker`)
+CACHE_CONFIG = False
+CONFIG_CACHE = {}
+
 class aXeConf():
     def __init__(self, conf_file='WFC3.IR.G141.V2.5.conf'):
         """Read an aXe-compatible configuration file
@@ -19,6 +29,8 @@ class aXeConf():
             Filename of the configuration file to read
         
         """
+        self.trace_cache = OrderedDict()
+        
         if conf_file is not None:
             self.conf = self.read_conf_file(conf_file)
             self.conf_file = conf_file
@@ -242,6 +254,66 @@ class aXeConf():
                 
         return dp
         
+    def get_beam_coeffs(self, x=507, y=507, beam='A'):
+        """Field-dependent trace and wavelength coefficients of a beam
+        
+        Results for scalar `x` and `y` are stored in a least-recently-used 
+        cache in `trace_cache`, keyed on position and beam, with up to 
+        `TRACE_CACHE_SIZE` entries.
+        
+        Parameters
+        ----------
+        x, y : float or array-like
+            Detector coordinates.
+        
+        beam : str
+            Beam name.
+        
+        Returns
+        -------
+        xoff_beam, yoff_beam : float or array-like
+            Field-dependent XOFF and YOFF of the beam.
+        
+        dydx, dldp : list
+            Field-dependent DYDX and DLDP coefficients.
+            
+        """
+        use_cache = np.isscalar(x) & np.isscalar(y)
+        if use_cache:
+            if not hasattr(self, 'trace_cache'):
+                self.trace_cache = OrderedDict()
+                
+            key = (float(x), float(y), beam)
+            if key in self.trace_cache:
+                self.trace_cache.move_to_end(key)
+                xoff_beam, yoff_beam, dydx, dldp = self.trace_cache[key]
+                return xoff_beam, yoff_beam, list(dydx), list(dldp)
+                
+        NORDER = self.orders[beam]+1
+        
+        xi, yi = x-self.xoff, y-self.yoff
+        xoff_beam = self.field_dependent(xi, yi, self.conf['XOFF_{0}'.format(beam)])
+        yoff_beam = self.field_dependent(xi, yi, self.conf['YOFF_{0}'.format(beam)])
+        
+        dydx = [0]*NORDER
+        dldp = [0]*NORDER
+        for i in range(NORDER):
+            if 'DYDX_{0:s}_{1:d}'.format(beam, i) in self.conf.keys():
+                coeffs = self.conf['DYDX_{0:s}_{1:d}'.format(beam, i)]
+                dydx[i] = self.field_dependent(xi, yi, coeffs)
+            
+            if 'DLDP_{0:s}_{1:d}'.format(beam, i) in self.conf.keys():
+                coeffs = self.conf['DLDP_{0:s}_{1:d}'.format(beam, i)]
+                dldp[i] = self.field_dependent(xi, yi, coeffs)
+        
+        if use_cache:
+            self.trace_cache[key] = (xoff_beam, yoff_beam, tuple(dydx), 
+                                     tuple(dldp))
+            if len(self.trace_cache) > TRACE_CACHE_SIZE:
+                self.trace_cache.popitem(last=False)
+                
+        return xoff_beam, yoff_beam, dydx, dldp
+        
     def get_beam_trace(self, x=507, y=507, dx=0., beam='A', fwcpos=None):
         """Get an aXe beam trace for an input reference pixel and list of output x pixels `dx`
         
@@ -276,33 +348,17 @@ class aXeConf():
         NORDER = self.orders[beam]+1
         
         xi, yi = x-self.xoff, y-self.yoff
-        xoff_beam = self.field_dependent(xi, yi, self.conf['XOFF_{0}'.format(beam)])
-        yoff_beam = self.field_dependent(xi, yi, self.conf['YOFF_{0}'.format(beam)])
-    
-        ## y offset of trace (DYDX)
-        dydx = np.zeros(NORDER) #0 #+1.e-80
-        dydx = [0]*NORDER
         
-        for i in range(NORDER):
-            if 'DYDX_{0:s}_{1:d}'.format(beam, i) in self.conf.keys():
-                coeffs = self.conf['DYDX_{0:s}_{1:d}'.format(beam, i)]
-                dydx[i] = self.field_dependent(xi, yi, coeffs)
+        ## Field-dependent offsets, trace (DYDX) and wavelength solution
+        ## (DLDP) coefficients
+        xoff_beam, yoff_beam, dydx, dldp = self.get_beam_coeffs(x, y, beam)
         
         # $dy = dydx_0+dydx_1 dx+dydx_2 dx^2+$ ...
 
-        dy = yoff_beam
+        dy = yoff_beam*1
         for i in range(NORDER):
             dy += dydx[i]*(dx-xoff_beam)**i
         
-        ## wavelength solution    
-        dldp = np.zeros(NORDER)
-        dldp = [0]*NORDER
-        
-        for i in range(NORDER):
-            if 'DLDP_{0:s}_{1:d}'.format(beam, i) in self.conf.keys():
-                coeffs = self.conf['DLDP_{0:s}_{1:d}'.format(beam, i)]
-                dldp[i] = self.field_dependent(xi, yi, coeffs)
-        
         self.eval_input = {'x':x, 'y':y, 'beam':beam, 'dx':dx,
                            'fwcpos':fwcpos}
         self.eval_output = {'xi':xi, 'yi':yi, 'dldp':dldp, 'dydx':dydx, 
@@ -554,7 +610,7 @@ def get_config_filename(instrume='WFC3', filter='F140W',
             
     return conf_file
         
-def load_grism_config(conf_file):
+def load_grism_config(conf_file, use_cache=None):
     """Load parameters from an aXe configuration file
     
     Parameters
@@ -562,12 +618,29 @@ def load_grism_config(conf_file):
     conf_file : str
         Filename of the configuration file
     
+    use_cache : bool or None
+        Return a configuration object already read from `conf_file` from 
+        `CONFIG_CACHE`, which is then shared by all of the objects that 
+        use it.  If None, use the module-level `CACHE_CONFIG` flag.
+        
     Returns
     -------
     conf : `~grizli.grismconf.aXeConf`
         Configuration file object.  Runs `conf.get_beams()` to read the 
         sensitivity curves.
     """
+    if use_cache is None:
+        use_cache = CACHE_CONFIG
+    
+    if use_cache:
+        key = os.path.abspath(conf_file)
+        if key in CONFIG_CACHE:
+            return CONFIG_CACHE[key]
+            
     conf = aXeConf(conf_file)
     conf.get_beams()
+    
+    if use_cache:
+        CONFIG_CACHE[key] = conf
+        
     return conf
@@ -3,6 +3,7 @@ Model grism spectra in individual FLTs
 """
 import os
 from collections import OrderedDict
+from collections.abc import ItemsView, ValuesView
 import copy
 
 import numpy as np
@@ -80,6 +81,139 @@ if False:
         obs = S.Observation(spec, bp)
         photflam_list[filter] = n/obs.countrate()
 
+class LazyFITSData(OrderedDict):
+    """`~collections.OrderedDict` of arrays read lazily from FITS extensions
+    
+    The FITS file is opened with `memmap=True` and an array is only copied
+    into memory the first time it is accessed as an item.  Use `get_cutout`
+    to read a sub-array directly from the memory-mapped file without 
+    loading the full array.  `get`, `items` and `values` also read the 
+    arrays on access.  Pickled copies store the filename and reopen the 
+    file when needed.
+    """
+    def __init__(self, file, extensions={}):
+        """
+        Parameters
+        ----------
+        file : str
+            FITS filename.
+        
+        extensions : dict
+            Keys of the dictionary and the corresponding EXTNAME in `file`.
+            Keys with an EXTNAME of `None` are initialized with `None` 
+            values.
+        
+        """
+        OrderedDict.__init__(self)
+        self.file = file
+        self.extensions = OrderedDict()
+        self._hdulist = None
+        for key in extensions:
+            if extensions[key] is not None:
+                self.extensions[key] = extensions[key]
+            
+            OrderedDict.__setitem__(self, key, None)
+    
+    @property 
+    def hdulist(self):
+        """Memory-mapped `~astropy.io.fits.HDUList`, opened on first use
+        """
+        if self._hdulist is None:
+            self._hdulist = pyfits.open(self.file, memmap=True)
+        
+        return self._hdulist
+        
+    def __getitem__(self, key):
+        if key in self.extensions:
+            data = self.hdulist[self.extensions[key]].data
+            if data is not None:
+                data = data*1
+            
+            self[key] = data
+            
+        return OrderedDict.__getitem__(self, key)
+    
+    def __setitem__(self, key, value):
+        if key in self.extensions:
+            self.extensions.pop(key)
+            
+        OrderedDict.__setitem__(self, key, value)
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        else:
+            return default
+    
+    def items(self):
+        return ItemsView(self)
+    
+    def values(self):
+        return ValuesView(self)
+        
+    def __reduce__(self):
+        extensions = OrderedDict()
+        items = []
+        for key in self:
+            if key in self.extensions:
+                extensions[key] = self.extensions[key]
+            else:
+                extensions[key] = None
+                items.append((key, OrderedDict.__getitem__(self, key)))
+        
+        return (self.__class__, (self.file, extensions), None, None, 
+                iter(items))
+                
+    def is_loaded(self, key):
+        """Has the array for `key` been read into memory?
+        """
+        return key not in self.extensions
+        
+    def get_cutout(self, key, slices):
+        """Copy of a sub-array, read from the file if not already loaded
+        
+        Parameters
+        ----------
+        key : str
+            Dictionary key.
+        
+        slices : tuple of slice
+            Slices of the array to extract, e.g., `(sly, slx)`.
+        
+        Returns
+        -------
+        cutout : array-like or None
+            Copy of the sliced data.
+            
+        """
+        if key in self.extensions:
+            data = self.hdulist[self.extensions[key]].data
+        else:
+            data = OrderedDict.__getitem__(self, key)
+        
+        if data is None:
+            return None
+            
+        return data[slices]*1
+        
+    def close(self):
+        """Close the memory-mapped file
+        """
+        if self._hdulist is not None:
+            self._hdulist.close()
+            self._hdulist = None
+
+def _get_data_cutout(data, key, slices):
+    """Cutout from a `dict` of arrays, reading `LazyFITSData` without 
+    loading the full array
+    """
+    if hasattr(data, 'get_cutout'):
+        return data.get_cutout(key, slices)
+    elif data[key] is None:
+        return None
+    else:
+        return data[key][slices]*1
+
 class GrismDisperser(object):
     def __init__(self, id=0, direct=None, 
                        segmentation=None, origin=[500, 500], 
@@ -253,6 +387,7 @@ class GrismDisperser(object):
         """
         self.seg = seg_array*1
         self.seg_ids = list(np.unique(self.seg))
+        self.A_resp = None
         try:
             self.total_flux = self.direct[self.seg == self.id].sum()
             if self.total_flux == 0:
@@ -282,8 +417,49 @@ class GrismDisperser(object):
         
         """
         self.MW_F99 = None
+        self.MW_EBV_RV = (MW_EBV, R_V)
         if MW_EBV > 0:
             self.MW_F99 = utils.MW_F99(MW_EBV*R_V, r_v=R_V)
+    
+    def get_sensitivity_curve(self):
+        """Sensitivity curve of the beam with Galactic extinction applied
+        
+        The curve is cached in a `sens_cache` dictionary attribute of the 
+        configuration object `self.conf`, keyed on the beam name and the 
+        extinction parameters, so it is only computed once for all of the 
+        dispersers that share the same configuration.
+        
+        Returns
+        -------
+        wave, sens : `~numpy.ndarray`
+            Wavelengths and sensitivity, including the `MW_F99` extinction.
+            The arrays are shared and shouldn't be modified.
+        """
+        if self.MW_F99 is None:
+            key = (self.beam, None)
+            cacheable = True
+        else:
+            # Can't cache if `MW_F99` was set directly
+            key = (self.beam, getattr(self, 'MW_EBV_RV', None))
+            cacheable = key[1] is not None
+            
+        sens_cache = getattr(self.conf, 'sens_cache', None)
+        if sens_cache is None:
+            sens_cache = self.conf.sens_cache = {}
+        
+        if cacheable & (key in sens_cache):
+            return sens_cache[key]
+            
+        conf_sens = self.conf.sens[self.beam]
+        wave = np.cast[np.float64](conf_sens['WAVELENGTH'])
+        sens = np.cast[np.float64](conf_sens['SENSITIVITY'])
+        if self.MW_F99 is not None:
+            sens = sens*10**(-0.4*(self.MW_F99(wave*u.AA)))
+        
+        if cacheable:
+            sens_cache[key] = wave, sens
+            
+        return wave, sens
             
     def process_config(self):
         """Process grism config file
@@ -332,15 +508,9 @@ class GrismDisperser(object):
         ysens = self.lam_beam*0
         so = np.argsort(self.lam_beam)
         
-        conf_sens = self.conf.sens[self.beam]
-        if self.MW_F99 is not None:
-            MWext = 10**(-0.4*(self.MW_F99(conf_sens['WAVELENGTH']*u.AA)))
-        else:
-            MWext = 1.
-        
+        sens_wave, sens_curve = self.get_sensitivity_curve()
         ysens[so] = interp.interp_conserve_c(self.lam_beam[so],
-                                             conf_sens['WAVELENGTH'], 
-                                             conf_sens['SENSITIVITY']*MWext,
+                                             sens_wave, sens_curve,
                                              integrate=1, left=0, right=0)
         self.lam_sort = so
         
@@ -387,8 +557,7 @@ class GrismDisperser(object):
         ysens = self.lam*0
         so = np.argsort(self.lam)
         ysens[so] = interp.interp_conserve_c(self.lam[so],
-                                             conf_sens['WAVELENGTH'], 
-                                             conf_sens['SENSITIVITY']*MWext,
+                                             sens_wave, sens_curve,
                                              integrate=1, left=0, right=0)
         
         # dl = np.abs(np.append(self.lam[1] - self.lam[0],
@@ -402,6 +571,9 @@ class GrismDisperser(object):
         
         self.sly_parent = slice(self.origin[0], self.origin[0] + self.sh[0])
         
+        # Dispersion response matrix has to be recomputed
+        self.A_resp = None
+        
         #print 'XXX wavelength: %s %s %s' %(self.lam[-5:], self.lam_beam[-5:], dl[-5:])
             
     def add_ytrace_offset(self, yoffset):
@@ -447,7 +619,9 @@ class GrismDisperser(object):
         
         self.ytrace *= self.grow
         self.ytrace += yoffset
-                
+        
+        self.A_resp = None
+        
     def compute_model(self, id=None, thumb=None, spectrum_1d=None,
                       in_place=True, modelf=None, scale=None, is_cgs=False,
                       apply_sensitivity=True, reset=True):
@@ -487,7 +661,6 @@ class GrismDisperser(object):
             the result is stored in `self.model` and `self.modelf`.
         """
         from .utils_c import disperse
-        from .utils_c import interp
         
         if id is None:
             id = self.id
@@ -505,18 +678,11 @@ class GrismDisperser(object):
         else:
             self.scale = scale
             
-        if spectrum_1d is not None:
-            xspec, yspec = spectrum_1d
-            scale_spec = self.sensitivity_beam*0.
-            int_func = interp.interp_conserve_c
-            scale_spec[self.lam_sort] = int_func(self.lam_beam[self.lam_sort],
-                                                xspec, yspec)*scale
-        else:
-            scale_spec = scale
-        
         self.is_cgs = is_cgs
-        if is_cgs:
-            scale_spec /= total_flux
+        sens_spec = self.get_scaled_sensitivity(spectrum_1d=spectrum_1d,
+                                       scale=scale, is_cgs=is_cgs, 
+                                       apply_sensitivity=apply_sensitivity, 
+                                       total_flux=total_flux)
                
         ### Output data, fastest is to compute in place but doesn't zero-out
         ### previous result                    
@@ -538,18 +704,13 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
                 return False
 
         ### Now compute the dispersed spectrum using the C helper
-        if apply_sensitivity:
-            sens_curve = self.sensitivity_beam
-        else:
-            sens_curve = 1.
-        
-        nonz = (sens_curve*scale_spec) != 0
+        nonz = sens_spec != 0
         
         if (nonz.sum() > 0) & (id in self.seg_ids):
             status = disperse.disperse_grism_object(thumb, self.seg, 
                                  np.float32(id),
                                  self.flat_index[nonz], self.yfrac_beam[nonz],
-                                 (sens_curve*scale_spec)[nonz],
+                                 sens_spec[nonz],
                                  modelf, self.x0, 
                                  np.array(self.sh, dtype=np.int64),
                                  self.x0, 
@@ -564,6 +725,147 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
             self.model = modelf.reshape(self.sh_beam)
             return True
     
+    def init_response_matrix(self, id=None, thumb=None):
+        """Precompute the sparse dispersion response matrix
+        
+        The 2D model computed by `compute_model` is linear in the 1D spectrum
+        sampled at `lam_beam`, so it can be written as a sparse matrix 
+        product, ``modelf = A_resp.dot(sensitivity_beam*spec)``.  The matrix 
+        is stored in `A_resp` and is reset whenever the trace, segmentation
+        or configuration are updated.
+        
+        Parameters
+        ----------
+        id : int
+            Segmentation ID.  If None, then use `self.id`.
+        
+        thumb : `~numpy.ndarray` with shape = `self.sh` or None
+            Optional direct image.  If `None` then use `self.direct`.
+        
+        Returns
+        -------
+        A_resp : `~scipy.sparse.csr_matrix`
+            Sparse matrix with shape (`self.modelf.size`, `len(self.lam_beam)`).
+            Also stored in the `A_resp` attribute.
+        """
+        import scipy.sparse
+        
+        if id is None:
+            id = self.id
+        
+        if thumb is None:
+            thumb = self.direct
+        
+        # Same pixel limits as in `disperse.disperse_grism_object`
+        yp, xp = np.indices(self.sh)
+        valid = (thumb != 0) & (self.seg == id) 
+        valid &= (yp < 2*self.x0[0]) & (xp < 2*self.x0[1])
+        
+        j = (yp - self.x0[0])[valid]
+        i = (xp - self.x0[1])[valid]
+        fl_ij = thumb[valid].astype(np.float64)/self.PAM_value
+        
+        NK = len(self.flat_index)
+        NL = self.modelf.size
+        col = np.arange(NK)[:,None] + 0*i[None,:]
+        
+        rows, cols, vals = [], [], []
+        for dj, frac in zip([0, -1], [self.yfrac_beam, 1-self.yfrac_beam]):
+            k = self.flat_index[:,None] + (j+dj)[None,:]*self.sh_beam[1] 
+            k += i[None,:]
+            ok = (k >= 0) & (k < NL)
+            rows.append(k[ok])
+            cols.append(col[ok])
+            vals.append((frac[:,None]*fl_ij[None,:])[ok])
+        
+        self.A_resp = scipy.sparse.csr_matrix((np.hstack(vals), 
+                                               (np.hstack(rows), 
+                                                np.hstack(cols))), 
+                                               shape=(NL, NK))
+        self.resp_id = id
+        
+        return self.A_resp
+        
+    def compute_model_response(self, spectrum_1d=None, scale=None, 
+                               is_cgs=False, apply_sensitivity=True, 
+                               A_resp=None):
+        """Compute a 2D model with the precomputed response matrix
+        
+        Equivalent to `compute_model` with ``in_place=False`` for the
+        object `id` used in `init_response_matrix`.
+        
+        Parameters
+        ----------
+        spectrum_1d, scale, is_cgs, apply_sensitivity : 
+            See `compute_model`.
+        
+        A_resp : `~scipy.sparse.csr_matrix` or None
+            Response matrix to use, e.g., a row-sliced version of `A_resp` 
+            for just the unmasked pixels.  If None, use `self.A_resp` and 
+            compute it if necessary.
+        
+        Returns
+        -------
+        modelf : `~numpy.ndarray`
+            Flattened model with `A_resp.shape[0]` elements.
+        """
+        if A_resp is None:
+            if getattr(self, 'A_resp', None) is None:
+                self.init_response_matrix()
+            
+            A_resp = self.A_resp
+            
+        sens_spec = self.get_scaled_sensitivity(spectrum_1d=spectrum_1d,
+                                       scale=scale, is_cgs=is_cgs, 
+                                       apply_sensitivity=apply_sensitivity)
+        
+        return A_resp.dot(sens_spec)
+    
+    def get_scaled_sensitivity(self, spectrum_1d=None, scale=None, 
+                               is_cgs=False, apply_sensitivity=True, 
+                               total_flux=None):
+        """Template spectrum times sensitivity along the trace
+        
+        This is the 1D array that is dispersed by `compute_model`.
+        
+        Parameters
+        ----------
+        spectrum_1d, scale, is_cgs, apply_sensitivity : 
+            See `compute_model`.  If `scale` is None, use `self.scale`.
+        
+        total_flux : float or None
+            Normalization for `is_cgs`.  If None, use `self.total_flux`.
+            
+        Returns
+        -------
+        sens_spec : `~numpy.ndarray`
+            Scaled spectrum with the same shape as `lam_beam`.
+        """
+        from .utils_c import interp
+        
+        if scale is None:
+            scale = self.scale
+        
+        if total_flux is None:
+            total_flux = self.total_flux
+            
+        if spectrum_1d is not None:
+            xspec, yspec = spectrum_1d
+            scale_spec = self.sensitivity_beam*0.
+            int_func = interp.interp_conserve_c
+            scale_spec[self.lam_sort] = int_func(self.lam_beam[self.lam_sort],
+                                                xspec, yspec)*scale
+        else:
+            scale_spec = self.sensitivity_beam*0.+scale
+        
+        if is_cgs:
+            scale_spec /= total_flux
+        
+        if apply_sensitivity:
+            scale_spec *= self.sensitivity_beam
+        
+        return scale_spec
+        
     def init_optimal_profile(self, seg_ids=None):
         """Initilize optimal extraction profile
         """
@@ -1013,18 +1315,13 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
         if flat_sensitivity:
             psf_sensitivity = np.abs(np.gradient(self.lam_psf))*photflam
         else:
-            sens = self.conf.sens[self.beam]
             # so = np.argsort(self.lam_psf)
             # s_i = interp.interp_conserve_c(self.lam_psf[so], sens['WAVELENGTH'], sens['SENSITIVITY'], integrate=1)
             # psf_sensitivity = s_i*0.
             # psf_sensitivity[so] = s_i
             
-            if self.MW_F99 is not None:
-                MWext = 10**(-0.4*(self.MW_F99(sens['WAVELENGTH']*u.AA)))
-            else:
-                MWext = 1.
-                                    
-            psf_sensitivity = self.get_psf_sensitivity(sens['WAVELENGTH'], sens['SENSITIVITY']*MWext)
+            sens_wave, sens_curve = self.get_sensitivity_curve()
+            psf_sensitivity = self.get_psf_sensitivity(sens_wave, sens_curve)
             
         self.psf_sensitivity = psf_sensitivity
         self.A_psf = scipy.sparse.csr_matrix(np.array(A_psf).T)
@@ -1067,13 +1364,8 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
             flat_y = flat_x*0.+1.e-17
             spectrum_1d = [flat_x, flat_y]
             
-        tab = self.conf.sens[self.beam]
-        if self.MW_F99 is not None:
-            MWext = 10**(-0.4*(self.MW_F99(tab['WAVELENGTH']*u.AA)))
-        else:
-            MWext = 1.
-        
-        sens_i = interp.interp_conserve_c(spectrum_1d[0], tab['WAVELENGTH'], tab['SENSITIVITY']*MWext, integrate=1, left=0, right=0)
+        sens_wave, sens_curve = self.get_sensitivity_curve()
+        sens_i = interp.interp_conserve_c(spectrum_1d[0], sens_wave, sens_curve, integrate=1, left=0, right=0)
         total_sens = np.trapz(spectrum_1d[1]*sens_i/np.gradient(spectrum_1d[0]), spectrum_1d[0])
         
         m = self.compute_model_psf(spectrum_1d=spectrum_1d, is_cgs=True, in_place=False).reshape(self.sh_beam)
@@ -1196,6 +1488,167 @@ Error: `thumb` must have the same dimensions as the direct image! ({0:d},{1:d})
         else:
             return modelf #.flatten()
             
+def compute_segmentation_index(seg, flam):
+    """Pixel limits and centroids of all segments in a single pass
+    
+    Vectorized version of `~grizli.utils_c.disperse.compute_segmentation_limits`
+    for every nonzero id in the segmentation image at once.
+    
+    Parameters
+    ----------
+    seg : `~numpy.ndarray`
+        Segmentation image.
+        
+    flam : `~numpy.ndarray`
+        Flux array for the weighted centroids, same shape as `seg`.
+    
+    Returns
+    -------
+    seg_index : dict
+        Dictionary keyed by integer id with the same output tuple as 
+        `compute_segmentation_limits`, i.e., 
+        
+            >>> ymin, ymax, y, xmin, xmax, x, area, segm_flux = seg_index[id]
+            
+    """
+    sh = seg.shape
+    nz = np.flatnonzero(seg)
+    ids, inv = np.unique(np.cast[int](seg.flat[nz]), return_inverse=True)
+    N = len(ids)
+    if N == 0:
+        return {}
+        
+    ii, jj = nz // sh[1], nz % sh[1]
+    wht = np.cast[np.float64](flam.flat[nz])
+    
+    # Sums accumulated in the same pixel order as the Cython function
+    area = np.bincount(inv, minlength=N)
+    denom = np.bincount(inv, weights=wht, minlength=N)
+    inumer = np.bincount(inv, weights=ii*wht, minlength=N)
+    jnumer = np.bincount(inv, weights=jj*wht, minlength=N)
+    denom[denom == 0] = -99
+    
+    so = np.argsort(inv, kind='stable')
+    starts = np.hstack([0, np.cumsum(area)[:-1]])
+    imin = ii[so][starts]
+    imax = ii[so][starts+area-1]
+    jmin = np.minimum.reduceat(jj[so], starts)
+    jmax = np.maximum.reduceat(jj[so], starts)
+    
+    seg_index = {}
+    for k in range(N):
+        seg_index[int(ids[k])] = (int(imin[k]), int(imax[k]), 
+                                  float(inumer[k]/denom[k]), 
+                                  int(jmin[k]), int(jmax[k]), 
+                                  float(jnumer[k]/denom[k]), 
+                                  int(area[k]), float(denom[k]))
+    
+    return seg_index
+    
+def disperse_beams(beams, spectra=None, is_cgs=False, num_threads=0):
+    """Compute models of many `GrismDisperser` objects in a single call
+    
+    The dispersion of all of the beams is done with the multi-threaded 
+    `~grizli.utils_c.disperse.disperse_grism_objects` kernel, which releases 
+    the GIL.  The result is equivalent to 
+    
+        >>> for beam, spec in zip(beams, spectra):
+        >>>     beam.compute_model(spectrum_1d=spec, is_cgs=is_cgs)
+    
+    Parameters
+    ----------
+    beams : list of `GrismDisperser`
+        Beams to compute.  Beams with `psf` attributes are computed 
+        individually with `compute_model_psf`.
+        
+    spectra : list or None
+        List of `spectrum_1d` templates for each beam.  If None, use flat 
+        spectra.
+    
+    is_cgs : bool or list of bool
+        See `GrismDisperser.compute_model`.
+    
+    num_threads : int
+        Number of threads.  If <= 0, use the OpenMP default, which can be 
+        set with the `OMP_NUM_THREADS` environment variable.
+        
+    Returns
+    -------
+    Models are stored in the `model` and `modelf` attributes of the `beams`.
+    """
+    from .utils_c import disperse
+    
+    N = len(beams)
+    if spectra is None:
+        spectra = [None]*N
+    
+    if np.isscalar(is_cgs):
+        is_cgs = [is_cgs]*N
+        
+    seg_id, x0, shd, shg = [], [], [], []
+    flam, segm, idxl, yfrac, ysens = [], [], [], [], []
+    thumb_size, trace_size, model_size = [0], [0], [0]
+    
+    compute = []
+    for beam, spec, cgs in zip(beams, spectra, is_cgs):
+        if hasattr(beam, 'psf'):
+            beam.compute_model_psf(spectrum_1d=spec, is_cgs=cgs)
+            continue
+        
+        beam.spectrum_1d = spec
+        beam.is_cgs = cgs
+        sens_spec = beam.get_scaled_sensitivity(spectrum_1d=spec, 
+                                                is_cgs=cgs)
+        
+        nonz = sens_spec != 0
+        if (nonz.sum() == 0) | (beam.id not in beam.seg_ids):
+            nonz &= False
+            
+        compute.append(beam)
+        seg_id.append(beam.id)
+        x0.append(beam.x0)
+        shd.append(beam.sh)
+        shg.append(beam.sh_beam)
+        
+        flam.append(beam.direct.flatten())
+        segm.append(beam.seg.flatten())
+        thumb_size.append(beam.direct.size)
+        
+        idxl.append(beam.flat_index[nonz])
+        yfrac.append(beam.yfrac_beam[nonz])
+        ysens.append(sens_spec[nonz])
+        trace_size.append(nonz.sum())
+        
+        model_size.append(beam.modelf.size)
+    
+    if len(compute) == 0:
+        return True
+        
+    full = np.zeros(np.sum(model_size), dtype=np.float64)
+    full_offset = np.cumsum(model_size)
+    
+    disperse.disperse_grism_objects(np.cast[np.float32](np.hstack(flam)),
+                            np.cast[np.float32](np.hstack(segm)),
+                            np.array(seg_id, dtype=np.float32),
+                            np.cumsum(thumb_size).astype(np.int64),
+                            np.array(x0, dtype=np.int64),
+                            np.array(shd, dtype=np.int64),
+                            np.hstack(idxl).astype(np.int64), 
+                            np.hstack(yfrac).astype(np.float64), 
+                            np.hstack(ysens).astype(np.float64), 
+                            np.cumsum(trace_size).astype(np.int64),
+                            full, full_offset.astype(np.int64),
+                            np.array(shg, dtype=np.int64), 
+                            num_threads=num_threads)
+    
+    for i, beam in enumerate(compute):
+        beam.modelf *= 0
+        beam.modelf += full[full_offset[i]:full_offset[i+1]]
+        beam.modelf /= beam.PAM_value
+        beam.model = beam.modelf.reshape(beam.sh_beam)
+    
+    return True
+    
 class ImageData(object):
     """Container for image data with WCS, etc."""
     def __init__(self, sci=None, err=None, dq=None,
@@ -1988,9 +2441,12 @@ class ImageData(object):
             slice_header = pyfits.Header()
             
         ### Generate new object        
-        slice_obj = ImageData(sci=self.data['SCI'][sly, slx]/self.photflam, 
-                              err=self.data['ERR'][sly, slx]/self.photflam, 
-                              dq=self.data['DQ'][sly, slx]*1, 
+        slices = (sly, slx)
+        slice_obj = ImageData(sci=_get_data_cutout(self.data, 'SCI', 
+                                                   slices)/self.photflam, 
+                              err=_get_data_cutout(self.data, 'ERR',
+                                                   slices)/self.photflam, 
+                              dq=_get_data_cutout(self.data, 'DQ', slices),
                               header=slice_header, wcs=slice_wcs,
                               photflam=self.photflam, photplam=self.photplam,
                               origin=slice_origin, instrument=self.instrument,
@@ -2006,10 +2462,7 @@ class ImageData(object):
         slice_obj.ABZP = self.ABZP
         slice_obj.thumb_extension = self.thumb_extension
         
-        if self.data['REF'] is not None:
-            slice_obj.data['REF'] = self.data['REF'][sly, slx]*1
-        else:
-            slice_obj.data['REF'] = None
+        slice_obj.data['REF'] = _get_data_cutout(self.data, 'REF', slices)
         
         slice_obj.grow = self.grow
         slice_obj.pad = self.pad             
@@ -2321,7 +2774,42 @@ class GrismFLT(object):
                            
         self.is_rotated = False
         self.has_edge_mask = False
+    
+    def __getattr__(self, name):
+        """Read `seg` and `model` arrays on first access after 
+        `load_from_fits` with `lazy=True`.
+        """
+        lazy = self.__dict__.get('_lazy_arrays', None)
+        if (lazy is None) | (name not in ['seg', 'model']):
+            raise AttributeError(name)
+        
+        value = lazy[name]
+        setattr(self, name, value)
+        del(lazy[name])
         
+        return value
+    
+    def get_cutout(self, attr, slices):
+        """Copy of a cutout of the `seg` or `model` arrays
+        
+        With `load_from_fits(lazy=True)`, the cutout is read from the 
+        memory-mapped file if the full array hasn't been loaded yet.
+        
+        Parameters
+        ----------
+        attr : str
+            'seg' or 'model'.
+        
+        slices : tuple of slice
+            Slices of the array to extract, e.g., `(sly, slx)`.
+        
+        """
+        lazy = self.__dict__.get('_lazy_arrays', None)
+        if (lazy is not None) & (attr not in self.__dict__):
+            return lazy.get_cutout(attr, slices)
+        else:
+            return getattr(self, attr)[slices]*1
+            
     def process_ref_file(self, ref_file, ref_ext=0, shrink_segimage=True,
                          verbose=True):
         """Read and blot a reference image
@@ -2546,7 +3034,7 @@ class GrismFLT(object):
                       spectrum_1d=None, is_cgs=False,
                       compute_size=False, max_size=None, store=True, 
                       in_place=True, add=True, get_beams=None, 
-                      psf_params=None, 
+                      psf_params=None, batch=None, footprints=None,
                       verbose=True):
         """Compute dispersed spectrum for a given object id
         
@@ -2615,6 +3103,17 @@ class GrismFLT(object):
             
             If `in_place` is False, return a full array including the model 
             for the single object.
+        
+        batch : list or None
+            If a list is provided and `in_place` is True, then append the 
+            beams (without PSF models) to the list rather than computing and
+            adding them to `self.model` directly.  Compute them all at once
+            later with `disperse_beams`, as in `compute_full_model`.
+        
+        footprints : list or None
+            If a list is provided and `in_place` is True, append 
+            ``(sly_parent, slx_parent)`` slices of the beams added to 
+            `self.model`.
         """               
         from .utils_c import disperse
         
@@ -2674,9 +3173,7 @@ class GrismFLT(object):
                 
             if (compute_size) | (x is None) | (y is None) | (size is None):
                 ### Get the array indices of the segmentation region
-                out = disperse.compute_segmentation_limits(self.seg, id,
-                                         self.direct.data[ext],
-                                         self.direct.sh)
+                out = self.get_segmentation_limits(id, ext=ext)
                 
                 ymin, ymax, y, xmin, xmax, x, area, segm_flux = out
                 if (area == 0) | ~np.isfinite(x) | ~np.isfinite(y):
@@ -2851,9 +3348,15 @@ class GrismFLT(object):
             #     if not skip_init_psf:
             #         beam.x_init_epsf(flat_sensitivity=False, psf_params=psf_params, psf_filter=psf_filter, yoff=0.06)
                 
+            if (footprints is not None) & in_place:
+                footprints.append((beam.sly_parent, beam.slx_parent))
+                
             ### Compute model
             if hasattr(beam, 'psf'):
                 beam.compute_model_psf(spectrum_1d=spectrum_1d, is_cgs=is_cgs)
+            elif (batch is not None) & in_place:
+                batch.append((beam, spectrum_1d, is_cgs))
+                continue
             else:
                 beam.compute_model(spectrum_1d=spectrum_1d, is_cgs=is_cgs)
             
@@ -2865,8 +3368,48 @@ class GrismFLT(object):
         else:
             return beams, output
     
+    def get_segmentation_limits(self, id, ext='REF'):
+        """Pixel limits and centroid of a segmentation region
+        
+        Same output as `~grizli.utils_c.disperse.compute_segmentation_limits`
+        on the full `seg` array, but read from an index of all of the 
+        segments computed once with `compute_segmentation_index`.  The index
+        is stored in `seg_index` and recomputed if `seg` or the direct image
+        array is replaced.
+        
+        Parameters
+        ----------
+        id : int
+            Segmentation id.
+        
+        ext : str
+            Extension of `direct.data` used for the flux-weighted centroid.
+        
+        Returns
+        -------
+        ymin, ymax, y, xmin, xmax, x, area, segm_flux : 
+            Segment limits, centroid, area and total flux.
+        """
+        flam = self.direct.data[ext]
+        index = getattr(self, 'seg_index', None)
+        if index is not None:
+            if (index[0] != ext) | (index[1] is not self.seg) | (index[2] is not flam):
+                index = None
+        
+        if index is None:
+            seg_index = compute_segmentation_index(self.seg, flam)
+            self.seg_index = index = (ext, self.seg, flam, seg_index)
+        
+        id = int(id)
+        if id in index[3]:
+            return index[3][id]
+        else:
+            # Not found, same as compute_segmentation_limits
+            return (self.seg.shape[0], 0, 0/-99., self.seg.shape[1], 0, 
+                    0/-99., 0, -99.)
+            
     def compute_full_model(self, ids=None, mags=None, mag_limit=22,
-                           store=True, verbose=False):
+                           store=True, verbose=False, num_threads=None):
         """Compute flat-spectrum model for multiple objects.
         
         Parameters
@@ -2880,12 +3423,16 @@ class GrismFLT(object):
             magnitudes based on the flux in segmentation regions and 
             zeropoints determined from PHOTFLAM and PHOTPLAM.
         
+        num_threads : int or None
+            If not None, set up the dispersers for all of the objects first
+            and then compute their models together with the multi-threaded
+            `disperse_beams` (see there for the meaning of `num_threads`).  
+            Otherwise compute the objects one at a time.
+        
         Returns
         -------
         Updated model stored in `self.model` attribute.
         """
-        from .utils_c import disperse
-
         if ids is None:
             ids = np.unique(self.seg)[1:]
         
@@ -2897,9 +3444,8 @@ class GrismFLT(object):
             
             mags = np.zeros(len(ids))
             for i, id in enumerate(ids):
-                out = disperse.compute_segmentation_limits(self.seg, id,
-                                self.direct.data[self.direct.thumb_extension],
-                                     self.direct.sh)
+                out = self.get_segmentation_limits(id,
+                                         ext=self.direct.thumb_extension)
             
                 ymin, ymax, y, xmin, xmax, x, area, segm_flux = out
                 mags[i] = self.direct.ABZP - 2.5*np.log10(segm_flux)
@@ -2916,12 +3462,27 @@ class GrismFLT(object):
                     raise ValueError ('`ids` and `mags` lists different sizes')
         
         ### Now compute the full model
+        if num_threads is None:
+            batch = None
+        else:
+            batch = []
+            
         for id_i, mag_i in zip(ids, mags):
             if verbose:
                 print(utils.NO_NEWLINE + 'compute model id={0:d}'.format(id_i))
                 
             self.compute_model_orders(id=id_i, compute_size=True, mag=mag_i, 
-                                      in_place=True, store=store)
+                                      in_place=True, store=store, 
+                                      batch=batch)
+        
+        if batch:
+            beams = [b[0] for b in batch]
+            disperse_beams(beams, spectra=[b[1] for b in batch], 
+                           is_cgs=[b[2] for b in batch], 
+                           num_threads=num_threads)
+            
+            for beam in beams:
+                beam.add_to_full_image(beam.model, self.model)
     
     def smooth_mask(self, gaussian_width=4, threshold=2.5):
         """Compute a mask where smoothed residuals greater than some value
@@ -3231,6 +3792,7 @@ class GrismFLT(object):
         
         ## zero out large data objects
         self.direct.data = self.grism.data = self.seg = self.model = None
+        self.seg_index = None
                                             
         fp = open('{0}.{1:02d}.GrismFLT.pkl'.format(root, self.grism.sci_extn), 'wb')
         pickle.dump(self, fp)
@@ -3265,7 +3827,7 @@ class GrismFLT(object):
             if verbose:
                 print(wcsfile)
             
-    def load_from_fits(self, save_file):
+    def load_from_fits(self, save_file, lazy=False):
         """Load saved data from a FITS file
         
         Parameters
@@ -3273,10 +3835,38 @@ class GrismFLT(object):
         save_file : str
             Filename of the saved output
         
+        lazy : bool
+            Memory-map the file and only read the arrays into memory when 
+            they are first accessed.  The `direct.data` and `grism.data` 
+            dictionaries are `LazyFITSData` objects and the `seg` and 
+            `model` attributes are read on demand (see `__getattr__`).  
+            Cutouts, e.g., for `BeamCutout`, are read directly from the 
+            file.
+            
         Returns
         -------
         True if completed successfully
         """
+        if lazy:
+            fits = pyfits.open(save_file, memmap=True)
+            extensions = {'D':OrderedDict(), 'G':OrderedDict()}
+            for ext in range(1,len(fits)):
+                extname = fits[ext].header['EXTNAME']
+                if extname[0] in extensions:
+                    extensions[extname[0]][extname[1:]] = extname
+            
+            fits.close()
+            
+            self.direct.data = LazyFITSData(save_file, extensions['D'])
+            self.grism.data = LazyFITSData(save_file, extensions['G'])
+            self._lazy_arrays = LazyFITSData(save_file, {'seg':'SEG', 
+                                                         'model':'MODEL'})
+            for attr in ['seg', 'model']:
+                if attr in self.__dict__:
+                    self.__dict__.pop(attr)
+                    
+            return True
+            
         fits = pyfits.open(save_file)
         self.seg = fits['SEG'].data*1
         self.model = fits['MODEL'].data*1
@@ -3709,7 +4299,8 @@ class BeamCutout(object):
                                          self.beam.sly_parent,
                                          get_slice_header=get_slice_header)
         
-        self.contam = flt.model[self.beam.sly_parent, self.beam.slx_parent]*1
+        self.contam = flt.get_cutout('model', (self.beam.sly_parent,
+                                               self.beam.slx_parent))
         if self.beam.id in flt.object_dispersers:
             self.contam -= self.beam.model
         
@@ -3969,7 +4560,63 @@ class BeamCutout(object):
             self.model = self.beam.modelf.reshape(self.beam.sh_beam)
                 
         return result
+    
+    def compute_masked_model(self, spectrum_1d=None, is_cgs=True, 
+                             apply_sensitivity=True):
+        """Model at the unmasked pixels with the dispersion response matrix
+        
+        Equivalent to 
+        ``self.compute_model(in_place=False, ...)[self.fit_mask]``, but uses 
+        a row-slice of `~grizli.model.GrismDisperser.A_resp` for the pixels 
+        in `fit_mask` that is computed once and reused until `fit_mask` or
+        the parent dispersion changes.  
+        
+        Falls back to `compute_model` for ePSF models.
+        
+        Parameters
+        ----------
+        spectrum_1d, is_cgs, apply_sensitivity : 
+            See `~grizli.model.GrismDisperser.compute_model`.
+        
+        Returns
+        -------
+        modelf : `~numpy.ndarray`
+            Model at the pixels where `fit_mask` is True.
+        """
+        if hasattr(self.beam, 'psf'):
+            return self.compute_model(spectrum_1d=spectrum_1d, in_place=False,
+                                      is_cgs=is_cgs, 
+                                      apply_sensitivity=apply_sensitivity)[self.fit_mask]
+        
+        return self.beam.compute_model_response(spectrum_1d=spectrum_1d,
+                                       is_cgs=is_cgs, 
+                                       apply_sensitivity=apply_sensitivity,
+                                       A_resp=self.get_masked_response())
+    
+    def get_masked_response(self):
+        """Row-slice of the dispersion response matrix for `fit_mask`
+        
+        Returns
+        -------
+        A_resp_mask : `~scipy.sparse.csr_matrix`
+            Rows of `~grizli.model.GrismDisperser.A_resp` where `fit_mask` 
+            is True, with shape (`fit_mask.sum()`, `len(beam.lam_beam)`).
+        """
+        if getattr(self.beam, 'A_resp', None) is None:
+            self.beam.init_response_matrix()
+            self.A_resp_mask = None
+        
+        if getattr(self, 'A_resp_mask', None) is not None:
+            if ((self.A_resp_mask_key[0] is not self.beam.A_resp) | 
+                (not np.array_equal(self.A_resp_mask_key[1], self.fit_mask))):
+                self.A_resp_mask = None
                 
+        if getattr(self, 'A_resp_mask', None) is None:
+            self.A_resp_mask = self.beam.A_resp[self.fit_mask,:]
+            self.A_resp_mask_key = (self.beam.A_resp, self.fit_mask*1)
+        
+        return self.A_resp_mask
+        
     def get_wavelength_wcs(self, wavelength=1.3e4):
         """Compute *celestial* WCS of the 2D spectrum array for a specified central wavelength
         
@@ -27,6 +27,10 @@ from .utils_c import interp
 
 from .utils import GRISM_COLORS, GRISM_MAJOR, GRISM_LIMITS, DEFAULT_LINE_LIST
 
+# Block size, in pixels, for tracking contamination model updates in the 
+# incremental `GroupFLT.refine_list`
+REFINE_BLOCK = 16
+
 
 def test():
     
@@ -138,10 +142,17 @@ def test():
     m2d = mb.reshape_flat(modelf)
     
 def _loadFLT(grism_file, sci_extn, direct_file, pad, ref_file, 
-               ref_ext, seg_file, verbose, catalog, ix):
+               ref_ext, seg_file, verbose, catalog, ix, shared_dir=None,
+               lazy_load=False):
     """Helper function for loading `.model.GrismFLT` objects with `multiprocessing`.
     
-    TBD
+    If `shared_dir` is specified, the large image arrays are written to 
+    memory-mapped files in that directory with `_save_shared_arrays` and the 
+    function returns a tuple of the stripped `~grizli.model.GrismFLT` object
+    and the dictionary of array filenames.
+    
+    If `lazy_load` is set and a saved "GrismFLT.fits" file is found, load 
+    it with `~grizli.model.GrismFLT.load_from_fits(lazy=True)`.
     """
     import time
     try:
@@ -174,7 +185,7 @@ def _loadFLT(grism_file, sci_extn, direct_file, pad, ref_file,
         flt = pickle.load(fp)
         fp.close()
         
-        status = flt.load_from_fits(save_file)
+        status = flt.load_from_fits(save_file, lazy=lazy_load)
                 
     else:    
         flt = model.GrismFLT(grism_file=grism_file, sci_extn=sci_extn,
@@ -197,6 +208,10 @@ def _loadFLT(grism_file, sci_extn, direct_file, pad, ref_file,
 
     if flt.grism.instrument in ['NIRISS', 'NIRCAM']:
         flt.transform_NIRISS()
+    
+    if shared_dir is not None:
+        shared_files = _save_shared_arrays(flt, shared_dir, ix)
+        return flt, shared_files
         
     return flt #, out_cat
     
@@ -242,9 +257,22 @@ def test_parallel():
     t1_pool = time.time()
     
     
-def _compute_model(i, flt, fit_info, is_cgs, store):
+def _compute_model(i, flt, fit_info, is_cgs, store, shared_files=None):
     """Helper function for computing model orders.
+    
+    If `shared_files` is specified, `flt` is a stripped copy (see 
+    `_strip_flt_arrays`) and the image arrays are attached from the 
+    memory-mapped files.  The model is then written directly into the shared
+    "model" file and isn't returned.  Only the `object_dispersers` entries 
+    computed here are returned, with `None` for entries that just store the 
+    `fit_info` spectrum, which the parent rebuilds.  The entries with 
+    stored beams (`store=True`) still include the dispersers and their model
+    arrays, so those are still sent through the pipe.
     """
+    if shared_files is not None:
+        _load_shared_arrays(flt, shared_files, mmap_mode='r')
+        flt.model = np.load(shared_files['model'], mmap_mode='r+')
+        
     for id in fit_info:
         try:
             status = flt.compute_model_orders(id=id, compute_size=True,
@@ -256,8 +284,127 @@ def _compute_model(i, flt, fit_info, is_cgs, store):
             continue
             
     print('{0}: _compute_model Done'.format(flt.grism.parent_file))
+    
+    if shared_files is not None:
+        flt.model.flush()
+        
+        # Entries updated here, without the spectra sent by the parent
+        dispersers = OrderedDict()
+        for id in fit_info:
+            if id not in flt.object_dispersers:
+                continue
+            
+            entry = flt.object_dispersers[id]
+            if entry[1] is not fit_info[id]['spec']:
+                continue
+                
+            if entry[2] is None:
+                dispersers[id] = None
+            else:
+                dispersers[id] = entry
+                
+        return i, None, dispersers
         
     return i, flt.model, flt.object_dispersers
+
+# Finalizers that remove the temporary shared directories
+_SHARED_DIR_FINALIZERS = {}
+
+def _remove_shared_dir(shared_dir, pid):
+    """Remove a temporary `shared_dir` made by process `pid`
+    
+    Forked workers inherit the finalizers of the parent, so only the 
+    process that made the directory removes it.
+    """
+    import shutil
+    
+    if os.getpid() == pid:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+def _save_shared_arrays(flt, shared_dir, ix):
+    """Move the large `~grizli.model.GrismFLT` arrays to memory-mapped files
+    
+    Parameters
+    ----------
+    flt : `~grizli.model.GrismFLT`
+        Exposure object.  The `direct.data`, `grism.data`, `seg` and `model` 
+        arrays are written to `.npy` files and replaced with `None`.
+    
+    shared_dir : str
+        Directory where to write the files.
+    
+    ix : int
+        Index of the exposure in the group, used for the filenames.
+        
+    Returns
+    -------
+    shared_files : dict
+        Filenames of the saved arrays, with keys like "direct:SCI", 
+        "grism:ERR", "seg" and "model".
+    """
+    shared_files = OrderedDict()
+    
+    arrays = []
+    for attr in ['direct', 'grism']:
+        data = getattr(flt, attr).data
+        for key in data:
+            if data[key] is not None:
+                arrays.append(('{0}:{1}'.format(attr, key), data[key]))
+                data[key] = None
+    
+    arrays.append(('seg', flt.seg))
+    arrays.append(('model', flt.model))
+    flt.seg = flt.model = None
+    
+    for key, arr in arrays:
+        file = os.path.join(shared_dir, 
+                            '{0:03d}.{1}.npy'.format(ix, key.replace(':','.')))
+        np.save(file, np.ascontiguousarray(arr))
+        shared_files[key] = file
+        
+    return shared_files
+
+def _load_shared_arrays(flt, shared_files, mmap_mode='r+'):
+    """Attach memory-mapped arrays saved with `_save_shared_arrays`
+    """
+    for key in shared_files:
+        arr = np.load(shared_files[key], mmap_mode=mmap_mode)
+        if ':' in key:
+            attr, ext = key.split(':')
+            getattr(flt, attr).data[ext] = arr
+        else:
+            setattr(flt, key, arr)
+
+def _strip_flt_arrays(flt):
+    """Shallow copy of a `~grizli.model.GrismFLT` without the image arrays
+    
+    The copy is cheap to pickle to `multiprocessing` workers, which 
+    re-attach the arrays with `_load_shared_arrays`.
+    """
+    import copy
+    
+    light = copy.copy(flt)
+    for attr in ['direct', 'grism']:
+        im = copy.copy(getattr(flt, attr))
+        im.data = OrderedDict([(key, None) for key in im.data])
+        setattr(light, attr, im)
+    
+    light.seg = light.model = None
+    light.seg_index = None
+    return light
+    
+def get_save_file(grism_file, sci_extn=1):
+    """Filename of the "GrismFLT.fits" file saved for an exposure
+    
+    See `GroupFLT.save_full_data`.
+    """
+    new_root = '.{0:02d}.GrismFLT.fits'.format(sci_extn)
+    
+    save_file = grism_file.replace('_flt.fits', new_root)
+    save_file = save_file.replace('_flc.fits', new_root)
+    save_file = save_file.replace('_cmb.fits', new_root)
+    save_file = save_file.replace('_rate.fits', new_root)
+    return save_file
     
 class GroupFLT():
     def __init__(self, grism_files=[], sci_extn=1, direct_files=[],
@@ -265,7 +412,7 @@ class GroupFLT():
                  ref_file=None, ref_ext=0, seg_file=None,
                  shrink_segimage=True, verbose=True, cpu_count=0,
                  catalog='', polyx=[0.3, 2.35],
-                 MW_EBV=0.):
+                 MW_EBV=0., shared_store=False, lazy_load=False):
         """Main container for handling multiple grism exposures together
         
         Parameters
@@ -323,6 +470,20 @@ class GroupFLT():
             Catalog filename assocated with `seg_file`.  These are typically
             generated with "SExtractor", but the source of the files 
             themselves isn't critical.
+        
+        shared_store : bool or str
+            Keep the large image arrays of the `FLTs` in memory-mapped files
+            that the `multiprocessing` workers read and write directly, 
+            rather than pickling full `~grizli.model.GrismFLT` objects 
+            between processes.  If a string, use it as the directory for the
+            files, otherwise make a temporary directory.  See 
+            `init_shared_store`.
+        
+        lazy_load : bool
+            Memory-map previously saved "GrismFLT.fits" files and only read
+            the arrays when they're needed, see 
+            `~grizli.model.GrismFLT.load_from_fits`.  Cutouts extracted 
+            with `get_beams` are read directly from the files.
             
         Attributes
         ----------
@@ -371,12 +532,22 @@ class GroupFLT():
         if cpu_count == 0:
             cpu_count = mp.cpu_count()
         
+        self.shared_dir = None
+        self.shared_files = None
+        
+        if shared_store and (cpu_count > 0):
+            self._make_shared_dir(shared_store)
+            self.shared_files = []
+            shared_dir = self.shared_dir
+        else:
+            shared_dir = None
+            
         if cpu_count < 0:
             ### serial
             self.FLTs = []
             t0_pool = time.time()
             for i in range(self.N):
-                flt = _loadFLT(self.grism_files[i], sci_extn, self.direct_files[i], pad, ref_file, ref_ext, seg_file, verbose, self.catalog, i)
+                flt = _loadFLT(self.grism_files[i], sci_extn, self.direct_files[i], pad, ref_file, ref_ext, seg_file, verbose, self.catalog, i, lazy_load=lazy_load)
                 self.FLTs.append(flt)
                 
             t1_pool = time.time()
@@ -386,13 +557,19 @@ class GroupFLT():
             t0_pool = time.time()
         
             pool = mp.Pool(processes=cpu_count)
-            results = [pool.apply_async(_loadFLT, (self.grism_files[i], sci_extn, self.direct_files[i], pad, ref_file, ref_ext, seg_file, verbose, self.catalog, i)) for i in range(self.N)]
+            results = [pool.apply_async(_loadFLT, (self.grism_files[i], sci_extn, self.direct_files[i], pad, ref_file, ref_ext, seg_file, verbose, self.catalog, i, shared_dir, lazy_load)) for i in range(self.N)]
         
             pool.close()
             pool.join()
     
             for res in results:
-                flt_i = res.get(timeout=1)
+                if shared_dir is not None:
+                    flt_i, files_i = res.get(timeout=1)
+                    _load_shared_arrays(flt_i, files_i, mmap_mode='r+')
+                    self.shared_files.append(files_i)
+                else:
+                    flt_i = res.get(timeout=1)
+                    
                 #flt_i.catalog = cat_i
                 
                 # somehow WCS getting flipped from cd to pc in res.get()???
@@ -405,6 +582,9 @@ class GroupFLT():
                 
             t1_pool = time.time()
         
+        if shared_store and (self.shared_files is None):
+            self.init_shared_store(shared_store)
+            
         # Parse grisms & PAs
         self.Ngrism = {}
         for i in range(self.N):
@@ -439,6 +619,93 @@ class GroupFLT():
         if verbose:
             print('Files loaded - {0:.2f} sec.'.format(t1_pool - t0_pool))
     
+    def _make_shared_dir(self, path=True):
+        """Set `shared_dir` attribute, making a temporary directory if 
+        `path` isn't a string.
+        
+        The temporary directory is removed with `close_shared_store`, or 
+        otherwise when the object is garbage collected or the interpreter 
+        exits.
+        """
+        import tempfile
+        import weakref
+        
+        if isinstance(path, str):
+            if not os.path.exists(path):
+                os.makedirs(path)
+                
+            self.shared_dir = path
+        else:
+            self.shared_dir = tempfile.mkdtemp(prefix='grizli_shared_')
+            finalizer = weakref.finalize(self, _remove_shared_dir, 
+                                         self.shared_dir, os.getpid())
+            _SHARED_DIR_FINALIZERS[self.shared_dir] = finalizer
+            
+    def init_shared_store(self, path=True):
+        """Move the `FLTs` image arrays to memory-mapped files
+        
+        The `direct.data`, `grism.data`, `seg` and `model` arrays of each 
+        exposure are written to `.npy` files in `shared_dir` and replaced 
+        with writeable `~numpy.memmap` views of those files.  Parallel 
+        workers, e.g., in `compute_full_model`, then attach the same files
+        and write models into them directly, so only the object metadata is
+        sent through the `multiprocessing` pipes.
+        
+        Parameters
+        ----------
+        path : bool or str
+            Directory for the shared files.  If not a string, make a new 
+            temporary directory that is removed along with the object.
+            
+        """
+        if self.shared_files is not None:
+            return True
+            
+        self._make_shared_dir(path)
+        self.shared_files = []
+        for i in range(self.N):
+            files_i = _save_shared_arrays(self.FLTs[i], self.shared_dir, i)
+            _load_shared_arrays(self.FLTs[i], files_i, mmap_mode='r+')
+            self.shared_files.append(files_i)
+        
+        return True
+        
+    def close_shared_store(self, remove=True):
+        """Read the memory-mapped arrays back into memory
+        
+        Parameters
+        ----------
+        remove : bool
+            Remove the shared files and the `shared_dir` directory.  If 
+            False, a temporary `shared_dir` is also kept after the object 
+            is deleted.
+        
+        """
+        import shutil
+        
+        if self.shared_files is None:
+            return True
+        
+        finalizer = _SHARED_DIR_FINALIZERS.pop(self.shared_dir, None)
+        if finalizer is not None:
+            finalizer.detach()
+        
+        for flt in self.FLTs:
+            for attr in ['direct', 'grism']:
+                data = getattr(flt, attr).data
+                for key in data:
+                    if data[key] is not None:
+                        data[key] = np.array(data[key])
+            
+            flt.seg = np.array(flt.seg)
+            flt.model = np.array(flt.model)
+        
+        if remove:
+            shutil.rmtree(self.shared_dir, ignore_errors=True)
+            
+        self.shared_files = self.shared_dir = None
+        return True
+        
     def save_full_data(self, warn=True):
         """Save models and data files for fast regeneration.
         
@@ -479,12 +746,7 @@ class GroupFLT():
                     print('{0}: Looks like data already saved!'.format(file))
                     continue
             
-            new_root = '.{0:02d}.GrismFLT.fits'.format(self.FLTs[i].grism.sci_extn)
-            
-            save_file = file.replace('_flt.fits', new_root)
-            save_file = save_file.replace('_flc.fits', new_root)
-            save_file = save_file.replace('_cmb.fits', new_root)
-            save_file = save_file.replace('_rate.fits', new_root)
+            save_file = get_save_file(file, self.FLTs[i].grism.sci_extn)
             print('Save {0}'.format(save_file))
             self.FLTs[i].save_full_pickle()
             
@@ -517,7 +779,108 @@ class GroupFLT():
         if verbose:
             print('Now we have {0:d} FLTs'.format(self.N))
             
-    def compute_single_model(self, id, center_rd=None, mag=-99, size=-1, store=False, spectrum_1d=None, is_cgs=False, get_beams=None, in_place=True, psf_param_dict={}):
+    @property 
+    def footprint_index(self):
+        """`~grizli.utils.FootprintIndex` of the padded exposure footprints
+        
+        Computed on first use and reset if exposures are added.
+        """
+        index = getattr(self, '_footprint_index', None)
+        if (index is None) or (index.N != self.N):
+            self._footprint_index = utils.FootprintIndex.from_flts(self.FLTs)
+        
+        return self._footprint_index
+    
+    def get_object_rd(self, ids):
+        """Catalog coordinates of objects
+        
+        Parameters
+        ----------
+        ids : int or list
+            Object IDs.
+        
+        Returns
+        -------
+        ra, dec : array or None
+            Coordinates, NaN for IDs not in the catalog.  None if no 
+            catalog is available.
+        
+        The mapping of IDs to catalog rows is computed once and stored in 
+        `_catalog_rows`.  It is recomputed if `catalog` is replaced or 
+        changes length, but not if the `NUMBER` column is edited in place.
+        """
+        if self.catalog is None:
+            return None
+        
+        cols = self.catalog.colnames
+        if 'X_WORLD' in cols:
+            rd_cols = ['X_WORLD', 'Y_WORLD']
+        elif 'ra' in cols:
+            rd_cols = ['ra', 'dec']
+        else:
+            return None
+        
+        # Catalog rows of the IDs, recomputed if the catalog is replaced
+        # or resized
+        rows = getattr(self, '_catalog_rows', None)
+        if ((rows is None) or (rows[0] is not self.catalog) or 
+            (rows[1] != len(self.catalog))):
+            idx = {id_i:i for i, id_i in enumerate(self.catalog['NUMBER'])}
+            rows = self._catalog_rows = (self.catalog, len(self.catalog), 
+                                         idx)
+        
+        idx = rows[2]
+        ids = np.atleast_1d(ids)
+        ix = np.array([idx.get(id_i, -1) for id_i in ids], dtype=int)
+        ok = ix >= 0
+        
+        ra = np.zeros(len(ids)) + np.nan
+        dec = np.zeros(len(ids)) + np.nan
+        ra[ok] = np.asarray(self.catalog[rd_cols[0]])[ix[ok]]
+        dec[ok] = np.asarray(self.catalog[rd_cols[1]])[ix[ok]]
+        
+        return ra, dec
+        
+    def get_exposure_indices(self, ids=None, center_rd=None):
+        """Exposures that can contain the spectra of a batch of objects
+        
+        Parameters
+        ----------
+        ids : list
+            Object IDs in `catalog`.
+        
+        center_rd : (ra, dec) arrays
+            Coordinates, rather than `ids`.
+            
+        Returns
+        -------
+        indices : list
+            Indices of the `FLTs` whose padded footprints contain each 
+            object, found with a single `footprint_index` query.  All 
+            exposures for objects without coordinates.
+            
+        """
+        if center_rd is None:
+            rd = self.get_object_rd(ids)
+            nobj = len(np.atleast_1d(ids))
+            if rd is None:
+                return [np.arange(self.N)]*nobj
+        else:
+            rd = center_rd
+        
+        ra, dec = np.atleast_1d(rd[0]), np.atleast_1d(rd[1])
+        contains = self.footprint_index.query(ra, dec)
+        
+        indices = []
+        for i in range(len(ra)):
+            if np.isfinite(ra[i]) & np.isfinite(dec[i]):
+                indices.append(np.where(contains[i,:])[0])
+            else:
+                indices.append(np.arange(self.N))
+        
+        return indices
+        
+    def compute_single_model(self, id, center_rd=None, mag=-99, size=-1, store=False, spectrum_1d=None, is_cgs=False, get_beams=None, in_place=True, psf_param_dict={}, num_threads=None, footprints=None, flt_indices=None):
         """Compute model spectrum in all exposures
         TBD
         
@@ -539,14 +902,37 @@ class GroupFLT():
         
         in_place : type
         
+        num_threads : int or None
+            If not None and `in_place`, compute the beams of all exposures 
+            together with the multi-threaded `~grizli.model.disperse_beams`.
+            The other options, e.g., `center_rd`, `psf_param_dict` and 
+            `flt_indices`, are applied as for the serial calculation.
         
+        footprints : list or None
+            If a list is provided and `in_place`, append ``(i, sly, slx)`` 
+            tuples of the exposure index and the parent-array slices of the 
+            beams added to the exposure models.
+        
+        flt_indices : list or None
+            Only compute the model in these exposures, e.g., from 
+            `get_exposure_indices`.  The output list of `get_beams` has one
+            entry for each of them.
+            
         Returns
         -------
         TBD
                
         """
+        # Compute the beams of all exposures together in threads
+        threaded = (num_threads is not None) & in_place & (not get_beams)
+        batches = []
+        
+        if flt_indices is None:
+            flt_indices = range(self.N)
+            
         out_beams = []
-        for flt in self.FLTs:                
+        for i in flt_indices:
+            flt = self.FLTs[i]
             if flt.grism.parent_file in psf_param_dict:
                 psf_params = psf_param_dict[flt.grism.parent_file]
             else:
@@ -556,15 +942,43 @@ class GroupFLT():
                 x = y = None
             else:
                 x, y = flt.direct.wcs.all_world2pix(np.array(center_rd)[None,:], 0).flatten()
+            
+            if footprints is not None:
+                flt_footprints = []
+            else:
+                flt_footprints = None
+            
+            if threaded:
+                batch = []
+                batches.append((flt, batch))
+            else:
+                batch = None
                 
             status = flt.compute_model_orders(id=id, x=x, y=y, verbose=False,
                           size=size, compute_size=(size < 0),
                           mag=mag, in_place=in_place, store=store,
                           spectrum_1d=spectrum_1d, is_cgs=is_cgs,
-                          get_beams=get_beams, psf_params=psf_params)
+                          get_beams=get_beams, psf_params=psf_params, 
+                          batch=batch, footprints=flt_footprints)
             
+            if flt_footprints:
+                footprints.extend([(i, sly, slx) 
+                                   for sly, slx in flt_footprints])
+                
             out_beams.append(status)
         
+        if threaded:
+            batch = [b for flt, flt_batch in batches for b in flt_batch]
+            if len(batch) > 0:
+                model.disperse_beams([b[0] for b in batch], 
+                                     spectra=[b[1] for b in batch],
+                                     is_cgs=[b[2] for b in batch], 
+                                     num_threads=num_threads)
+            
+            for flt, flt_batch in batches:
+                for b in flt_batch:
+                    b[0].add_to_full_image(b[0].model, flt.model)
+            
         if get_beams:
             return out_beams
         else:
@@ -572,9 +986,22 @@ class GroupFLT():
             
     def compute_full_model(self, fit_info=None, verbose=True, store=False, 
                            mag_limit=25, coeffs=[1.2, -0.5], cpu_count=0,
-                           is_cgs=False):
+                           is_cgs=False, shared_store=None):
         """TBD
+        
+        If `shared_store` is True, or is None and the group was initialized 
+        with a shared store (see `init_shared_store`), then the workers 
+        write the models directly into the memory-mapped `model` arrays and
+        only return the IDs of the updated `object_dispersers` entries.  With
+        `store=True` the computed dispersers themselves are still returned 
+        through the `multiprocessing` pipes.
         """
+        if shared_store is None:
+            shared_store = getattr(self, 'shared_files', None) is not None
+        
+        if shared_store:
+            self.init_shared_store(shared_store)
+            
         if cpu_count <= 0:
             cpu_count = mp.cpu_count()
         
@@ -600,15 +1027,29 @@ class GroupFLT():
         t0_pool = time.time()
         
         pool = mp.Pool(processes=cpu_count)
-        results = [pool.apply_async(_compute_model, (i, self.FLTs[i], fit_info, is_cgs, store)) for i in range(self.N)]
+        if shared_store:
+            for flt in self.FLTs:
+                flt.model.flush()
+                
+            results = [pool.apply_async(_compute_model, (i, _strip_flt_arrays(self.FLTs[i]), fit_info, is_cgs, store, self.shared_files[i])) for i in range(self.N)]
+        else:
+            results = [pool.apply_async(_compute_model, (i, self.FLTs[i], fit_info, is_cgs, store)) for i in range(self.N)]
 
         pool.close()
         pool.join()
                 
         for res in results:
             i, model, dispersers = res.get(timeout=1)
-            self.FLTs[i].object_dispersers = dispersers
-            self.FLTs[i].model = model
+            if model is not None:
+                self.FLTs[i].object_dispersers = dispersers
+                self.FLTs[i].model = model
+            else:
+                # Only the updated entries from the shared-store workers
+                for id in dispersers:
+                    if dispersers[id] is None:
+                        dispersers[id] = (is_cgs, fit_info[id]['spec'], None)
+                    
+                    self.FLTs[i].object_dispersers[id] = dispersers[id]
             
         t1_pool = time.time()
         if verbose:
@@ -616,7 +1057,8 @@ class GroupFLT():
         
     def get_beams(self, id, size=10, center_rd=None, beam_id='A',
                   min_overlap=0.1, min_valid_pix=10, min_mask=0.01, 
-                  min_sens=0.08, mask_resid=True, get_slice_header=True):
+                  min_sens=0.08, mask_resid=True, get_slice_header=True,
+                  flt_indices=None, use_index=True):
         """Extract 2D spectra "beams" from the GroupFLT exposures.
         
         Parameters
@@ -652,6 +1094,14 @@ class GroupFLT():
             
         get_slice_header : bool
             Passed to `~grizli.model.BeamCutout`.
+        
+        flt_indices : list or None
+            Indices of the exposures to extract from, e.g., computed for a 
+            batch of objects with `get_exposure_indices`.
+        
+        use_index : bool
+            If `flt_indices` not provided, skip exposures whose padded 
+            footprints in `footprint_index` don't contain the object.
             
         Returns
         -------
@@ -659,10 +1109,19 @@ class GroupFLT():
             List of `~grizli.model.BeamCutout` objects.
         
         """
-        beams = self.compute_single_model(id, center_rd=center_rd, size=size, store=False, get_beams=[beam_id])
+        if (flt_indices is None) & use_index:
+            if center_rd is None:
+                flt_indices = self.get_exposure_indices(ids=[id])[0]
+            else:
+                flt_indices = self.get_exposure_indices(center_rd=([center_rd[0]], [center_rd[1]]))[0]
+        elif flt_indices is None:
+            flt_indices = np.arange(self.N)
+            
+        beams = self.compute_single_model(id, center_rd=center_rd, size=size, store=False, get_beams=[beam_id], flt_indices=flt_indices)
         
         out_beams = []
-        for flt, beam in zip(self.FLTs, beams):
+        for i, beam in zip(flt_indices, beams):
+            flt = self.FLTs[i]
             try:
                 out_beam = model.BeamCutout(flt=flt, beam=beam[beam_id],
                                         conf=flt.conf, min_mask=min_mask,
@@ -692,7 +1151,8 @@ class GroupFLT():
     
     def refine_list(self, ids=[], mags=[], poly_order=3, mag_limits=[16,24], 
                     max_coeff=5, ds9=None, verbose=True, fcontam=0.5,
-                    wave=np.linspace(0.2, 2.5e4, 100)):
+                    wave=np.linspace(0.2, 2.5e4, 100), refine_tol=None, 
+                    num_threads=None):
         """Refine contamination model for list of objects.  Loops over `refine`.
         
         Parameters
@@ -727,11 +1187,28 @@ class GroupFLT():
         wave : `~numpy.array`
             Wavelength array for the polynomial fit.  
         
+        refine_tol : float or None
+            If specified, refine the model incrementally over repeated calls 
+            (see `refine_needed`).  Objects are only refit if they weren't 
+            converged on the previous call or if the contamination model 
+            changed within their spectra since they were last fit.  The 
+            full-field models are only updated for objects whose new 
+            polynomial spectrum differs by more than `refine_tol` (relative
+            to the maximum of the previous spectrum) from the one currently
+            in the model.
+        
+        num_threads : int or None
+            Compute the model updates for all exposures at once with the 
+            multi-threaded `~grizli.model.disperse_beams`, see 
+            `compute_single_model`.
+            
         Returns
         -------
         Updates `self.model` in place.
         
         """
+        t0 = time.time()
+        
         if (len(ids) == 0) | (len(ids) != len(mags)):
             bright = ((self.catalog['MAG_AUTO'] < mag_limits[1]) &
                       (self.catalog['MAG_AUTO'] > mag_limits[0]))
@@ -745,13 +1222,108 @@ class GroupFLT():
         #wave = np.linspace(0.2,5.4e4,100)
         poly_templates = utils.polynomial_templates(wave, order=poly_order, line=False)
             
+        if refine_tol is not None:
+            self.init_refine_state(reset=False)
+            step0 = self.refine_step
+            
+            # Refit everything if the fit parameters changed
+            params = (poly_order, max_coeff, fcontam)
+            if params != self.refine_params:
+                for id in self.refine_state:
+                    self.refine_state[id]['converged'] = False
+                
+                self.refine_params = params
+            
+        nfit = 0
         for id, mag in zip(ids, mags):
+            if refine_tol is not None:
+                if not self.refine_needed(id):
+                    continue
+                    
             self.refine(id, mag=mag, poly_order=poly_order,
                         max_coeff=max_coeff, size=30, ds9=ds9,
                         verbose=verbose, fcontam=fcontam, 
-                        templates=poly_templates)
+                        templates=poly_templates, refine_tol=refine_tol,
+                        num_threads=num_threads)
+            nfit += 1
+        
+        if verbose:
+            msg = 'refine_list: {0} objects, {1} fit'.format(len(ids), nfit)
+            if refine_tol is not None:
+                msg += ', {0} updated'.format(self.refine_step - step0)
+            
+            print(msg + ' - {0:.1f} s'.format(time.time() - t0))
+    
+    def init_refine_state(self, reset=True):
+        """Initialize bookkeeping for incremental `refine_list` iterations
+        
+        Attributes
+        ----------
+        refine_state : dict
+            Keyed by object id, with the step counter when the object was 
+            last fit, the footprints of its spectra in the exposures, the 
+            last polynomial spectrum put in the model and whether that 
+            spectrum converged.
+        
+        refine_step : int
+            Counter incremented for every object model update.
+            
+        refine_counter : list
+            Arrays for each exposure with the `refine_step` of the last 
+            model update in blocks of `REFINE_BLOCK` pixels.
+            
+        """
+        if (not reset) & hasattr(self, 'refine_state'):
+            return True
+        
+        self.refine_state = {}
+        self.refine_step = 0
+        self.refine_params = None
+        self.refine_counter = []
+        for flt in self.FLTs:
+            sh = np.array(flt.grism.sh) // REFINE_BLOCK + 1
+            self.refine_counter.append(np.zeros(sh, dtype=np.int64))
+        
+        return True
+        
+    def _refine_blocks(self, sly, slx, i):
+        """Slices of `refine_counter` arrays corresponding to parent-array 
+        slices
+        """
+        sh = self.FLTs[i].grism.sh
+        y0, y1 = np.maximum(sly.start, 0), np.minimum(sly.stop, sh[0])
+        x0, x1 = np.maximum(slx.start, 0), np.minimum(slx.stop, sh[1])
+        if (y1 <= y0) | (x1 <= x0):
+            return None
+            
+        return (slice(y0 // REFINE_BLOCK, (y1-1) // REFINE_BLOCK + 1),
+                slice(x0 // REFINE_BLOCK, (x1-1) // REFINE_BLOCK + 1))
+                
+    def refine_needed(self, id):
+        """Does an object need to be refit in the incremental `refine_list`?
+        
+        True if the object hasn't been fit yet, if its spectrum hadn't 
+        converged the last time it was fit, or if any other object model 
+        was updated within its footprints since then.
+        """
+        if id not in self.refine_state:
+            return True
+        
+        state = self.refine_state[id]
+        if not state['converged']:
+            return True
+            
+        for i, sly, slx in state['footprints']:
+            blocks = self._refine_blocks(sly, slx, i)
+            if blocks is None:
+                continue
+                
+            if self.refine_counter[i][blocks].max() > state['step']:
+                return True
+        
+        return False
     
-    def refine(self, id, mag=-99, poly_order=3, size=30, ds9=None, verbose=True, max_coeff=2.5, fcontam=0.5, templates=None):
+    def refine(self, id, mag=-99, poly_order=3, size=30, ds9=None, verbose=True, max_coeff=2.5, fcontam=0.5, templates=None, refine_tol=None, num_threads=None):
         """Fit polynomial to extracted spectrum of single object to use for contamination model.
         
         Parameters
@@ -788,6 +1360,9 @@ class GroupFLT():
             Precomputed template dictionary.  If `None` then compute 
             polynomial templates with order `poly_order`.
         
+        refine_tol, num_threads : 
+            See `refine_list`.
+            
         Returns
         -------
         Updates `self.model` in place.
@@ -796,6 +1371,32 @@ class GroupFLT():
         beams = self.get_beams(id, size=size, min_overlap=0.1,
                                get_slice_header=False, min_mask=0.01, 
                                min_sens=0.01, mask_resid=True)
+        
+        if refine_tol is not None:
+            self.init_refine_state(reset=False)
+            
+            # Footprints of the extracted spectra in the exposures
+            flt_index = {}
+            for i, flt in enumerate(self.FLTs):
+                flt_index[flt.grism.parent_file, flt.grism.sci_extn] = i
+            
+            fit_footprints = []
+            for beam in beams:
+                i = flt_index[beam.grism.parent_file, beam.grism.sci_extn]
+                fit_footprints.append((i, beam.beam.sly_parent, 
+                                       beam.beam.slx_parent))
+            
+            if id in self.refine_state:
+                last_spectrum = self.refine_state[id]['spectrum']
+            else:
+                last_spectrum = None
+                
+            # Updated below if the model is changed
+            self.refine_state[id] = {'step':self.refine_step, 
+                                     'footprints':fit_footprints,
+                                     'spectrum':last_spectrum,
+                                     'converged':True}
+            
         if len(beams) == 0:
             return True
         
@@ -835,9 +1436,34 @@ class GroupFLT():
 
             return True
         
+        if refine_tol is not None:
+            # Skip the update if the spectrum hasn't changed
+            state = self.refine_state[id]
+            if state['spectrum'] is not None:
+                xlast, ylast = state['spectrum']
+                if (len(xlast) == len(xspec)) & (len(ylast) == len(ypoly)):
+                    dy = np.abs(ypoly - ylast).max()
+                    if dy <= refine_tol*np.abs(ylast).max():
+                        return True
+            
+            footprints = []
+        else:
+            footprints = None
+            
         # Put the refined model into the full-field model    
-        self.compute_single_model(id, mag=mag, size=-1, store=False, spectrum_1d=[xspec, ypoly], is_cgs=True, get_beams=None, in_place=True)
-        
+        self.compute_single_model(id, mag=mag, size=-1, store=False, spectrum_1d=[xspec, ypoly], is_cgs=True, get_beams=None, in_place=True, num_threads=num_threads, footprints=footprints)
+        
+        if refine_tol is not None:
+            self.refine_step += 1
+            for i, sly, slx in footprints:
+                blocks = self._refine_blocks(sly, slx, i)
+                if blocks is not None:
+                    self.refine_counter[i][blocks] = self.refine_step
+                
+            state['step'] = self.refine_step
+            state['spectrum'] = (xspec*1, ypoly*1)
+            state['converged'] = False
+            
         # Display the result?
         if ds9:
             flt = self.FLTs[0]
@@ -2035,15 +2661,10 @@ class MultiBeam(GroupFitter):
             spectrum_1d = [temp.wave*(1+z), temp.flux/(1+z)]
             
             if z > 4:
-                try:
-                    import eazy.igm
-                    igm = eazy.igm.Inoue14()
+                igm = utils.get_igm_table()
+                if igm is not None:
                     igmz = igm.full_IGM(z, spectrum_1d[0])
                     spectrum_1d[1]*=igmz    
-                    #print('IGM')            
-                except:
-                    # No IGM
-                    pass
                   
             i0 = 0            
             for ib in range(self.N):
@@ -3503,8 +4124,50 @@ class MultiBeam(GroupFitter):
                 
     def fit_trace_shift(self, split_groups=True, max_shift=5, tol=1.e-2, 
                         verbose=True, lm=False, fit_with_psf=False,
-                        reset=False):
-        """TBD
+                        reset=False, linearized=False, max_iter=5):
+        """Fit for offsets of the spectral traces in the cross-dispersion axis
+        
+        Parameters
+        ----------
+        split_groups : bool
+            Fit a single shift for all beams of a given grism / PA, 
+            otherwise fit one shift per beam.
+        
+        max_shift : float
+            Maximum allowed shift, pixels.
+        
+        tol : float
+            Tolerance of the optimizer.  With `linearized` the iterations 
+            stop when no shift changes by more than `tol` pixels.
+        
+        lm : bool
+            Use `~scipy.optimize.leastsq` rather than Powell minimization.
+        
+        reset : bool
+            Reset the shifts to zero.
+            
+        linearized : bool
+            Solve for the shifts with Gauss-Newton iterations of a model 
+            linearized in the shifts (see `_linear_trace_shift`), which 
+            requires three dispersions per beam per iteration rather than 
+            one per beam for every optimizer step.  Note that the objective
+            differs from that of `eval_trace_shift`, which scales the model 
+            with an unweighted least-squares fit of all pixels: here the 
+            normalization is fit with the inverse-variance weights of the 
+            `fit_mask` pixels, so the shifts can differ slightly between 
+            the two modes for noisy data.
+        
+        max_iter : int
+            Maximum number of `linearized` iterations.
+        
+        Returns
+        -------
+        shifts : array
+            Shifts for each group of beams.
+        
+        out : object
+            Output of the optimizer, or a dict with the `linearized` 
+            iterations.
         """
         from scipy.optimize import leastsq, minimize
         
@@ -3523,6 +4186,11 @@ class MultiBeam(GroupFitter):
         if reset:
             shifts = np.zeros(len(indices))
             out = None
+        elif linearized:
+            shifts, out = self._linear_trace_shift(indices, 
+                                                   max_shift=max_shift,
+                                                   tol=tol, max_iter=max_iter,
+                                                   verbose=verbose)
         elif lm:
             out = leastsq(self.eval_trace_shift, s0, args=args, Dfun=None, full_output=0, col_deriv=0, ftol=1.49012e-08, xtol=1.49012e-08, gtol=0.0, maxfev=0, epsfcn=None, factor=100, diag=None)
             shifts = out[0]
@@ -3553,6 +4221,113 @@ class MultiBeam(GroupFitter):
            
         return shifts, out
         
+    def _linear_trace_shift(self, indices, max_shift=5, tol=1.e-2, 
+                            max_iter=5, step=0.5, verbose=True):
+        """Gauss-Newton fit of the trace offsets
+        
+        For shifts ``s`` near a reference ``s0``, the flat-spectrum model of 
+        the beams in group ``g`` is approximated as 
+        ``m(s) = m(s0) + (s-s0)*dm/ds``, with the derivative taken from 
+        central differences of dispersions at ``s0 +/- step``.  With the 
+        normalization ``a`` of `eval_trace_shift`, the model 
+        ``a*m(s0) + sum_g a*(s_g-s0_g)*dm_g/ds`` is linear in ``a`` and the 
+        products ``a*(s_g-s0_g)``, so each iteration is a single weighted 
+        least-squares solve.  The model is re-dispersed at the updated 
+        shifts for the next iteration, which also gives the exact chi-squared
+        used to accept or backtrack the step.
+        
+        Parameters
+        ----------
+        indices : list of lists
+            Indices of `beams` in each group with a common shift.
+        
+        max_shift, tol, max_iter : 
+            See `fit_trace_shift`.
+            
+        step : float
+            Offset in pixels for the numerical derivatives.
+            
+        Returns
+        -------
+        shifts : array
+            Best-fit shifts.
+        
+        out : dict
+            Number of iterations ``nit``, ``chi2`` (per degree of freedom) at
+            each iteration and the ``shifts`` evaluated.
+        """
+        ng = len(indices)
+        group = np.zeros(self.N, dtype=int) - 1
+        for il, l in enumerate(indices):
+            group[l] = il
+        
+        mask = self.fit_mask
+        y = self.scif[mask]
+        w = self.sivarf[mask]
+        
+        npix = [beam.beam.modelf.size for beam in self.beams]
+        beam_group = np.repeat(group, npix)[mask]
+        
+        def flat_model(beam, s):
+            beam.beam.add_ytrace_offset(s)
+            return beam.beam.compute_model(in_place=False)*1
+            
+        shifts = np.zeros(ng)
+        best_shifts, best_chi2 = shifts*1, np.inf
+        hist = {'chi2':[], 'shifts':[]}
+        
+        converged = False
+        for it in range(max_iter+1):
+            sg = shifts[group]*(group >= 0)
+            m0 = np.hstack([flat_model(beam, sg[i]) 
+                            for i, beam in enumerate(self.beams)])[mask]
+                            
+            a = np.sum(w**2*m0*y)/np.sum((w*m0)**2)
+            chi2 = np.sum(((y-a*m0)*w)**2)/self.DoF
+            
+            hist['chi2'].append(chi2)
+            hist['shifts'].append(shifts*1)
+            if verbose:
+                print('{0} [{1}] {2:6.2f}'.format(utils.NO_NEWLINE, ' '.join(['{0:5.2f}'.format(s) for s in shifts]), chi2))
+            
+            if chi2 > best_chi2:
+                # Linearization overshot, backtrack halfway
+                dshift = (shifts - best_shifts)/2.
+                shifts = best_shifts + dshift
+                if np.max(np.abs(dshift)) < tol:
+                    break
+                    
+                continue
+            
+            best_shifts, best_chi2 = shifts*1, chi2
+            if converged | (it == max_iter):
+                break
+                
+            # Design matrix: [m(s0), dm/ds for each group]
+            dm = np.hstack([(flat_model(beam, sg[i]+step) - 
+                             flat_model(beam, sg[i]-step))/(2*step)
+                            for i, beam in enumerate(self.beams)])[mask]
+            
+            A = np.zeros((ng+1, len(m0)))
+            A[0,:] = m0
+            for il in range(ng):
+                A[il+1,:] = dm*(beam_group == il)
+            
+            ok = np.sum(A != 0, axis=1) > 0
+            coeffs = np.zeros(ng+1)
+            coeffs[ok] = np.linalg.lstsq((A[ok,:]*w).T, y*w, rcond=None)[0]
+            if coeffs[0] == 0:
+                break
+                
+            dshift = coeffs[1:]/coeffs[0]
+            shifts = np.clip(shifts + dshift, -max_shift, max_shift)
+            converged = np.max(np.abs(dshift)) < tol
+            
+        out = {'nit':it, 'chi2':np.array(hist['chi2']), 
+               'shifts':np.array(hist['shifts'])}
+        
+        return best_shifts, out
+        
     @staticmethod
     def eval_trace_shift(shifts, self, indices, poly_order, lm, verbose, fit_with_psf):
         """TBD
@@ -4174,12 +4949,54 @@ class MultiBeam(GroupFitter):
         
         return pyfits.HDUList(p)
         
-    def check_for_bad_PAs(self, poly_order=1, chi2_threshold=1.5, fit_background=True, reinit=True):
-        """
+    def check_for_bad_PAs(self, poly_order=1, chi2_threshold=1.5, fit_background=True, reinit=True, huber_delta=4):
+        """Find grism/PA groups with poor fits relative to the others
+        
+        The beams of each PA are fit with polynomial templates and the 
+        reduced chi-squared values are compared within each grism.  The 
+        polynomial models and background components are computed once for 
+        all beams and each PA fit uses the rows and columns of that design
+        matrix for its own beams, which is equivalent to fitting a separate
+        `MultiBeam` of the beams of each PA with 
+        `~grizli.fitting.GroupFitter.xfit_at_z`.
+        
+        Parameters
+        ----------
+        poly_order : int
+            Order of the polynomial templates.
+        
+        chi2_threshold : float
+            PAs with reduced chi-squared greater than `chi2_threshold` times 
+            the minimum value for a given grism are flagged as bad.
+        
+        fit_background : bool
+            Fit a pedestal background for each beam.
+            
+        reinit : bool
+            Remove the beams of the bad PAs from `beams`.
+        
+        huber_delta : float
+            Huber loss parameter, see 
+            `~grizli.fitting.GroupFitter.xfit_at_z`.
+        
+        Returns
+        -------
+        fit_log : dict
+            Fit results for each grism/PA.
+        
+        keep_dict : dict
+            PAs that were kept for each grism.
+            
+        has_bad : bool
+            At least one PA was flagged.
         """
-
+        import scipy.optimize
+        from scipy.special import huber
+        from .fitting import COEFF_SCALE
+        
         wave = np.linspace(2000,2.5e4,100)
         poly_templates = utils.polynomial_templates(wave, order=poly_order)
+        NTEMP = len(poly_templates)
         
         fit_log = OrderedDict()
         keep_dict = {}
@@ -4187,30 +5004,56 @@ class MultiBeam(GroupFitter):
         
         keep_beams = []
         
+        # Full design matrix of the spectrum pixels, computed once
+        mask = self.fit_mask[:self.Ntot]
+        weight = (self.weightf*self.fit_mask)[:self.Ntot]
+        sivarf = (self.sivarf*np.sqrt(self.weightf))[:self.Ntot][mask]
+        
+        A = np.zeros((self.N+NTEMP, mask.sum()))
+        if fit_background:
+            A[:self.N,:] = self.A_bgm[:,:mask.sum()]
+            pedestal = 0.04
+        else:
+            pedestal = 0.
+            
+        for i, t in enumerate(poly_templates):
+            s = [poly_templates[t].wave, poly_templates[t].flux]
+            for j, beam in enumerate(self.beams):
+                if self.mslices[j] is None:
+                    continue
+                    
+                A[self.N+i, self.mslices[j]] = beam.compute_model(spectrum_1d=s, in_place=False, is_cgs=True)[beam.fit_mask]*COEFF_SCALE
+                
+        Ax = A*sivarf
+        data = (self.scif[:self.Ntot][mask]+pedestal)*sivarf
+        
         for g in self.PA:
             fit_log[g] = OrderedDict()
             keep_dict[g] = []
                             
             for pa in self.PA[g]:
-                beams = [self.beams[i] for i in self.PA[g][pa]]
-                mb_i = MultiBeam(beams, fcontam=self.fcontam,
-                                 sys_err=self.sys_err, min_sens=self.min_sens,
-                                 min_mask=self.min_mask, 
-                                 mask_resid=self.mask_resid, 
-                                 MW_EBV=self.MW_EBV)
-                              
+                ix = self.PA[g][pa]
+                pix = [self.mslices[j] for j in ix 
+                       if self.mslices[j] is not None]
+                
+                rows = np.hstack([ix, self.N+np.arange(NTEMP)])
                 try:
-                    chi2, _, _, _ = mb_i.xfit_at_z(z=0,
-                                                   templates=poly_templates,
-                                                fit_background=fit_background)
+                    pix = np.hstack(pix)
+                    oktemp = A[rows,:][:,pix].sum(axis=1) != 0
+                    AxT = Ax[rows[oktemp],:][:,pix].T
+                    coeffs, rnorm = scipy.optimize.nnls(AxT, data[pix])
+                    
+                    resid = data[pix] - AxT.dot(coeffs)
+                    if huber_delta > 0:
+                        chi2 = np.sum(huber(huber_delta, resid)*2.)
+                    else:
+                        chi2 = np.sum(resid**2)
                 except:
                     chi2 = 1e30
-                    
-                if False:
-                    p_i = mb_i.template_at_z(z=0, templates=poly_templates, fit_background=fit_background, fitter='lstsq', fwhm=1400, get_uncertainties=2)
                 
-                fit_log[g][pa] = {'chi2': chi2, 'DoF': mb_i.DoF, 
-                                  'chi_nu': chi2/np.maximum(mb_i.DoF, 1)}
+                DoF = int(np.sum([weight[self.slices[j]].sum() for j in ix]))
+                fit_log[g][pa] = {'chi2': chi2, 'DoF': DoF, 
+                                  'chi_nu': chi2/np.maximum(DoF, 1)}
                 
             
             min_chinu = 1e30
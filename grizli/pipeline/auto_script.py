@@ -5,6 +5,7 @@ import os
 import inspect
 import traceback
 import glob
+import io
 
 import numpy as np
 import astropy.io.fits as pyfits
@@ -955,8 +956,7 @@ def remove_bad_expflag(field_root='', HOME_PATH='./', min_bad=2):
     if len(files) == 0:
         return False
     
-    expf = utils.header_keys_from_filelist(files, keywords=['EXPFLAG'], 
-                                           ext=0, colname_case=str.upper)
+    expf = utils.get_flt_info(files, columns=['FILE', 'FILTER', 'EXPFLAG'])
     expf.write('{0}_expflag.txt'.format(field_root), 
                format='csv', overwrite=True)
     
@@ -2193,9 +2193,13 @@ def load_GroupFLT(field_root='j142724+334246', force_ref=None, force_seg=None, f
                 
         return [grp]
     
-def grism_prep(field_root='j142724+334246', ds9=None, refine_niter=3, gris_ref_filters=GRIS_REF_FILTERS, files=None, split_by_grism=True, refine_poly_order=1, refine_fcontam=0.5, cpu_count=0, mask_mosaic_edges=True, grisms_to_process=None):
+def grism_prep(field_root='j142724+334246', ds9=None, refine_niter=3, gris_ref_filters=GRIS_REF_FILTERS, files=None, split_by_grism=True, refine_poly_order=1, refine_fcontam=0.5, cpu_count=0, mask_mosaic_edges=True, grisms_to_process=None, refine_tol=None, refine_threads=None):
     """
     Contamination model for grism exposures
+    
+    ``refine_tol`` and ``refine_threads`` are passed to 
+    `~grizli.multifit.GroupFLT.refine_list` for incremental refinement of
+    the contamination model over the ``refine_niter`` iterations.
     """
     import glob
     import os
@@ -2288,15 +2292,26 @@ def grism_prep(field_root='j142724+334246', ds9=None, refine_niter=3, gris_ref_f
                 
             grp.refine_list(poly_order=refine_poly_order, mag_limits=[18, 24],
                             max_coeff=5, ds9=ds9, verbose=True, 
-                            fcontam=refine_i)
+                            fcontam=refine_i, refine_tol=refine_tol,
+                            num_threads=refine_threads)
 
         ##############
         # Save model to avoid having to recompute it again
         grp.save_full_data()
     
+    # Footprints of all exposures to find the exposures of extracted objects
+    flts = [flt for grp_i in grp_objects for flt in grp_i.FLTs]
+    labels = [os.path.basename(multifit.get_save_file(flt.grism_file, 
+                                                      flt.grism.sci_extn))
+              for flt in flts]
+    
+    fp_index = utils.FootprintIndex.from_flts(flts, labels=labels)
+    fp_index.write('{0}.footprints.fits'.format(field_root))
+    
     # Link minimal files to Extractions directory
     os.chdir('../Extractions/')
     os.system('ln -s ../Prep/*GrismFLT* .')
+    os.system('ln -s ../Prep/{0}.footprints.fits .'.format(field_root))
     os.system('ln -s ../Prep/*_fl*wcs.fits .')
     os.system('ln -s ../Prep/{0}-*.cat.fits .'.format(field_root))
     os.system('ln -s ../Prep/{0}-*seg.fits .'.format(field_root))
@@ -2374,7 +2389,145 @@ def refine_model_with_fits(field_root='j142724+334246', grp=None, master_files=N
     
     del(grp)
     
-def extract(field_root='j142724+334246', maglim=[13,24], prior=None, MW_EBV=0.00, ids=[], pline=DITHERED_PLINE, fit_only_beams=True, run_fit=True, poly_order=7, oned_R=30, master_files=None, grp=None, bad_pa_threshold=None, fit_trace_shift=False, size=32, diff=True, min_sens=0.02, fcontam=0.2, min_mask=0.01, sys_err=0.03, skip_complete=True, fit_args={}, args_file='fit_args.npy', get_only_beams=False):
+# State shared with the forked workers of `extract`
+_EXTRACT_STATE = {}
+
+def _extract_worker(args):
+    """Run `extract_object` in a worker forked by `extract`
+    """
+    ii, id = args
+    try:
+        return extract_object(_EXTRACT_STATE['grp'], id, ii=ii, 
+                              nids=_EXTRACT_STATE['nids'], 
+                              **_EXTRACT_STATE['kwargs'])
+    except:
+        traceback.print_exc()
+        return False
+        
+def _write_extracted(root, hdu, mb, png_data):
+    """
+    Write the ``stack.fits`` and ``beams.fits`` files of an extracted object
+    and then the ``stack.png`` figure in `png_data`, so that the figure 
+    only exists once the FITS files are complete.
+    """
+    hdu.writeto('{0}.stack.fits'.format(root), overwrite=True)
+    mb.write_master_fits()
+    
+    with open('{0}.stack.png'.format(root), 'wb') as fp:
+        fp.write(png_data.getvalue())
+    
+def extract_object(grp, id, ii=0, nids=1, target='j142724+334246', size=32, min_sens=0.02, fcontam=0.2, MW_EBV=0., sys_err=0.03, min_mask=0.01, bad_pa_threshold=None, fit_trace_shift=False, init_templates={}, oned_R=30, bin_steps=None, show_beams=True, diff=True, close=True, skip_complete=True, writer=None, pending=None):
+    """Extract the beams and stacked spectra of a single object
+    
+    Writes the ``beams.fits``, 1D spectrum and ``stack.fits`` files and
+    figures of object `id` from the exposures in `grp`, as in the first 
+    loop of `extract`.
+    
+    If `writer` is an `~concurrent.futures.Executor`, the ``stack.fits`` 
+    and ``beams.fits`` files are written by `writer` and the futures are 
+    appended to the `pending` list.  The ``stack.png`` figure that marks 
+    the object as complete for `skip_complete` is written after them.
+    
+    Returns
+    -------
+    status : bool
+        Spectra extracted.
+    """
+    import matplotlib.pyplot as plt
+    
+    try:
+        from .. import multifit
+    except:
+        from grizli import multifit
+    
+    if skip_complete:
+        if os.path.exists('{0}_{1:05d}.stack.png'.format(target, id)):
+            return False
+        
+    beams = grp.get_beams(id, size=size, beam_id='A', min_sens=min_sens)
+    for i in range(len(beams))[::-1]:
+        if beams[i].fit_mask.sum() < 10:
+            beams.pop(i)
+            
+    print('{0}/{1}: {2} {3}'.format(ii, nids, id, len(beams)))
+    if len(beams) < 1:
+        return False
+    
+    mb = multifit.MultiBeam(beams, fcontam=fcontam, group_name=target, psf=False, MW_EBV=MW_EBV, sys_err=sys_err, min_mask=min_mask, min_sens=min_sens)
+    
+    if bad_pa_threshold is not None:
+        out = mb.check_for_bad_PAs(chi2_threshold=bad_pa_threshold,
+                                               poly_order=1, reinit=True, 
+                                              fit_background=True)
+
+        fit_log, keep_dict, has_bad = out
+
+        if has_bad:
+            print('\n  Has bad PA!  Final list: {0}\n{1}'.format(keep_dict, fit_log))
+    
+    ixi = grp.catalog['NUMBER'] == id
+    if (fit_trace_shift > 0) & (grp.catalog['MAG_AUTO'][ixi][0] < 24.5):
+        b = mb.beams[0]
+        b.compute_model()
+        sn_lim = fit_trace_shift*1
+        if (np.max((b.model/b.grism['ERR'])[b.fit_mask.reshape(b.sh)]) > sn_lim) | (sn_lim > 100):
+            print(' Fit trace shift: \n')
+            try:
+                shift = mb.fit_trace_shift(tol=1.e-3, verbose=True, split_groups=True, lm=True)
+            except:
+                pass
+                
+    try:
+        tfit = mb.template_at_z(z=0, templates=init_templates, fit_background=True, fitter='lstsq', get_uncertainties=2)
+    except:
+        tfit = None
+        
+    try:
+        fig1 = mb.oned_figure(figsize=[5,3], tfit=tfit, show_beams=show_beams, scale_on_stacked=True, ylim_percentile=5)
+        if oned_R:
+            outroot='{0}_{1:05d}.R{2:.0f}'.format(target, id, oned_R)
+            hdu = mb.oned_spectrum_to_hdu(outputfile=outroot+'.fits', 
+                                          tfit=tfit, wave=bin_steps)                     
+        else:
+            outroot='{0}_{1:05d}.1D'.format(target, id)
+            hdu = mb.oned_spectrum_to_hdu(outputfile=outroot+'.fits',
+                                          tfit=tfit)
+            
+        fig1.savefig(outroot+'.png')
+        
+    except:
+        return False
+    
+    hdu, fig = mb.drizzle_grisms_and_PAs(fcontam=0.5, flambda=False, kernel='point', size=32, zfit=tfit, diff=diff)
+    
+    # Render the figure here since pyplot isn't thread safe
+    png_data = io.BytesIO()
+    fig.savefig(png_data, format='png')
+    
+    root = '{0}_{1:05d}'.format(target, id)
+    if writer is None:
+        _write_extracted(root, hdu, mb, png_data)
+    else:
+        pending.append(writer.submit(_write_extracted, root, hdu, mb, 
+                                     png_data))
+        
+    if close:
+        plt.close(fig); plt.close(fig1); del(hdu); del(mb)
+        for k in range(100000): plt.close()
+    
+    return True
+    
+def extract(field_root='j142724+334246', maglim=[13,24], prior=None, MW_EBV=0.00, ids=[], pline=DITHERED_PLINE, fit_only_beams=True, run_fit=True, poly_order=7, oned_R=30, master_files=None, grp=None, bad_pa_threshold=None, fit_trace_shift=False, size=32, diff=True, min_sens=0.02, fcontam=0.2, min_mask=0.01, sys_err=0.03, skip_complete=True, fit_args={}, args_file='fit_args.npy', get_only_beams=False, extract_cpus=0, extract_batch=64):
+    """Extract spectra and, optionally, fit redshifts for objects in a field
+    
+    ``extract_cpus`` > 1 runs `extract_object` for the objects in processes 
+    forked from this one, which share the `~grizli.multifit.GroupFLT` 
+    object read-only (copy-on-write).  The workers are restarted after 
+    ``extract_batch`` objects to bound their memory use.  Otherwise, the 
+    objects are extracted serially and the ``stack.fits`` and 
+    ``beams.fits`` files are written in a background thread, with at most
+    ``extract_batch`` pending.
+    """
     import glob
     import os
     
@@ -2482,89 +2635,58 @@ def extract(field_root='j142724+334246', maglim=[13,24], prior=None, MW_EBV=0.00
         
     ###############
     # Stacked spectra
-    for ii, id in enumerate(ids):
-        if skip_complete:
-            if os.path.exists('{0}_{1:05d}.stack.png'.format(target, id)):
-                continue
-            
-        beams = grp.get_beams(id, size=size, beam_id='A', min_sens=min_sens)
-        for i in range(len(beams))[::-1]:
-            if beams[i].fit_mask.sum() < 10:
-                beams.pop(i)
-                
-        print('{0}/{1}: {2} {3}'.format(ii, len(ids), id, len(beams)))
-        if len(beams) < 1:
-            continue
-            
-        #mb = multifit.MultiBeam(beams, fcontam=fcontam, group_name=target, psf=False, MW_EBV=MW_EBV, min_sens=min_sens)
+    extract_kwargs = dict(target=target, size=size, min_sens=min_sens, 
+                          fcontam=fcontam, MW_EBV=MW_EBV, sys_err=sys_err,
+                          min_mask=min_mask, 
+                          bad_pa_threshold=bad_pa_threshold, 
+                          fit_trace_shift=fit_trace_shift,
+                          init_templates=init_templates, oned_R=oned_R, 
+                          show_beams=show_beams, diff=diff, close=close, 
+                          skip_complete=skip_complete)
+    
+    if oned_R:
+        extract_kwargs['bin_steps'] = bin_steps
         
-        mb = multifit.MultiBeam(beams, fcontam=fcontam, group_name=target, psf=False, MW_EBV=MW_EBV, sys_err=sys_err, min_mask=min_mask, min_sens=min_sens)
+    if extract_cpus > 1:
+        # Forked workers share the read-only `grp` copy-on-write
+        import multiprocessing as mp
         
-        if bad_pa_threshold is not None:
-            out = mb.check_for_bad_PAs(chi2_threshold=bad_pa_threshold,
-                                                   poly_order=1, reinit=True, 
-                                                  fit_background=True)
-
-            fit_log, keep_dict, has_bad = out
-
-            if has_bad:
-                print('\n  Has bad PA!  Final list: {0}\n{1}'.format(keep_dict, fit_log))
-        
-        ixi = grp.catalog['NUMBER'] == id
-        if (fit_trace_shift > 0) & (grp.catalog['MAG_AUTO'][ixi][0] < 24.5):
-            b = mb.beams[0]
-            b.compute_model()
-            sn_lim = fit_trace_shift*1
-            if (np.max((b.model/b.grism['ERR'])[b.fit_mask.reshape(b.sh)]) > sn_lim) | (sn_lim > 100):
-                print(' Fit trace shift: \n')
-                try:
-                    shift = mb.fit_trace_shift(tol=1.e-3, verbose=True, split_groups=True, lm=True)
-                except:
-                    pass
-                    
-        try:
-            tfit = mb.template_at_z(z=0, templates=init_templates, fit_background=True, fitter='lstsq', get_uncertainties=2)
-        except:
-            tfit = None
-    
-        # if False:
-        #     # Use spline for first-pass continuum fit
-        #     wspline = np.arange(4200, 2.5e4)
-        #     Rspline = 10
-        #     df_spl = len(utils.log_zgrid(zr=[wspline[0], wspline[-1]], dz=1./Rspline))
-        #     tspline = utils.bspline_templates(wspline, df=df_spl+2, log=True, clip=0.0001)
-        #     pfit = mb.template_at_z(z=0, templates=tspline, fit_background=True, fitter='lstsq', get_uncertainties=2)
-            
+        _EXTRACT_STATE['grp'] = grp
+        _EXTRACT_STATE['kwargs'] = extract_kwargs
+        _EXTRACT_STATE['nids'] = len(ids)
+        
+        # Restart workers after each batch to bound their memory
+        ctx = mp.get_context('fork')
+        pool = ctx.Pool(extract_cpus, maxtasksperchild=extract_batch)
         try:
-            fig1 = mb.oned_figure(figsize=[5,3], tfit=tfit, show_beams=show_beams, scale_on_stacked=True, ylim_percentile=5)
-            if oned_R:
-                outroot='{0}_{1:05d}.R{2:.0f}'.format(target, id, oned_R)
-                hdu = mb.oned_spectrum_to_hdu(outputfile=outroot+'.fits', 
-                                              tfit=tfit, wave=bin_steps)                     
-            else:
-                outroot='{0}_{1:05d}.1D'.format(target, id)
-                hdu = mb.oned_spectrum_to_hdu(outputfile=outroot+'.fits',
-                                              tfit=tfit)
-                
-            fig1.savefig(outroot+'.png')
-            
-        except:
-            continue
-   
-        hdu, fig = mb.drizzle_grisms_and_PAs(fcontam=0.5, flambda=False, kernel='point', size=32, zfit=tfit, diff=diff)
-        fig.savefig('{0}_{1:05d}.stack.png'.format(target, id))
-
-        hdu.writeto('{0}_{1:05d}.stack.fits'.format(target, id), 
-                    overwrite=True)
-        mb.write_master_fits()
+            for status in pool.imap_unordered(_extract_worker, 
+                                              list(enumerate(ids))):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+            _EXTRACT_STATE.clear()
+    else:
+        # Write the output files in a background thread
+        from concurrent.futures import ThreadPoolExecutor
+        
+        writer = ThreadPoolExecutor(max_workers=1)
+        pending = []
+        for ii, id in enumerate(ids):
+            extract_object(grp, id, ii=ii, nids=len(ids), writer=writer, 
+                           pending=pending, **extract_kwargs)
+            
+            # Bound the number of unwritten outputs held in memory
+            if len(pending) > extract_batch:
+                for future in pending:
+                    future.result()
+                    
+                pending = []
         
-        if False:
-            # Fit here for AWS...
-            fitting.run_all_parallel(id, verbose=True)
+        for future in pending:
+            future.result()
             
-        if close:
-            plt.close(fig); plt.close(fig1); del(hdu); del(mb)
-            for k in range(100000): plt.close()
+        writer.shutdown()
             
     if not run_fit:
         if init_grp:
@@ -2603,9 +2725,14 @@ def extract(field_root='j142724+334246', maglim=[13,24], prior=None, MW_EBV=0.00
     else:
         return True
         
-def generate_fit_params(field_root='j142724+334246', fitter=['nnls', 'bounded'], prior=None, MW_EBV=0.00, pline=DITHERED_PLINE, fit_only_beams=True, run_fit=True, poly_order=7, fsps=True, min_sens=0.01, sys_err=0.03, fcontam=0.2, zr=[0.05, 3.6], dz=[0.004, 0.0004], fwhm=1000, lorentz=False, include_photometry=True, use_phot_obj=False, save_file='fit_args.npy', fit_trace_shift=False, **kwargs):
+def generate_fit_params(field_root='j142724+334246', fitter=['nnls', 'bounded'], prior=None, MW_EBV=0.00, pline=DITHERED_PLINE, fit_only_beams=True, run_fit=True, poly_order=7, fsps=True, min_sens=0.01, sys_err=0.03, fcontam=0.2, zr=[0.05, 3.6], dz=[0.004, 0.0004], fwhm=1000, lorentz=False, include_photometry=True, use_phot_obj=False, save_file='fit_args.npy', fit_trace_shift=False, template_bank=False, **kwargs):
     """
     Generate a parameter dictionary for passing to the fitting script
+    
+    If `template_bank` is set, the templates are stored in 
+    `~grizli.utils.TemplateBank` files ``{field_root}.t0.bank.fits`` and 
+    ``{field_root}.t1.bank.fits`` that are memory-mapped by the fitting 
+    processes, rather than pickled in `save_file`.
     """
     import numpy as np
     from grizli import utils, fitting
@@ -2615,7 +2742,17 @@ def generate_fit_params(field_root='j142724+334246', fitter=['nnls', 'bounded'],
     
     t0 = utils.load_templates(fwhm=fwhm, line_complexes=True, stars=False, full_line_list=None, continuum_list=None, fsps_templates=fsps, alf_template=True, lorentz=lorentz)
     t1 = utils.load_templates(fwhm=fwhm, line_complexes=False, stars=False, full_line_list=None, continuum_list=None, fsps_templates=fsps, alf_template=True, lorentz=lorentz)
-
+    
+    if template_bank:
+        banks = []
+        for ti, tt in zip(['t0', 't1'], [t0, t1]):
+            bank_file = '{0}.{1}.bank.fits'.format(field_root, ti)
+            utils.TemplateBank(tt).write(bank_file)
+            print('Template bank: {0}'.format(bank_file))
+            banks.append(utils.TemplateBank(file=bank_file))
+        
+        t0, t1 = banks
+        
     args = fitting.run_all(0, t0=t0, t1=t1, fwhm=1200, zr=zr, dz=dz, fitter=fitter, group_name=field_root, fit_stacks=False, prior=prior,  fcontam=fcontam, pline=pline, min_sens=min_sens, mask_sn_limit=np.inf, fit_beams=False,  root=field_root, fit_trace_shift=fit_trace_shift, phot=phot, use_phot_obj=use_phot_obj, verbose=True, scale_photometry=False, show_beams=True, overlap_threshold=10, get_ir_psfs=True, fit_only_beams=fit_only_beams, MW_EBV=MW_EBV, sys_err=sys_err, get_dict=True)
     
     # EAZY-py photometry object from HST photometry
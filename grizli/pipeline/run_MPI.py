@@ -13,21 +13,45 @@ where "-n 8" indicates running 8 parallel threads.
 
 Needs 'fit_args.py' created by `auto_script.generate_fit_params`.
 
+The MPI workers are persistent processes that read the fit arguments, 
+templates and configuration files once (`fitting.init_fit_worker`).  
+Without MPI, a single persistent worker can fit every Nth object with 
+
+    python $GRIZLICODE/grizli/pipeline/run_MPI.py --worker [i N]
+
+or a local pool of N processes can be used with
+
+    python $GRIZLICODE/grizli/pipeline/run_MPI.py --pool N
+
+The objects are submitted in order of decreasing expected fit time, 
+estimated from the `beams.fits` files (`get_fit_costs`) and calibrated 
+against the fit times recorded in `FIT_TIMES_FILE` by earlier runs.  Idle 
+workers take the next object from the queue as they finish.
+
+
 """
 import time
 import os
+import sys
 import glob
 
 import numpy as np
+import astropy.io.fits as pyfits
 
 import matplotlib.pyplot as plt
 plt.ioff()
 
-from grizli.fitting import run_all_parallel
+from grizli.fitting import run_all_parallel, fit_worker, init_fit_worker
 from grizli import utils
 utils.set_warnings()
 
-def find_ids():
+# Fit times recorded by `run_scheduled`
+FIT_TIMES_FILE = 'fit_times.txt'
+
+# Minimum number of recorded times needed to calibrate the cost model
+MIN_FIT_TIMES = 10
+
+def find_ids(return_files=False):
     # Find objects that with extarcted spectra and that need to be fit
     all_files=glob.glob('*beams.fits')
     files = []
@@ -39,26 +63,192 @@ def find_ids():
         
     ids = [int(file.split('_')[1].split('.')[0]) for file in files]
     
+    if return_files:
+        return ids, files
+        
     return ids
+
+def beams_file_features(file):
+    """Properties of a `beams.fits` file that determine the fit time
     
-if __name__ == '__main__':
+    Returns
+    -------
+    features : list
+        Number of beams (``COUNT``), total number of extensions 
+        (``NEXTxxxx``), total grism exposure time (``T_{grism}``) and 
+        file size in MB, which scales with the size of the cutouts.
+    """
+    h = pyfits.getheader(file, 0)
+    count = h['COUNT']
+    nexts = np.sum([h['NEXT{0:04d}'.format(i)] for i in range(count)
+                   if 'NEXT{0:04d}'.format(i) in h])
+    texp = np.sum([h[k] for k in h if k.startswith('T_')])
+    size = os.path.getsize(file)/1.e6
+    
+    return [int(count), int(nexts), float(texp), size]
+
+def read_fit_times(times_file=FIT_TIMES_FILE):
+    """Read fit times recorded by `run_scheduled`
+    
+    Returns
+    -------
+    times : dict
+        Latest successful record for each object, keyed by ID, with values
+        ``[count, next, texp, size, time]``.
+    """
+    times = {}
+    if not os.path.exists(times_file):
+        return times
+        
+    data = np.atleast_2d(np.loadtxt(times_file, ndmin=2))
+    for row in data:
+        if row[-1] > 0:
+            times[int(row[0])] = row[1:-1]
+            
+    return times
+
+def record_fit_time(id, features, dt, status, times_file=FIT_TIMES_FILE):
+    """Append a fit time to `times_file`
+    """
+    if not os.path.exists(times_file):
+        with open(times_file, 'w') as fp:
+            fp.write('# id count next texp size time status\n')
+    
+    with open(times_file, 'a') as fp:
+        row = [id] + list(features) + [dt, status]
+        fp.write('{0:d} {1:d} {2:d} {3:.1f} {4:.3f} {5:.2f} {6:d}\n'.format(*row))
+        
+def get_fit_costs(ids, files, times_file=FIT_TIMES_FILE, verbose=True):
+    """Estimate relative fit times for objects
+    
+    If at least `MIN_FIT_TIMES` fits have been recorded in `times_file`, 
+    the cost is a non-negative linear model of the `beams_file_features` 
+    fit to the recorded times, and objects with a recorded time for the 
+    same file size use that time directly.  Otherwise the cost is the file
+    size.
+    
+    Returns
+    -------
+    costs : array
+        Estimated cost for each object in `ids`.
+    
+    features : list
+        `beams_file_features` for each object.
+    """
+    from scipy.optimize import nnls
+    
+    features = [beams_file_features(file) for file in files]
+    X = np.array(features, dtype=float).reshape((-1, 4))
+    
+    times = read_fit_times(times_file)
+    if len(times) < MIN_FIT_TIMES:
+        if verbose:
+            print('Fit costs from file sizes')
+            
+        return X[:,3], features
+    
+    rec = np.array([times[k] for k in times])
+    A = np.hstack([np.ones((len(rec), 1)), rec[:,:4]])
+    coeffs, rnorm = nnls(A, rec[:,4])
+    
+    if verbose:
+        print('Fit costs from {0} recorded times: {1}'.format(len(rec), 
+                                                              coeffs))
+    
+    costs = np.hstack([np.ones((len(X), 1)), X]).dot(coeffs)
+    for i, id in enumerate(ids):
+        if id in times:
+            if np.abs(times[id][3] - X[i,3]) < 1.e-3:
+                costs[i] = times[id][4]
+    
+    return costs, features
 
-    from mpi4py.futures import MPIPoolExecutor
-    import drizzlepac # In here for travis
+def run_scheduled(ids, files, executor, times_file=FIT_TIMES_FILE, verbose=True):
+    """Submit the fits in order of decreasing cost and record the times
+    
+    Each object is a separate task, so idle workers pull the next most 
+    expensive object from the executor queue as soon as they finish.
+    
+    Parameters
+    ----------
+    ids, files : list
+        Object IDs and `beams.fits` files from `find_ids`.
     
+    executor : `~concurrent.futures.Executor`
+        E.g., `~mpi4py.futures.MPIPoolExecutor` or 
+        `~concurrent.futures.ProcessPoolExecutor`.
+    """
+    from concurrent.futures import as_completed
+    
+    costs, features = get_fit_costs(ids, files, times_file=times_file,
+                                    verbose=verbose)
+    so = np.argsort(costs)[::-1]
+    
+    futures = {}
+    for i in so:
+        futures[executor.submit(run_all_parallel, ids[i])] = i
+    
+    for future in as_completed(futures):
+        ix = future.result()
+        i = futures[future]
+        record_fit_time(ids[i], features[i], ix[2], ix[1], 
+                        times_file=times_file)
+                        
+        print('  Done, id={0} / status={1}, t={2:.1f}'.format(ix[0], ix[1], ix[2]))
+    
+def run_worker(ids, worker=0, nworkers=1):
+    """Fit every `nworkers`th object in a single persistent process
+    """
     t1 = time.time()
     
-    ids = find_ids()
+    for ix in fit_worker(ids[worker::nworkers]):
+        print('  Done, id={0} / status={1}, t={2:.1f}'.format(ix[0], ix[1], ix[2]))
+    
+    t2 = time.time()
+    print('Worker {0}/{1}: {2:.1f}'.format(worker, nworkers, t2-t1))
+    
+if __name__ == '__main__':
+    
+    ids, files = find_ids(return_files=True)
     if len(ids) == 0:
         exit()
+    
+    if '--worker' in sys.argv:
+        argv = sys.argv[sys.argv.index('--worker')+1:]
+        if len(argv) >= 2:
+            worker, nworkers = int(argv[0]), int(argv[1])
+        else:
+            worker, nworkers = 0, 1
+        
+        # Interleave in order of decreasing cost
+        costs, _ = get_fit_costs(ids, files)
+        so = np.argsort(costs)[::-1]
+        run_worker([ids[i] for i in so], worker=worker, nworkers=nworkers)
+        exit()
+    
+    t1 = time.time()
+    
+    # Workers load the shared state once
+    if '--pool' in sys.argv:
+        from concurrent.futures import ProcessPoolExecutor
+        
+        nproc = int(sys.argv[sys.argv.index('--pool')+1])
+        with ProcessPoolExecutor(max_workers=nproc, 
+                                 initializer=init_fit_worker) as executor:
+            run_scheduled(ids, files, executor)
+        
+        label = 'ProcessPool'
+    else:
+        from mpi4py.futures import MPIPoolExecutor
+        import drizzlepac # In here for travis
         
-    with MPIPoolExecutor() as executor:
-        res = executor.map(run_all_parallel, ids)
-        for ix in res:
-            print('  Done, id={0} / status={1}, t={2:.1f}'.format(ix[0], ix[1], ix[2]))
+        with MPIPoolExecutor(initializer=init_fit_worker) as executor:
+            run_scheduled(ids, files, executor)
         
+        label = 'MPIPool'
+            
     t2 = time.time()
     
-    print('MPIPool: {0:.1f}'.format(t2-t1))
+    print('{0}: {1:.1f}'.format(label, t2-t1))
     
         
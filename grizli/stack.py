@@ -654,15 +654,10 @@ class StackFitter(GroupFitter):
                         
         for i, t in enumerate(templates):
             ti = templates[t]
-            try:
-                import eazy.igm
-                if z > 7:
-                    igm = eazy.igm.Inoue14()
-                    igmz = igm.full_IGM(z, ti.wave*(1+z))         
-                else:
-                    igmz = 1.
-                    
-            except:
+            igm = utils.get_igm_table()
+            if (z > 7) & (igm is not None):
+                igmz = igm.full_IGM(z, ti.wave*(1+z))         
+            else:
                 igmz = 1.
 
             
@@ -0,0 +1,48 @@
+import unittest
+
+import numpy as np
+from .. import grismconf
+
+def simple_conf():
+    """
+    Configuration with a field-dependent linear trace for beam A
+    """
+    conf = grismconf.aXeConf(conf_file=None)
+    conf.xoff = conf.yoff = 0.
+    conf.orders = {'A':1}
+    conf.conf = {'XOFF_A':np.array([0., 0.01, 0.]),
+                 'YOFF_A':np.array([1., 0., 0.002]),
+                 'DYDX_A_0':np.array([0.5, 1.e-3, 0.]),
+                 'DYDX_A_1':np.array([0.01, 0., 1.e-5]),
+                 'DLDP_A_0':np.array([1.e4, 0.1, 0.2]),
+                 'DLDP_A_1':np.array([45., 1.e-3, 0.])}
+    return conf
+
+class Dummy(unittest.TestCase):
+    def test_trace_cache(self):
+        from unittest import mock
+
+        conf = simple_conf()
+        dx = np.arange(-10, 200)
+        positions = [(100., 200.), (500.5, 20.), (900., 700.)]
+
+        # Traces evaluated from the arrays, which aren't cached
+        ref = [conf.get_beam_trace(x=np.array([x]), y=np.array([y]), dx=dx)
+               for x, y in positions]
+        self.assertEqual(len(conf.trace_cache), 0)
+
+        with mock.patch.object(grismconf, 'TRACE_CACHE_SIZE', 2):
+            for it in range(2):
+                for (x, y), (dy, lam) in zip(positions, ref):
+                    dyi, lami = conf.get_beam_trace(x=x, y=y, dx=dx)
+                    np.testing.assert_allclose(dyi, dy, rtol=1.e-12)
+                    np.testing.assert_allclose(lami, lam, rtol=1.e-12)
+
+                # Oldest position evicted
+                self.assertEqual(list(conf.trace_cache.keys()),
+                                 [(500.5, 20., 'A'), (900., 700., 'A')])
+
+            # Cache hit moves the entry to the end
+            conf.get_beam_trace(x=500.5, y=20., dx=dx)
+            self.assertEqual(list(conf.trace_cache.keys()),
+                             [(900., 700., 'A'), (500.5, 20., 'A')])
@@ -0,0 +1,156 @@
+import unittest
+
+import numpy as np
+from .. import model
+
+class SimpleConf(object):
+    """
+    Minimal linear dispersion for testing `~grizli.model.GrismDisperser`
+    """
+    conf_file = 'simple_G102.conf'
+    conf = {}
+    beams = ['A']
+
+    def __init__(self):
+        self.dxlam = {'A':np.arange(10, 120)}
+        wave = np.linspace(7000, 12000, 300)
+        sens = np.exp(-(wave-9500)**2/2/1000**2)*1.e17
+        self.sens = {'A':{'WAVELENGTH':wave, 'SENSITIVITY':sens}}
+
+    def get_beam_trace(self, x=507, y=507, dx=0., beam='A', fwcpos=None):
+        dx = np.asarray(dx, dtype=float)
+        return 0.3 + 0.01*dx + 1.e-4*x, 8000 + 25.*dx + 0.01*y
+
+def simple_disperser(**kwargs):
+    yp, xp = np.indices((31,30))
+    R = np.sqrt((xp-15)**2+(yp-15)**2)
+    direct = np.cast[np.float32](np.exp(-R**2/2/3**2)+0.01)
+    seg = np.cast[np.float32]((R < 8)*5)
+    seg[0,:] = seg[:,-1] = 5
+
+    beam = model.GrismDisperser(id=5, direct=direct, segmentation=seg,
+                                conf=SimpleConf(), origin=[100,100],
+                                xcenter=0.2, ycenter=-0.3, **kwargs)
+    return beam
+
+class Dummy(unittest.TestCase):
+    def test_response_matrix(self):
+        beam = simple_disperser()
+        wave = np.linspace(7000, 13000, 500)
+        flux = 1 + np.sin(wave/300.)
+
+        for is_cgs in [False, True]:
+            m0 = beam.compute_model(spectrum_1d=[wave, flux], in_place=False,
+                                    is_cgs=is_cgs)*1
+            m1 = beam.compute_model_response(spectrum_1d=[wave, flux],
+                                             is_cgs=is_cgs)
+            np.testing.assert_allclose(m0, m1, rtol=1.e-8,
+                                       atol=1.e-12*np.abs(m0).max())
+
+        # Reset with a trace offset
+        beam.add_ytrace_offset(0.3)
+        m0 = beam.compute_model(in_place=False)*1
+        m1 = beam.compute_model_response()
+        np.testing.assert_allclose(m0, m1, rtol=1.e-8,
+                                   atol=1.e-12*np.abs(m0).max())
+
+    def test_disperse_beams(self):
+        beams = [simple_disperser() for i in range(4)]
+        beams[1].add_ytrace_offset(0.4)
+        
+        wave = np.linspace(7000, 13000, 500)
+        spectra = [None] + [[wave, 1 + np.sin(wave/(100.*i))] 
+                            for i in range(1,4)]
+        
+        m0 = []
+        for beam, spec in zip(beams, spectra):
+            beam.compute_model(spectrum_1d=spec, is_cgs=True)
+            m0.append(beam.modelf*1)
+            beam.modelf *= 0
+            
+        model.disperse_beams(beams, spectra=spectra, is_cgs=True, 
+                             num_threads=2)
+        
+        for beam, m in zip(beams, m0):
+            np.testing.assert_allclose(beam.modelf, m, rtol=1.e-12)
+            np.testing.assert_allclose(beam.model.flatten(), m, rtol=1.e-12)
+            
+    def test_segmentation_index(self):
+        from ..utils_c import disperse
+        
+        rng = np.random.RandomState(1)
+        seg = np.zeros((100, 120), dtype=np.float32)
+        for k in range(1, 40):
+            y, x = rng.randint(0, 90), rng.randint(0, 110)
+            seg[y:y+rng.randint(1,10), x:x+rng.randint(1,10)] = k
+        
+        flam = rng.normal(size=seg.shape).astype(np.float32)
+        flam[seg == 3] = 0
+        
+        seg_index = model.compute_segmentation_index(seg, flam)
+        ids = np.unique(seg)[1:]
+        self.assertEqual(len(seg_index), len(ids))
+        
+        sh = np.array(seg.shape, dtype=np.int64)
+        for id in ids:
+            out = disperse.compute_segmentation_limits(seg, id, flam, sh)
+            self.assertEqual(seg_index[int(id)], out)
+            
+    def test_lazy_fits(self):
+        import os
+        import pickle
+        import tempfile
+        import astropy.io.fits as pyfits
+        
+        sh = (40, 50)
+        arrays = {'DSCI':np.random.normal(size=sh).astype(np.float32),
+                  'GSCI':np.random.normal(size=sh).astype(np.float32),
+                  'SEG':np.ones(sh, dtype=np.float32),
+                  'MODEL':np.random.normal(size=sh).astype(np.float32)}
+        
+        hdu = pyfits.HDUList([pyfits.PrimaryHDU()])
+        for ext in ['DSCI', 'GSCI', 'SEG', 'MODEL']:
+            hdu.append(pyfits.ImageHDU(data=arrays[ext], name=ext))
+        
+        hdu.append(pyfits.ImageHDU(name='DREF'))
+        
+        save_file = os.path.join(tempfile.mkdtemp(), 'test.GrismFLT.fits')
+        hdu.writeto(save_file)
+        
+        flt = model.GrismFLT.__new__(model.GrismFLT)
+        flt.direct = model.ImageData.__new__(model.ImageData)
+        flt.grism = model.ImageData.__new__(model.ImageData)
+        flt.load_from_fits(save_file, lazy=True)
+        
+        slices = (slice(5,10), slice(20,30))
+        cutout = flt.get_cutout('model', slices)
+        self.assertFalse('model' in flt.__dict__)
+        np.testing.assert_allclose(cutout, arrays['MODEL'][slices])
+        
+        cutout = model._get_data_cutout(flt.grism.data, 'SCI', slices)
+        self.assertFalse(flt.grism.data.is_loaded('SCI'))
+        np.testing.assert_allclose(cutout, arrays['GSCI'][slices])
+        self.assertTrue(flt.direct.data['REF'] is None)
+        
+        # Dict accessors read the arrays rather than the placeholders
+        np.testing.assert_allclose(flt.grism.data.get('SCI'), arrays['GSCI'])
+        for key, data in flt.grism.data.items():
+            self.assertTrue(data is not None)
+        
+        self.assertEqual(flt.grism.data.get('XXX', 1), 1)
+        
+        # Pickled copy reopens the file
+        flt_copy = pickle.loads(pickle.dumps(flt))
+        
+        # Read full arrays on first access
+        np.testing.assert_allclose(flt.seg, arrays['SEG'])
+        self.assertTrue('seg' in flt.__dict__)
+        np.testing.assert_allclose(flt.direct.data['SCI'], arrays['DSCI'])
+        self.assertTrue(flt.direct.data.is_loaded('SCI'))
+        
+        np.testing.assert_allclose(flt_copy.model, arrays['MODEL'])
+        self.assertEqual(list(flt_copy.grism.data.keys()), ['SCI'])
+        
+        flt.direct.data.close()
+        flt.grism.data.close()
+        flt_copy.grism.data.close()
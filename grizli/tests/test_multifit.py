@@ -0,0 +1,323 @@
+import unittest
+
+import numpy as np
+from .. import multifit, utils
+
+# Parent-array slices of the spectra of two overlapping objects
+SLICES = {1:(slice(10, 30), slice(10, 60)), 2:(slice(20, 40), slice(40, 90))}
+
+class FakeImage(object):
+    def __init__(self):
+        self.parent_file = 'test_flt.fits'
+        self.sci_extn = 1
+        self.sh = (100, 100)
+
+class FakeFLT(object):
+    """
+    Records model updates in place of `~grizli.model.GrismFLT`
+    """
+    def __init__(self):
+        self.grism = FakeImage()
+        self.updates = []
+
+    def compute_model_orders(self, id=0, footprints=None, **kwargs):
+        self.updates.append(id)
+        if footprints is not None:
+            footprints.append(SLICES[id])
+
+        return True
+
+class FakeDirect(dict):
+    photplam = 1.4e4
+
+class FakeBeam(object):
+    def __init__(self, id):
+        self.id = id
+        self.grism = FakeImage()
+        self.direct = FakeDirect(REF=None)
+        self.beam = FakeBeam.Beam()
+        self.beam.sly_parent, self.beam.slx_parent = SLICES[id]
+        self.beam.total_flux = 1.
+
+    class Beam(object):
+        pass
+
+class FakeMultiBeam(object):
+    """
+    Flat spectrum fit with a level set in `LEVELS`
+    """
+    LEVELS = {1:1., 2:1.}
+    NFIT = {1:0, 2:0}
+
+    def __init__(self, beams, **kwargs):
+        self.id = beams[0].id
+        self.wavef = np.linspace(1.e4, 1.6e4, 50)
+        self.fit_mask = np.ones(50, dtype=bool)
+
+    def template_at_z(self, **kwargs):
+        FakeMultiBeam.NFIT[self.id] += 1
+        wave = np.linspace(1.1e4, 1.5e4, 20)
+        cont1d = utils.SpectrumTemplate(wave=wave,
+                                      flux=wave*0+self.LEVELS[self.id])
+        cfit = {'poly {0}'.format(i):[1.*(i == 0)] for i in range(4)}
+        return {'cfit':cfit, 'cont1d':cont1d}
+
+class Dummy(unittest.TestCase):
+    def test_refine_list_incremental(self):
+        from unittest import mock
+
+        grp = multifit.GroupFLT.__new__(multifit.GroupFLT)
+        grp.FLTs = [FakeFLT()]
+        grp.N = 1
+
+        def get_beams(id, **kwargs):
+            return [FakeBeam(id)]
+
+        grp.get_beams = get_beams
+        kws = dict(ids=[1, 2], mags=[20, 21], refine_tol=0.01, verbose=False)
+
+        with mock.patch.object(multifit, 'MultiBeam', FakeMultiBeam):
+            # Serial model updates, i.e., num_threads=None
+            grp.refine_list(**kws)
+            self.assertEqual(grp.FLTs[0].updates, [1, 2])
+            self.assertTrue(grp.refine_counter[0].max() > 0)
+
+            # Refit but spectra haven't changed
+            grp.refine_list(**kws)
+            self.assertEqual(FakeMultiBeam.NFIT, {1:2, 2:2})
+            self.assertEqual(grp.FLTs[0].updates, [1, 2])
+
+            # Converged
+            grp.refine_list(**kws)
+            self.assertEqual(FakeMultiBeam.NFIT, {1:2, 2:2})
+
+            # Updating object 1 triggers a refit of overlapping object 2
+            FakeMultiBeam.LEVELS[1] = 2.
+            grp.refine_state[1]['converged'] = False
+            grp.refine_list(**kws)
+            self.assertEqual(FakeMultiBeam.NFIT, {1:3, 2:3})
+            self.assertEqual(grp.FLTs[0].updates, [1, 2, 1])
+
+    def test_shared_dir_cleanup(self):
+        import gc
+        import os
+
+        grp = multifit.GroupFLT.__new__(multifit.GroupFLT)
+        grp._make_shared_dir(True)
+        shared_dir = grp.shared_dir
+        self.assertTrue(os.path.exists(shared_dir))
+
+        # Temporary directory removed with the object
+        del(grp)
+        gc.collect()
+        self.assertFalse(os.path.exists(shared_dir))
+
+class FakeWCS(object):
+    def __init__(self, offset):
+        self.offset = offset
+
+    def all_world2pix(self, rd, origin):
+        return rd + self.offset
+
+class FakeDisperser(object):
+    """
+    Adds the object position and PSF parameter to a single model pixel
+    """
+    def __init__(self, x, y, psf_params):
+        self.x, self.y, self.psf_params = x, y, psf_params
+        self.sly_parent = slice(int(y), int(y)+1)
+        self.slx_parent = slice(int(x), int(x)+1)
+
+    def compute_model(self, spectrum_1d=None, is_cgs=False):
+        psf = 0 if self.psf_params is None else self.psf_params
+        self.model = np.array([[self.x + 10*self.y + 100*psf]])
+
+    def add_to_full_image(self, data, full_array):
+        full_array[self.sly_parent, self.slx_parent] += data
+
+class FakeModelFLT(object):
+    def __init__(self, offset):
+        self.grism = FakeImage()
+        self.grism.parent_file = 'flt_{0}.fits'.format(offset)
+        self.direct = FakeImage()
+        self.direct.wcs = FakeWCS(offset)
+        self.model = np.zeros((100, 100))
+
+    def compute_model_orders(self, id=0, x=None, y=None, psf_params=None,
+                             batch=None, footprints=None, **kwargs):
+        if x is None:
+            x = y = 50
+
+        beam = FakeDisperser(x, y, psf_params)
+        if footprints is not None:
+            footprints.append((beam.sly_parent, beam.slx_parent))
+
+        if batch is not None:
+            batch.append((beam, None, False))
+        else:
+            beam.compute_model()
+            beam.add_to_full_image(beam.model, self.model)
+
+        return True
+
+class ThreadedModels(unittest.TestCase):
+    def test_threaded_single_model(self):
+        from unittest import mock
+        from .. import model
+
+        def disperse_beams(beams, spectra=None, is_cgs=False,
+                           num_threads=0):
+            for beam in beams:
+                beam.compute_model()
+
+        kws = dict(center_rd=[20.5, 30.5], flt_indices=[0, 2],
+                   psf_param_dict={'flt_2.fits':2.})
+
+        models = []
+        for num_threads in [None, 2]:
+            grp = multifit.GroupFLT.__new__(multifit.GroupFLT)
+            grp.FLTs = [FakeModelFLT(offset) for offset in range(3)]
+            grp.N = 3
+
+            footprints = []
+            with mock.patch.object(model, 'disperse_beams', disperse_beams):
+                grp.compute_single_model(1, num_threads=num_threads,
+                                         footprints=footprints, **kws)
+
+            self.assertEqual([f[0] for f in footprints], [0, 2])
+            models.append(np.array([flt.model for flt in grp.FLTs]))
+
+        np.testing.assert_array_equal(models[0], models[1])
+        self.assertEqual(models[1][1].sum(), 0)
+        self.assertEqual(models[1][2][32, 22], 22.5 + 325 + 200)
+
+class FakeTrace(object):
+    """
+    Gaussian cross-dispersion profile centered at the trace offset
+    """
+    def __init__(self, sh=(21, 40), sigma=1.5):
+        self.sh = sh
+        self.sigma = sigma
+        self.yoffset = 0.
+        self.modelf = np.zeros(sh).flatten()
+
+    def add_ytrace_offset(self, yoffset):
+        self.yoffset = yoffset
+
+    def compute_model(self, in_place=False):
+        yp, xp = np.indices(self.sh)
+        yc = self.sh[0]//2 + self.yoffset
+        prof = np.exp(-(yp-yc)**2/2/self.sigma**2)
+        return (prof*(1 + xp/self.sh[1])).flatten()
+
+class FakeTraceBeam(object):
+    def __init__(self):
+        self.beam = FakeTrace()
+
+class TraceShift(unittest.TestCase):
+    def test_linear_trace_shift(self):
+        mb = multifit.MultiBeam.__new__(multifit.MultiBeam)
+        mb.beams = [FakeTraceBeam(), FakeTraceBeam()]
+        mb.N = 2
+
+        # Data with known offsets for the two groups
+        truth = [0.7, -1.2]
+        data = []
+        for beam, shift in zip(mb.beams, truth):
+            beam.beam.add_ytrace_offset(shift)
+            data.append(2.5*beam.beam.compute_model())
+
+        mb.scif = np.hstack(data)
+        mb.sivarf = np.ones_like(mb.scif)
+        mb.fit_mask = np.ones(mb.scif.size, dtype=bool)
+        mb.DoF = mb.fit_mask.sum()
+
+        shifts, out = mb._linear_trace_shift([[0], [1]], tol=1.e-4,
+                                             max_iter=10, verbose=False)
+
+        np.testing.assert_allclose(shifts, truth, atol=1.e-3)
+        self.assertTrue(out['chi2'][-1] < out['chi2'][0])
+
+class FakeCatalog(dict):
+    """
+    Minimal catalog table with `NUMBER` and `X_WORLD`/`Y_WORLD` columns
+    """
+    @property
+    def colnames(self):
+        return list(self.keys())
+
+    def __len__(self):
+        return len(self['NUMBER'])
+
+class FakeIndex(object):
+    """
+    Exposure footprints as RA ranges
+    """
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.N = len(ranges)
+
+    def query(self, ra, dec):
+        return np.array([[(r >= r0) & (r < r1) for r0, r1 in self.ranges]
+                         for r in ra])
+
+class FakeCutoutFLT(object):
+    def __init__(self, ix, ra_range):
+        self.ix = ix
+        self.ra_range = ra_range
+        self.conf = None
+        self.grism = FakeImage()
+
+    def compute_model_orders(self, id=0, x=None, y=None, get_beams=None,
+                             **kwargs):
+        ra = FakeCutoutFLT.CATALOG_RA[id]
+        if (ra < self.ra_range[0]) | (ra >= self.ra_range[1]):
+            return False
+
+        return {'A':self.ix}
+
+class FakeCutout(object):
+    def __init__(self, flt=None, beam=None, **kwargs):
+        self.flt_index = beam
+        self.sh = (5, 20)
+        self.grism = {'SCI':np.ones(self.sh)}
+        self.model = np.ones(self.sh)
+        self.fit_mask = np.ones(100, dtype=bool)
+        self.beam = FakeBeam.Beam()
+        self.beam.total_flux = 1.
+
+class IndexedBeams(unittest.TestCase):
+    def test_get_beams_index(self):
+        from unittest import mock
+        from .. import model
+
+        ranges = [(0, 10), (5, 15), (20, 30)]
+        FakeCutoutFLT.CATALOG_RA = {1:7., 2:25., 3:12.}
+
+        grp = multifit.GroupFLT.__new__(multifit.GroupFLT)
+        grp.FLTs = [FakeCutoutFLT(i, r) for i, r in enumerate(ranges)]
+        grp.N = len(ranges)
+        grp._footprint_index = FakeIndex(ranges)
+        grp.catalog = FakeCatalog(NUMBER=np.array([1, 2, 3]),
+                                  X_WORLD=np.array([7., 25., 12.]),
+                                  Y_WORLD=np.zeros(3))
+
+        with mock.patch.object(model, 'BeamCutout', FakeCutout):
+            for id in [1, 2, 3]:
+                beams = grp.get_beams(id, use_index=True)
+                full = grp.get_beams(id, use_index=False)
+                self.assertEqual([b.flt_index for b in beams],
+                                 [b.flt_index for b in full])
+                self.assertTrue(len(beams) > 0)
+
+        # Row index is reused and reset with a new catalog
+        rows = grp._catalog_rows
+        grp.get_object_rd([1])
+        self.assertTrue(grp._catalog_rows is rows)
+
+        grp.catalog = FakeCatalog(NUMBER=np.array([3, 1]),
+                                  X_WORLD=np.array([12., 7.]),
+                                  Y_WORLD=np.zeros(2))
+        ra, dec = grp.get_object_rd([1, 2, 3])
+        np.testing.assert_array_equal(ra[[0, 2]], [7., 12.])
+        self.assertTrue(np.isnan(ra[1]))
@@ -3,8 +3,357 @@ import unittest
 import numpy as np
 from .. import utils
 
+class BoxFilter(object):
+    """
+    Top-hat filter for testing the filter integrations
+    """
+    def __init__(self, w0, w1):
+        self.wave = np.arange(w0-100, w1+100, 5.)
+        self.throughput = ((self.wave > w0) & (self.wave < w1))*1.
+        
 class Dummy(unittest.TestCase):  
     def test_log_zgrid(self):
         value = np.array([ 0.1       ,  0.21568801,  0.34354303,  0.48484469,  0.64100717, 0.8135934 ])
         np.testing.assert_allclose(utils.log_zgrid([0.1,1],0.1), value, rtol=1e-06, atol=0, equal_nan=False, err_msg='', verbose=True)
-  
\ No newline at end of file
+  
+    def test_interp_conserve_zgrid(self):
+        from ..utils_c.interp import interp_conserve_c
+        
+        x = np.linspace(8000, 11500, 200)
+        zgrid = utils.log_zgrid([0.1, 2.5], 0.05)
+        
+        wave = np.linspace(900, 2.e4, 3000)
+        flux = 1 + np.sin(wave/300.)
+        
+        out = utils.interp_conserve_zgrid(x, wave, flux, zgrid)
+        for i, z in enumerate(zgrid):
+            ref = interp_conserve_c(x, wave*(1+z), flux/(1+z))
+            np.testing.assert_allclose(out[i,:], ref, rtol=1.e-8, atol=1.e-10)
+    
+    def test_normal_equations_lsq(self):
+        import scipy.optimize
+        
+        rng = np.random.RandomState(1)
+        A = rng.normal(size=(200, 12)) + rng.normal(size=(200, 1))
+        A[:,0] *= 1.e4
+        b = A[:,:4].dot([1.e-4, 1, -1, 2]) + rng.normal(size=200)
+        AtA, Atb = A.T.dot(A), A.T.dot(b)
+        
+        x0, rnorm = scipy.optimize.nnls(A, b)
+        x1, free = utils.normal_equations_lsq(AtA, Atb)
+        np.testing.assert_allclose(x1, x0, rtol=1.e-8, atol=1.e-10)
+        np.testing.assert_array_equal(free, x0 > 0)
+        
+        # Warm start from a perturbed problem
+        x2, free2 = utils.normal_equations_lsq(AtA, Atb + 10, x0=x1, 
+                                               free=free)
+        x3, free3 = utils.normal_equations_lsq(AtA, Atb, x0=x2, free=free2)
+        np.testing.assert_allclose(x3, x0, rtol=1.e-8, atol=1.e-10)
+        
+        lower = -rng.uniform(size=12)
+        upper = rng.uniform(size=12)
+        lower[0], upper[0] = -np.inf, np.inf
+        out = scipy.optimize.lsq_linear(A, b, bounds=(lower, upper), 
+                                        method='bvls', tol=1.e-12)
+        
+        x4, free4 = utils.normal_equations_lsq(AtA, Atb, lower, upper)
+        np.testing.assert_allclose(x4, out.x, rtol=1.e-8, atol=1.e-10)
+        
+        # Ill-conditioned design matrix with nearly degenerate columns
+        # of very different scales
+        B = A*1
+        B[:,1] = (A[:,2] + 1.e-7*rng.normal(size=200))*1.e-8
+        BtB, Btb = B.T.dot(B), B.T.dot(b)
+        inf = np.ones(12)*np.inf
+        with self.assertRaises(np.linalg.LinAlgError):
+            utils.normal_equations_lsq(BtB, Btb, -inf, inf)
+    
+    def test_template_bank(self):
+        import os
+        import pickle
+        import tempfile
+        from collections import OrderedDict
+        
+        wave = np.arange(500, 3.e4, 1.)
+        templates = OrderedDict()
+        templates['cont'] = utils.SpectrumTemplate(wave=wave, 
+                                                   flux=(wave/5000.)**-1)
+        templates['line Ha'] = utils.SpectrumTemplate(central_wave=6564.61, 
+                                                      fwhm=1000, 
+                                                      velocity=True)
+        
+        bank = utils.TemplateBank(templates, wmin=400, wmax=4.e4)
+        self.assertEqual(list(bank.keys()), list(templates.keys()))
+        self.assertEqual(bank['line Ha'].fwhm, 1000)
+        
+        # Templates are views of the bank array
+        for i, k in enumerate(templates):
+            self.assertTrue(np.shares_memory(bank[k].flux, bank.flux[i]))
+            fi = np.interp(bank[k].wave, templates[k].wave, templates[k].flux)
+            np.testing.assert_allclose(bank[k].flux, fi, rtol=1.e-2, 
+                                       atol=1.e-3*fi.max())
+        
+        # File and pickle roundtrip
+        bank_file = os.path.join(tempfile.mkdtemp(), 'test.bank.fits')
+        bank.write(bank_file)
+        bank_mmap = utils.TemplateBank(file=bank_file)
+        self.assertTrue(np.shares_memory(bank_mmap['cont'].flux, 
+                                         bank_mmap.flux))
+        bank_copy = pickle.loads(pickle.dumps(bank_mmap))
+        np.testing.assert_allclose(bank_copy.flux, bank.flux)
+        np.testing.assert_allclose(bank_copy['line Ha'].flux, 
+                                   bank['line Ha'].flux)
+        
+        with self.assertRaises(TypeError):
+            bank['cont'] = templates['cont']
+    
+    def test_igm_table(self):
+        import tempfile
+        
+        try:
+            import eazy.igm
+        except ImportError:
+            self.skipTest('eazy not available')
+        
+        igm = eazy.igm.Inoue14()
+        table = utils.IGMTable(zmin=3, zmax=6, dz=0.01, 
+                               cache_dir=tempfile.mkdtemp())
+        
+        rng = np.random.RandomState(3)
+        for z in [3.005, 4.237, 5.891]:
+            lobs = np.sort(rng.uniform(800, 1400, size=500))*(1+z)
+            np.testing.assert_allclose(table.full_IGM(z, lobs), 
+                                       igm.full_IGM(z, lobs), atol=5.e-3)
+        
+        # Read back from the cache file
+        table2 = utils.IGMTable(zmin=3, zmax=6, dz=0.01, 
+                                cache_dir=table.cache_dir)
+        self.assertTrue(isinstance(table2.table, np.memmap))
+        
+        # Redshifts beyond zmax use the zmax transmission
+        wrest = np.linspace(800, 1400, 100)
+        igm_hi = table.full_IGM(7., wrest*8.)
+        np.testing.assert_allclose(igm_hi, table.full_IGM(6., wrest*7.))
+        self.assertTrue(np.all(np.isfinite(igm_hi)))
+        self.assertTrue(np.all((igm_hi >= 0) & (igm_hi <= 1)))
+        np.testing.assert_array_equal(igm_hi[wrest > 1300], 1.)
+        
+    def test_filter_matrix(self):
+        # Last filters partly and completely beyond the red end of `wave`
+        filters = [BoxFilter(8000, 9500), BoxFilter(9000, 1.3e4), 
+                   BoxFilter(2.4e4, 2.7e4), BoxFilter(2.8e4, 3.2e4)]
+        
+        wave = np.arange(5000, 2.5e4, 2.)
+        spec = utils.SpectrumTemplate(wave=wave, flux=(wave/1.e4)**-1.5)
+        
+        fnu = spec.integrate_filter_list(filters, use_wave='templ')
+        ref = [spec.integrate_filter(f, use_wave='templ') for f in filters]
+        np.testing.assert_allclose(fnu, ref, rtol=1.e-3)
+        self.assertTrue(fnu[-2] > 0)
+        self.assertEqual(fnu[-1], 0)
+        
+        # Spectrum outside of all of the filters
+        blue = utils.SpectrumTemplate(wave=np.arange(1000, 3000, 2.), 
+                                      flux=np.ones(1000))
+        fnu = blue.integrate_filter_list(filters, use_wave='filter')
+        np.testing.assert_array_equal(fnu, 0)
+        
+        # Batch of spectra with uncertainties
+        fmat = utils.get_filter_matrix(wave, filters)
+        flux = np.array([spec.flux, 2*spec.flux])
+        fnu2, efnu2 = fmat(flux, err=flux*0.1)
+        np.testing.assert_allclose(fnu2[1,:3], 2*fnu2[0,:3], rtol=1.e-8)
+        self.assertTrue(np.all(efnu2[:,:3] > 0))
+        self.assertTrue(np.all(efnu2[:,3] == 0))
+        
+    def test_template_filter_grid(self):
+        from collections import OrderedDict
+        
+        filters = [BoxFilter(8000, 9500), BoxFilter(1.1e4, 1.3e4)]
+        
+        wave = np.arange(500, 3.e4, 1.)
+        templates = OrderedDict()
+        templates['cont'] = utils.SpectrumTemplate(wave=wave, 
+                                                   flux=(wave/5000.)**-1)
+        
+        zgrid = utils.log_zgrid([0.5, 1.5], 0.01)
+        grid = utils.get_template_filter_grid(templates, filters, zgrid,
+                                              apply_igm=False)
+        
+        self.assertEqual(grid.grid.shape, (len(zgrid), 1, 2))
+        self.assertEqual(grid.templates_hash, utils.templates_hash(templates))
+        self.assertTrue(utils.get_template_filter_grid(templates, filters, 
+                                          zgrid, apply_igm=False) is grid)
+        
+        z = 0.5*(zgrid[10] + zgrid[11])
+        tz = templates['cont'].zscale(z, apply_igm=False)
+        ref = [tz.integrate_filter(f) for f in filters]
+        np.testing.assert_allclose(grid(z)[0], ref, rtol=1.e-3)
+    
+    def test_template_cache(self):
+        import os
+        import tempfile
+        from collections import OrderedDict
+        
+        wave = np.arange(500, 3.e4, 1.)
+        templates = OrderedDict()
+        templates['cont'] = utils.SpectrumTemplate(wave=wave, 
+                                                   flux=(wave/5000.)**-1,
+                                                   name='cont')
+        templates['line Ha'] = utils.SpectrumTemplate(central_wave=6564.61, 
+                                                      fwhm=1000, 
+                                                      velocity=True)
+        
+        cache_file = os.path.join(tempfile.mkdtemp(), 'templates_test.npy')
+        self.assertTrue(utils.read_template_cache(cache_file) is None)
+        self.assertTrue(utils.write_template_cache(cache_file, templates))
+        
+        cached = utils.read_template_cache(cache_file)
+        self.assertEqual(list(cached.keys()), list(templates.keys()))
+        self.assertEqual(cached['line Ha'].fwhm, 1000)
+        self.assertEqual(cached['cont'].name, 'cont')
+        for k in templates:
+            np.testing.assert_allclose(cached[k].flux, templates[k].flux)
+            np.testing.assert_allclose(cached[k].flux_fnu, 
+                                       templates[k].flux_fnu)
+        
+        # Hash changes with the arguments
+        f1 = utils.template_cache_file([1200, True])
+        self.assertEqual(f1, utils.template_cache_file([1200, True]))
+        self.assertNotEqual(f1, utils.template_cache_file([1000, True]))
+    
+    def test_footprint_index(self):
+        import os
+        import tempfile
+        
+        # Squares across RA=0
+        fp = [np.array([[359.9, 0.], [0.1, 0.], [0.1, 0.2], [359.9, 0.2]]), 
+              np.array([[0.05, 0.1], [0.3, 0.1], [0.3, 0.3], [0.05, 0.3]])]
+        
+        index = utils.FootprintIndex(fp, labels=['a', 'b'])
+        contains = index.query([359.95, 0.07, 0.2, 10.], [0.05, 0.15, 0.25, 0.])
+        np.testing.assert_array_equal(contains, [[True, False], 
+                                                 [True, True], 
+                                                 [False, True],
+                                                 [False, False]])
+        
+        fp_file = os.path.join(tempfile.mkdtemp(), 'test.footprints.fits')
+        index.write(fp_file)
+        index2 = utils.FootprintIndex(file=fp_file)
+        self.assertEqual(index2.labels, ['a', 'b'])
+        np.testing.assert_array_equal(index2.query_indices(0.07, 0.15), [0, 1])
+    
+    def test_overlapping_footprint_pairs(self):
+        from shapely.geometry import box
+        
+        fps = [box(0, 0, 1, 1), box(2, 2, 3, 3), box(0.5, 0.5, 2.5, 2.5), 
+               box(1, 0, 2, 1), box(10, 10, 11, 11)]
+        
+        # Touching edges (0, 3) have zero overlap area
+        neighbors = utils.overlapping_footprint_pairs(fps)
+        self.assertEqual(neighbors, [[2], [2], [0, 1, 3], [2], []])
+        
+        # Brute force
+        for i in range(len(fps)):
+            olap = [j for j in range(len(fps)) 
+                    if (j != i) & (fps[i].intersection(fps[j]).area > 0)]
+            self.assertEqual(neighbors[i], olap)
+    
+    def test_get_flt_info(self):
+        import os
+        import gzip
+        import shutil
+        import tempfile
+        import astropy.io.fits as pyfits
+        
+        path = tempfile.mkdtemp()
+        
+        h = pyfits.Header()
+        h['INSTRUME'] = 'WFC3'
+        h['FILTER'] = 'F140W'
+        h['EXPTIME'] = 100.
+        sci = pyfits.ImageHDU(data=np.zeros((16, 16), dtype=np.float32), 
+                              name='SCI')
+        sci.header['EXTVER'] = 1
+        sci.header['CRPIX1'] = 8.
+        hdu = pyfits.HDUList([pyfits.PrimaryHDU(header=h), sci])
+        
+        files = [os.path.join(path, 'ix0001a1q_flt.fits'), 
+                 os.path.join(path, 'ix0001a2q_flt.fits.gz')]
+        hdu.writeto(files[0])
+        with open(files[0], 'rb') as f_in:
+            with gzip.open(files[1], 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        
+        for file in files:
+            self.assertEqual(utils.read_fits_header(file)['FILTER'], 'F140W')
+            h1 = utils.read_fits_header(file, ext=('SCI',1))
+            self.assertEqual(h1['CRPIX1'], 8.)
+        
+        columns = ['FILE', 'FILTER', 'EXPTIME', 'PA_V3']
+        info = utils.get_flt_info(files, columns=columns, max_workers=2)
+        self.assertEqual(list(info['FILE']), ['ix0001a1q_flt.fits', 
+                                              'ix0001a2q_flt.fits'])
+        np.testing.assert_allclose(info['EXPTIME'], 100.)
+        self.assertTrue(np.isnan(info['PA_V3'][0]))
+        cache_file = os.path.join(path, utils.FLT_INFO_CACHE_FILE)
+        self.assertTrue(os.path.exists(cache_file))
+        
+        # Cached values are used if the file hasn't changed
+        import json
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+        
+        cache[os.path.abspath(files[0])]['row']['EXPTIME'] = 200.
+        with open(cache_file, 'w') as fp:
+            json.dump(cache, fp)
+        
+        cached = utils.get_flt_info(files, columns=columns)
+        np.testing.assert_allclose(cached['EXPTIME'], [200., 100.])
+        
+        st = os.stat(files[0])
+        os.utime(files[0], (st.st_atime, st.st_mtime+10))
+        cached = utils.get_flt_info(files, columns=columns)
+        np.testing.assert_allclose(cached['EXPTIME'], 100.)
+    
+    def test_blot_pixel_map(self):
+        import os
+        import tempfile
+        from unittest import mock
+        import astropy.wcs as pywcs
+        
+        in_wcs = pywcs.WCS(naxis=2)
+        in_wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+        in_wcs.wcs.crval = [150., 2.]
+        in_wcs.wcs.crpix = [50., 50.]
+        in_wcs.wcs.cd = np.array([[-1., 0], [0, 1.]])*0.1/3600.
+        in_wcs.pixel_shape = (100, 100)
+        
+        out_wcs = in_wcs.deepcopy()
+        out_wcs.wcs.crpix = [20., 30.]
+        out_wcs.pixel_shape = (40, 60)
+        
+        in_data = np.arange(100*100, dtype=np.float32).reshape((100, 100))+1
+        cache_dir = tempfile.mkdtemp()
+        
+        with mock.patch.object(utils, 'BLOT_PIXEL_MAP_DIR', cache_dir):
+            utils.BLOT_PIXEL_MAPS.clear()
+            blotted = utils.blot_nearest_exact(in_data, in_wcs, out_wcs, 
+                                               use_cache=False)
+            
+            # Pure shift by (30, 20) pixels
+            np.testing.assert_allclose(blotted, in_data[20:80, 30:70])
+            
+            cached = utils.blot_nearest_exact(in_data, in_wcs, out_wcs)
+            np.testing.assert_allclose(cached, blotted)
+            self.assertEqual(len(utils.BLOT_PIXEL_MAPS), 1)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            
+            # Read from disk
+            utils.BLOT_PIXEL_MAPS.clear()
+            xi, yi, xo, yo = utils.blot_pixel_map(in_wcs, out_wcs)
+            self.assertEqual(xi.dtype, np.uint16)
+            np.testing.assert_array_equal(xi, xo+30)
+            np.testing.assert_array_equal(yi, yo+20)
+        
+        utils.BLOT_PIXEL_MAPS.clear()
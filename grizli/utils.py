@@ -92,13 +92,122 @@ def set_warnings(numpy_level='ignore', astropy_level='ignore'):
     np.seterr(all=numpy_level)
     warnings.simplefilter(astropy_level, category=AstropyWarning)
     
-def get_flt_info(files=[], columns=['FILE', 'FILTER', 'INSTRUME', 'DETECTOR', 'TARGNAME', 'DATE-OBS', 'TIME-OBS', 'EXPSTART', 'EXPTIME', 'PA_V3', 'RA_TARG', 'DEC_TARG', 'POSTARG1', 'POSTARG2']):
+FLT_INFO_CACHE_FILE = '.flt_info_cache.json'
+
+def read_fits_header(file, ext=0):
+    """Read a single header from a FITS file without reading any data
+    
+    The file is read in 2880-byte FITS records up to the ``END`` card of the 
+    requested extension.  Gzipped files (``.gz``) are decompressed as a 
+    stream, so only the leading part of a large file is inflated for the 
+    primary header.
+    
+    Parameters
+    ----------
+    file : str
+        FITS filename, optionally gzipped.
+    
+    ext : int, tuple
+        Extension number or ``(EXTNAME, EXTVER)``, e.g., ('SCI',1).
+    
+    Returns
+    -------
+    header : `~astropy.io.fits.Header`
+        Header object.
+        
+    """
+    import gzip
+    
+    BLOCK = 2880
+    
+    if file.endswith('.gz'):
+        fp = gzip.open(file, 'rb')
+    else:
+        fp = open(file, 'rb')
+    
+    try:
+        iext = 0
+        while True:
+            data = b''
+            while True:
+                block = fp.read(BLOCK)
+                if len(block) < BLOCK:
+                    raise IOError('{0}: extension {1} not found'.format(file,
+                                                                       ext))
+                    
+                data += block
+                cards = [block[i:i+80] for i in range(0, BLOCK, 80)]
+                if b'END' + b' '*77 in cards:
+                    break
+            
+            h = pyfits.Header.fromstring(data.decode('ascii'))
+            if isinstance(ext, tuple):
+                extname = h.get('EXTNAME', '')
+                if (extname == ext[0]) & (h.get('EXTVER', 1) == ext[1]):
+                    return h
+            elif iext == ext:
+                return h
+                
+            # Skip the data block
+            naxis = [h['NAXIS{0}'.format(i+1)] for i in range(h['NAXIS'])]
+            nbytes = int(np.prod(naxis))*(h['NAXIS'] > 0)
+            nbytes = (nbytes + h.get('PCOUNT', 0))*h.get('GCOUNT', 1)
+            nbytes *= np.abs(h['BITPIX'])//8
+            if nbytes % BLOCK > 0:
+                nbytes += BLOCK - nbytes % BLOCK
+            
+            fp.seek(nbytes, 1)
+            iext += 1
+    finally:
+        fp.close()
+    
+def flt_info_row(file, columns=['FILE', 'FILTER']):
+    """Header keywords of a single exposure for `get_flt_info`
+    
+    Returns
+    -------
+    row : dict
+        Dictionary of the values of `columns`, where the first two entries 
+        are taken to be the filename and the filter name from 
+        `get_hst_filter` and missing keywords are set to `np.nan`.
+    """
+    h = read_fits_header(file, ext=0)
+    row = OrderedDict()
+    row[columns[0]] = os.path.basename(file).split('.gz')[0]
+    row[columns[1]] = get_hst_filter(h)
+    
+    for key in columns[2:]:
+        value = h[key] if key in h else np.nan
+        if not isinstance(value, (str, bool, int, float)):
+            value = np.nan
+            
+        row[key] = value
+    
+    return row
+    
+def get_flt_info(files=[], columns=['FILE', 'FILTER', 'INSTRUME', 'DETECTOR', 'TARGNAME', 'DATE-OBS', 'TIME-OBS', 'EXPSTART', 'EXPTIME', 'PA_V3', 'RA_TARG', 'DEC_TARG', 'POSTARG1', 'POSTARG2'], use_cache=True, max_workers=8):
     """Extract header information from a list of FLT files
     
+    Only the primary headers are read (`read_fits_header`), in a pool of
+    `max_workers` threads.  With `use_cache`, the header values are stored 
+    in a sidecar file `FLT_INFO_CACHE_FILE` in the directory of each file,
+    keyed by the filename, size and modification time, so only new or 
+    modified files are read on subsequent calls.
+    
     Parameters
     -----------
     files : list
         List of exposure filenames.
+    
+    columns : list
+        Header keywords to extract.  The first two columns are always the 
+        filename and the filter name from `get_hst_filter`.
+        
+    use_cache : bool
+        Read and update the cache files.
+    
+    max_workers : int
+        Number of threads for reading headers.  Run serially if < 2.
         
     Returns
     --------
@@ -106,41 +215,110 @@ def get_flt_info(files=[], columns=['FILE', 'FILTER', 'INSTRUME', 'DETECTOR', 'T
         Table containing header keywords
         
     """
-    import astropy.io.fits as pyfits
+    import json
+    from concurrent.futures import ThreadPoolExecutor
     from astropy.table import Table
     
     if not files:
         files=glob.glob('*flt.fits')
     
     N = len(files)
+    columns = ['FILE', 'FILTER'] + list(columns[2:])
+    
+    # File properties for the cache keys
+    paths = [os.path.abspath(file) for file in files]
+    stats = [(os.stat(path).st_size, os.stat(path).st_mtime) 
+             for path in paths]
+    
+    cache = OrderedDict()
+    if use_cache:
+        for cache_dir in np.unique([os.path.dirname(p) for p in paths]):
+            cache_file = os.path.join(cache_dir, FLT_INFO_CACHE_FILE)
+            if not os.path.exists(cache_file):
+                continue
+            
+            try:
+                with open(cache_file) as fp:
+                    cache.update(json.load(fp))
+            except:
+                print('get_flt_info: couldn\'t read {0}'.format(cache_file))
     
-    data = []
-        
+    rows = [None]*N
     for i in range(N):
-        line = [os.path.basename(files[i]).split('.gz')[0]]
-        if files[i].endswith('.gz'):
-            im = pyfits.open(files[i])
-            h = im[0].header
+        if paths[i] not in cache:
+            continue
+            
+        entry = cache[paths[i]]
+        if (entry['size'], entry['mtime']) != stats[i]:
+            continue
+            
+        if np.all([c in entry['row'] for c in columns]):
+            rows[i] = entry['row']
+    
+    missing = [i for i in range(N) if rows[i] is None]
+    if len(missing) > 0:
+        scan_files = [files[i] for i in missing]
+        if (max_workers > 1) & (len(missing) > 1):
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                scanned = list(pool.map(flt_info_row, scan_files, 
+                                        [columns]*len(missing)))
         else:
-            h = pyfits.Header().fromfile(files[i])
-        
-        filt = get_hst_filter(h)
-        line.append(filt)
-        has_columns = ['FILE', 'FILTER']
+            scanned = [flt_info_row(file, columns) for file in scan_files]
+            
+        for i, row in zip(missing, scanned):
+            rows[i] = row
+            
+            # Keep other columns of an existing entry for the same file
+            if paths[i] in cache:
+                entry = cache[paths[i]]
+                if (entry['size'], entry['mtime']) == stats[i]:
+                    for c in entry['row']:
+                        if c not in row:
+                            row[c] = entry['row'][c]
+            
+            cache[paths[i]] = {'size':stats[i][0], 'mtime':stats[i][1], 
+                               'row':row}
         
-        for key in columns[2:]:
-            has_columns.append(key)
-            if key in h:
-                line.append(h[key])
-            else:
-                line.append(np.nan)
-                continue
-                
-        data.append(line)
+        if use_cache:
+            for cache_dir in np.unique([os.path.dirname(paths[i]) 
+                                        for i in missing]):
+                write_flt_info_cache(cache_dir, cache)
     
-    tab = Table(rows=data, names=has_columns)
+    data = [[rows[i][c] for c in columns] for i in range(N)]
+    tab = Table(rows=data, names=columns)
     return tab
 
+def write_flt_info_cache(cache_dir, cache):
+    """Write the `get_flt_info` cache entries for files in `cache_dir`
+    
+    The cache is written to a temporary file first, so parallel processes 
+    don't read partial files.
+    
+    Returns
+    -------
+    status : bool
+        The file was written.
+    """
+    import json
+    
+    entries = OrderedDict()
+    for path in cache:
+        if os.path.dirname(path) == cache_dir:
+            entries[path] = cache[path]
+    
+    cache_file = os.path.join(cache_dir, FLT_INFO_CACHE_FILE)
+    tmp = cache_file+'.{0}'.format(os.getpid())
+    try:
+        with open(tmp, 'w') as fp:
+            json.dump(entries, fp)
+        
+        os.rename(tmp, cache_file)
+    except:
+        print('write_flt_info_cache: couldn\'t write {0}'.format(cache_file))
+        return False
+    
+    return True
+
 def radec_to_targname(ra=0, dec=0, round_arcsec=(4, 60), precision=2, targstr='j{rah}{ram}{ras}{sign}{ded}{dem}', header=None):
     """Turn decimal degree coordinates into a string with rounding.
 
@@ -227,70 +405,93 @@ def radec_to_targname(ra=0, dec=0, round_arcsec=(4, 60), precision=2, targstr='j
 
     return targname
     
-def blot_nearest_exact(in_data, in_wcs, out_wcs, verbose=True, stepsize=-1, 
-                       scale_by_pixel_area=False, wcs_mask=True, 
-                       fill_value=0):
+# Cached `blot_pixel_map` output, keyed by `wcs_hash` of the two WCS
+BLOT_PIXEL_MAPS = OrderedDict()
+MAX_BLOT_PIXEL_MAPS = 8
+
+# Directory for pixel maps cached on disk.  The default False only caches 
+# them in memory, and None uses grizli_cache_dir('pixel_maps').  Nothing 
+# is removed from the directory, which should be cleaned up by the user.
+BLOT_PIXEL_MAP_DIR = False
+
+def wcs_hash(wcs):
+    """MD5 hash of a WCS header, including image dimensions and distortion
+    lookup tables
     """
-    Own blot function for blotting exact pixels without rescaling for input 
-    and output pixel size
+    import hashlib
     
-    test
+    md5 = hashlib.md5()
+    md5.update(to_header(wcs, relax=True).tostring().encode('utf-8'))
+    for attr in ['cpdis1', 'cpdis2', 'det2im1', 'det2im2']:
+        table = getattr(wcs, attr, None)
+        if table is None:
+            continue
+        
+        md5.update(attr.encode('utf-8'))
+        md5.update(np.ascontiguousarray(table.data, dtype=float))
+        for arr in [table.crpix, table.crval, table.cdelt]:
+            md5.update(np.ascontiguousarray(arr, dtype=float))
+    
+    return md5.hexdigest()
+    
+def blot_pixel_map(in_wcs, out_wcs, stepsize=-1, wcs_mask=True, 
+                   verbose=True, use_cache=True):
+    """Nearest-pixel map from `in_wcs` to `out_wcs` for `blot_nearest_exact`
+    
+    With `use_cache`, the maps are stored in memory in `BLOT_PIXEL_MAPS`, 
+    and on disk in `BLOT_PIXEL_MAP_DIR` if that is set, keyed by hashes of 
+    both WCS, so the distortion transformations are only computed once for
+    a given pair of images.
     
     Parameters
     ----------
-    in_data : `~numpy.ndarray`
-        Input data to blot.
-    
-    in_wcs : `~astropy.wcs.WCS`
-        Input WCS.  Must have _naxis1, _naxis2 or pixel_shape attributes.
-        
-    out_wcs : `~astropy.wcs.WCS`
-        Output WCS.  Must have _naxis1, _naxis2 or pixel_shape attributes.
-   
-    scale_by_pixel_area : bool
-        If True, then scale the output image by the square of the image pixel
-        scales (out**2/in**2), i.e., the pixel areas.
+    in_wcs, out_wcs : `~astropy.wcs.WCS`
+        Input and output WCS.  Must have _naxis1, _naxis2 or pixel_shape 
+        attributes.
     
-    wcs_mask : bool
-        Use fast WCS masking.  If False, use `pyregion`.
+    stepsize, wcs_mask : int, bool
+        See `blot_nearest_exact`.
     
-    fill_value : int/float
-        Value in `out_data` not covered by `in_data`.
-        
     Returns
     -------
-    out_data : `~numpy.ndarray`
-        Blotted data.
-    
+    xi, yi, xo, yo : array-like
+        Pixel indices such that ``out[yo, xo] = in[yi, xi]``, as unsigned 
+        16-bit integers if the image dimensions allow.  None if the images 
+        don't overlap.
+        
     """
     from shapely.geometry import Polygon
-    import pyregion
-    import scipy.ndimage as nd
-    from drizzlepac import cdriz
     
-    try:
-        from .utils_c.interp import pixel_map_c
-    except:
-        from grizli.utils_c.interp import pixel_map_c
+    if use_cache:
+        key = '{0}_{1}_{2}_{3}'.format(wcs_hash(in_wcs), wcs_hash(out_wcs),
+                                       stepsize, wcs_mask)
+        key = key.replace('-', 'm')
         
-    if False:
-        # Testing
-        im = pyfits.open('jbhj40-bhj-40-000.0-f814w_drc_sci.fits')
-        out = pyfits.open('jbhj40hbq_flc.fits')
-
-        in_data = im[0].data
-        in_wcs = pywcs.WCS(im[0].header)
+        if key in BLOT_PIXEL_MAPS:
+            BLOT_PIXEL_MAPS.move_to_end(key)
+            return BLOT_PIXEL_MAPS[key]
         
-        ext = 1
-        out_wcs = pywcs.WCS(out['SCI',ext].header, fobj=out)
-
-        out_data = utils.blot_nearest_exact(in_data, in_wcs, out_wcs)
+        if BLOT_PIXEL_MAP_DIR is None:
+            cache_dir = grizli_cache_dir('pixel_maps')
+        else:
+            cache_dir = BLOT_PIXEL_MAP_DIR
         
-        # Try HSTWCS
-        from stwcs.wcsutil import HSTWCS
-        source_wcs = HSTWCS(fobj=out, ext=('SCI',ext), minerr=0.0, wcskey=' ')
-        blot_wcs = HSTWCS(fobj=im, ext=(0), minerr=0.0, wcskey=' ')
-    
+        if cache_dir is False:
+            cache_file = None
+        else:
+            cache_file = os.path.join(cache_dir, 
+                                      'pixel_map_{0}.npz'.format(key))
+            
+        if (cache_file is not None) and os.path.exists(cache_file):
+            with np.load(cache_file) as npz:
+                pixel_map = tuple([npz[c] for c in ['xi', 'yi', 'xo', 'yo']])
+            
+            BLOT_PIXEL_MAPS[key] = pixel_map
+            while len(BLOT_PIXEL_MAPS) > MAX_BLOT_PIXEL_MAPS:
+                BLOT_PIXEL_MAPS.popitem(last=False)
+                
+            return pixel_map
+            
     # Shapes, in numpy array convention (y, x)
     if hasattr(in_wcs, 'pixel_shape'):  
         in_sh = in_wcs.pixel_shape[::-1]
@@ -312,7 +513,7 @@ def blot_nearest_exact(in_data, in_wcs, out_wcs, verbose=True, stepsize=-1,
     if olap.area == 0:
         if verbose:
             print('No overlap')
-        return np.zeros(out_sh)
+        return None
     
     # Region mask for speedup
     if np.isclose(olap.area, out_poly.area, 0.01):
@@ -326,6 +527,7 @@ def blot_nearest_exact(in_data, in_wcs, out_wcs, verbose=True, stepsize=-1,
         pts = np.array([xp.flatten(), yp.flatten()]).T
         mask = out_xy_path.contains_points(pts).reshape(out_sh) 
     else:
+        import pyregion
         olap_poly = np.array(olap.exterior.xy)
         poly_reg = "fk5\npolygon("+','.join(['{0}'.format(p) for p in olap_poly.T.flatten()])+')\n'
         reg = pyregion.parse(poly_reg)
@@ -339,6 +541,8 @@ def blot_nearest_exact(in_data, in_wcs, out_wcs, verbose=True, stepsize=-1,
         rd = out_wcs.all_pix2world(xo, yo, 0)
         xf, yf = in_wcs.all_world2pix(rd[0], rd[1], 0)
     else:
+        from drizzlepac import cdriz
+        
         ## Seems backwards and doesn't quite agree with above
         blot_wcs = out_wcs
         source_wcs = in_wcs
@@ -355,7 +559,93 @@ def blot_nearest_exact(in_data, in_wcs, out_wcs, verbose=True, stepsize=-1,
     xi, yi = np.cast[int](np.round(xf)), np.cast[int](np.round(yf))
         
     m2 = (xi >= 0) & (yi >= 0) & (xi < in_sh[1]) & (yi < in_sh[0])
-    xi, yi, xf, yf, xo, yo = xi[m2], yi[m2], xf[m2], yf[m2], xo[m2], yo[m2]
+    
+    if np.max(list(in_sh) + list(out_sh)) < 2**16:
+        itype = np.uint16
+    else:
+        itype = np.int32
+        
+    pixel_map = tuple([arr[m2].astype(itype) for arr in [xi, yi, xo, yo]])
+    
+    if use_cache:
+        BLOT_PIXEL_MAPS[key] = pixel_map
+        while len(BLOT_PIXEL_MAPS) > MAX_BLOT_PIXEL_MAPS:
+            BLOT_PIXEL_MAPS.popitem(last=False)
+        
+        if cache_file is not None:
+            tmp = cache_file+'.{0}'.format(os.getpid())
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir)
+                
+                with open(tmp, 'wb') as fp:
+                    np.savez(fp, xi=pixel_map[0], yi=pixel_map[1], 
+                             xo=pixel_map[2], yo=pixel_map[3])
+                
+                os.rename(tmp, cache_file)
+            except:
+                print('blot_pixel_map: couldn\'t write {0}'.format(cache_file))
+    
+    return pixel_map
+    
+def blot_nearest_exact(in_data, in_wcs, out_wcs, verbose=True, stepsize=-1, 
+                       scale_by_pixel_area=False, wcs_mask=True, 
+                       fill_value=0, use_cache=True):
+    """
+    Own blot function for blotting exact pixels without rescaling for input 
+    and output pixel size
+    
+    test
+    
+    Parameters
+    ----------
+    in_data : `~numpy.ndarray`
+        Input data to blot.
+    
+    in_wcs : `~astropy.wcs.WCS`
+        Input WCS.  Must have _naxis1, _naxis2 or pixel_shape attributes.
+        
+    out_wcs : `~astropy.wcs.WCS`
+        Output WCS.  Must have _naxis1, _naxis2 or pixel_shape attributes.
+   
+    scale_by_pixel_area : bool
+        If True, then scale the output image by the square of the image pixel
+        scales (out**2/in**2), i.e., the pixel areas.
+    
+    wcs_mask : bool
+        Use fast WCS masking.  If False, use `pyregion`.
+    
+    fill_value : int/float
+        Value in `out_data` not covered by `in_data`.
+    
+    use_cache : bool
+        Use cached pixel maps for the pair of WCS, see `blot_pixel_map`.
+        
+    Returns
+    -------
+    out_data : `~numpy.ndarray`
+        Blotted data.
+    
+    """
+    import scipy.ndimage as nd
+    
+    try:
+        from .utils_c.interp import pixel_map_c
+    except:
+        from grizli.utils_c.interp import pixel_map_c
+        
+    if hasattr(out_wcs, 'pixel_shape'):
+        out_sh = out_wcs.pixel_shape[::-1]
+    else:
+        out_sh = (out_wcs._naxis2, out_wcs._naxis1)
+    
+    pixel_map = blot_pixel_map(in_wcs, out_wcs, stepsize=stepsize, 
+                               wcs_mask=wcs_mask, verbose=verbose, 
+                               use_cache=use_cache)
+    if pixel_map is None:
+        return np.zeros(out_sh)
+        
+    xi, yi, xo, yo = [np.cast[int](arr) for arr in pixel_map]
     
     out_data = np.ones(out_sh, dtype=np.float)*fill_value
     status = pixel_map_c(np.cast[np.float](in_data), xi, yi, out_data, xo, yo)
@@ -725,7 +1015,66 @@ def get_visit_footprints(visits):
     
     return visits
     
-def parse_visit_overlaps(visits, buffer=15.):
+def overlapping_footprint_pairs(footprints):
+    """Find all pairs of footprints that overlap with nonzero area
+    
+    Candidate pairs are found with a `shapely.strtree.STRtree` spatial index
+    (or a vectorized bounding-box test if that isn't available) and then
+    checked with the exact polygon intersection.
+    
+    Parameters
+    ----------
+    footprints : list of `~shapely.geometry.Polygon`
+        Footprint polygons.
+    
+    Returns
+    -------
+    neighbors : list of lists
+        ``neighbors[i]`` is the sorted list of indices ``j != i`` where
+        ``footprints[i].intersection(footprints[j]).area > 0``.
+    
+    """
+    N = len(footprints)
+    neighbors = [[] for i in range(N)]
+    if N == 0:
+        return neighbors
+        
+    try:
+        from shapely.strtree import STRtree
+        tree = STRtree(footprints)
+        geom_index = {id(fp): k for k, fp in enumerate(footprints)}
+    except ImportError:
+        tree = None
+        bounds = np.array([fp.bounds for fp in footprints])
+    
+    for i in range(N):
+        if tree is not None:
+            res = tree.query(footprints[i])
+            # shapely>=2 returns indices, earlier versions the geometries
+            if (len(res) > 0) and hasattr(res[0], 'bounds'):
+                cand = [geom_index[id(g)] for g in res]
+            else:
+                cand = list(res)
+        else:
+            bi = bounds[i]
+            cand = np.where((bounds[:,0] <= bi[2]) & (bounds[:,2] >= bi[0]) &
+                            (bounds[:,1] <= bi[3]) & (bounds[:,3] >= bi[1]))[0]
+        
+        for j in cand:
+            j = int(j)
+            if j <= i:
+                continue
+            
+            if footprints[i].intersection(footprints[j]).area > 0:
+                neighbors[i].append(j)
+                neighbors[j].append(i)
+    
+    for i in range(N):
+        neighbors[i].sort()
+        
+    return neighbors
+    
+def parse_visit_overlaps(visits, buffer=15., use_index=True):
     """Find overlapping visits/filters to make combined mosaics
     
     Parameters
@@ -740,6 +1089,12 @@ def parse_visit_overlaps(visits, buffer=15.):
         Buffer, in `~astropy.units.arcsec`, to add around visit footprints to 
         look for overlaps.
     
+    use_index : bool
+        Compute the visit footprints once and find overlapping pairs with a 
+        spatial index (`~grizli.utils.overlapping_footprint_pairs`) rather 
+        than comparing every visit with all later visits.  The groups are 
+        the same as with the brute-force loop (``use_index=False``).
+        
     Returns
     -------
     exposure_groups : list
@@ -747,6 +1102,7 @@ def parse_visit_overlaps(visits, buffer=15.):
         
     """
     import copy
+    import heapq
     from shapely.geometry import Polygon
     
     N = len(visits)
@@ -754,44 +1110,88 @@ def parse_visit_overlaps(visits, buffer=15.):
     exposure_groups = []
     used = np.arange(len(visits)) < 0
     
-    for i in range(N):
-        f_i = visits[i]['product'].split('-')[-1]
-        if used[i]:
-            continue
-        
-        if 'footprint' in visits[i]:
-            fp_i = visits[i]['footprint'].buffer(buffer/3600.)
-        else:
-            im_i = pyfits.open(glob.glob(visits[i]['product']+'_dr?_sci.fits')[0])
-            wcs_i = pywcs.WCS(im_i[0])
-            fp_i = Polygon(wcs_i.calc_footprint()).buffer(buffer/3600.)
+    if use_index:
+        footprints = []
+        for i in range(N):
+            if 'footprint' in visits[i]:
+                fp_i = visits[i]['footprint'].buffer(buffer/3600.)
+            else:
+                dr_file = glob.glob(visits[i]['product']+'_dr?_sci.fits')[0]
+                wcs_i = pywcs.WCS(pyfits.getheader(dr_file, 0))
+                fp_i = Polygon(wcs_i.calc_footprint()).buffer(buffer/3600.)
             
-        exposure_groups.append(copy.deepcopy(visits[i]))
+            footprints.append(fp_i)
+        
+        filters = [v['product'].split('-')[-1] for v in visits]
+        neighbors = overlapping_footprint_pairs(footprints)
         
-        for j in range(i+1, N):
-            f_j = visits[j]['product'].split('-')[-1]
-            if (f_j != f_i) | (used[j]):
+        for i in range(N):
+            if used[i]:
                 continue
             
-            #
-            if 'footprint' in visits[j]:
-                fp_j = visits[j]['footprint'].buffer(buffer/3600.)
-            else:
-                im_j = pyfits.open(glob.glob(visits[j]['product']+'_dr?_sci.fits')[0])
-                wcs_j = pywcs.WCS(im_j[0])
-                fp_j = Polygon(wcs_j.calc_footprint()).buffer(buffer/3600.)
+            exposure_groups.append(copy.deepcopy(visits[i]))
+            
+            # Visits are added in increasing index order, and a visit joins 
+            # the group if it overlaps any member added before it, which 
+            # is the same as the test against the growing union polygon 
+            # in the brute-force loop below.
+            fp_i = footprints[i]
+            queue = [j for j in neighbors[i] 
+                     if (j > i) & (filters[j] == filters[i]) & (~used[j])]
+            heapq.heapify(queue)
+            while len(queue) > 0:
+                j = heapq.heappop(queue)
+                if used[j]:
+                    continue
                 
-            # im_j = pyfits.open(glob.glob(visits[j]['product']+'_dr?_sci.fits')[0])
-            # wcs_j = pywcs.WCS(im_j[0])
-            # fp_j = Polygon(wcs_j.calc_footprint()).buffer(buffer/3600.)
-            
-            olap = fp_i.intersection(fp_j)
-            if olap.area > 0:
                 used[j] = True
-                fp_i = fp_i.union(fp_j)
+                fp_i = fp_i.union(footprints[j])
                 exposure_groups[-1]['footprint'] = fp_i
                 exposure_groups[-1]['files'].extend(visits[j]['files'])
                 
+                for k in neighbors[j]:
+                    if (k > j) & (filters[k] == filters[i]) & (~used[k]):
+                        heapq.heappush(queue, k)
+    
+    else:
+        for i in range(N):
+            f_i = visits[i]['product'].split('-')[-1]
+            if used[i]:
+                continue
+        
+            if 'footprint' in visits[i]:
+                fp_i = visits[i]['footprint'].buffer(buffer/3600.)
+            else:
+                im_i = pyfits.open(glob.glob(visits[i]['product']+'_dr?_sci.fits')[0])
+                wcs_i = pywcs.WCS(im_i[0])
+                fp_i = Polygon(wcs_i.calc_footprint()).buffer(buffer/3600.)
+            
+            exposure_groups.append(copy.deepcopy(visits[i]))
+        
+            for j in range(i+1, N):
+                f_j = visits[j]['product'].split('-')[-1]
+                if (f_j != f_i) | (used[j]):
+                    continue
+            
+                #
+                if 'footprint' in visits[j]:
+                    fp_j = visits[j]['footprint'].buffer(buffer/3600.)
+                else:
+                    im_j = pyfits.open(glob.glob(visits[j]['product']+'_dr?_sci.fits')[0])
+                    wcs_j = pywcs.WCS(im_j[0])
+                    fp_j = Polygon(wcs_j.calc_footprint()).buffer(buffer/3600.)
+                
+                # im_j = pyfits.open(glob.glob(visits[j]['product']+'_dr?_sci.fits')[0])
+                # wcs_j = pywcs.WCS(im_j[0])
+                # fp_j = Polygon(wcs_j.calc_footprint()).buffer(buffer/3600.)
+            
+                olap = fp_i.intersection(fp_j)
+                if olap.area > 0:
+                    used[j] = True
+                    fp_i = fp_i.union(fp_j)
+                    exposure_groups[-1]['footprint'] = fp_i
+                    exposure_groups[-1]['files'].extend(visits[j]['files'])
+                
     for i in range(len(exposure_groups)):
         flt_i = pyfits.open(exposure_groups[i]['files'][0])
         product = flt_i[0].header['TARGNAME'].lower()        
@@ -1793,6 +2193,222 @@ def emission_line_templates():
         line_templates[t] = utils.SpectrumTemplate(wave=wave, flux=neb_only, name='fsps_{0}_lines'.format(t))
         
     
+def grizli_cache_dir(*subdirs):
+    """User directory for cached files generated by grizli
+    
+    ``$GRIZLI_CACHE`` if set, otherwise ``$XDG_CACHE_HOME/grizli`` or 
+    ``~/.cache/grizli``, rather than the `GRIZLI_PATH` data directory, 
+    which can be the read-only package installation.
+    
+    Parameters
+    ----------
+    subdirs : str
+        Subdirectories appended to the path.
+    
+    Returns
+    -------
+    path : str
+        Directory path, which isn't created here.
+    """
+    path = os.getenv('GRIZLI_CACHE')
+    if path is None:
+        xdg_cache = os.getenv('XDG_CACHE_HOME', 
+                              os.path.join(os.path.expanduser('~'), '.cache'))
+        path = os.path.join(xdg_cache, 'grizli')
+    
+    return os.path.join(path, *subdirs)
+    
+# Lazily-built IGM lookup table, see `get_igm_table`
+IGM_TABLE = None
+
+class IGMTable(object):
+    def __init__(self, zmin=0., zmax=15., dz=0.01, wmin=100., wmax=1300., dw=0.5, cache_dir=None, scale_tau=1.):
+        """Lookup table of the IGM transmission on a (z, rest wavelength) 
+        lattice
+        
+        The table is computed on first use with the `Inoue et al. (2014)
+        <http://adsabs.harvard.edu/abs/2014MNRAS.442.1805I>`_ model 
+        implemented in `eazy.igm.Inoue14` and is cached to a ``.npy`` file in
+        `cache_dir`, which is memory-mapped when it is read back.  The 
+        interpolated transmission agrees with `eazy.igm.Inoue14.full_IGM` 
+        to better than 0.005 within the redshift grid.
+        
+        Parameters
+        ----------
+        zmin, zmax, dz : float
+            Redshift grid.  Redshifts outside the grid are clipped to the 
+            limits, i.e., the transmission at ``z > zmax`` is that of 
+            `zmax` at the same rest-frame wavelengths.
+        
+        wmin, wmax, dw : float
+            Rest-frame wavelength grid, Angstroms.  The transmission is 
+            unity at wavelengths greater than `wmax` and is set to the value 
+            at `wmin` for shorter wavelengths.  Nodes are added on either 
+            side of the Lyman series lines, where the transmission is 
+            discontinuous.
+        
+        cache_dir : str or None
+            Directory for the cached table.  Default is 
+            ``grizli_cache_dir('igm')``.  If the directory isn't writable, 
+            the table is just kept in memory.
+        
+        scale_tau : float
+            Passed to `eazy.igm.Inoue14`.
+            
+        Attributes
+        ----------
+        zgrid, wgrid : array-like
+            Redshift and rest-frame wavelength grids.
+        
+        data : (NZ, NW) array-like
+            Transmission table.
+            
+        """
+        self.NZ = int(np.round((zmax-zmin)/dz))+1
+        self.zgrid = zmin + np.arange(self.NZ)*dz
+        
+        self.zmin, self.dz = zmin, dz
+        self.wmin, self.wmax, self.dw = wmin, wmax, dw
+        self.scale_tau = scale_tau
+        
+        if cache_dir is None:
+            cache_dir = grizli_cache_dir('igm')
+            
+        self.cache_dir = cache_dir
+        self._table = None
+    
+    @property 
+    def cache_file(self):
+        """Filename of the cached table
+        """
+        label = 'igm_inoue14_tau{0:.2f}_z{1:.2f}-{2:.2f}-{3:.4f}_w{4:.0f}-{5:.0f}-{6:.2f}.npy'
+        label = label.format(self.scale_tau, self.zmin, self.zgrid[-1],
+                             self.dz, self.wmin, self.wmax, self.dw)
+        return os.path.join(self.cache_dir, label)
+    
+    @property 
+    def available(self):
+        """Table is cached or can be computed with `eazy.igm`
+        """
+        if os.path.exists(self.cache_file):
+            return True
+        
+        try:
+            import eazy.igm
+            return True
+        except:
+            return False
+    
+    @property 
+    def table(self):
+        """Full table, with the wavelength grid in the first row
+        """
+        if self._table is None:
+            self._table = self.load_table()
+            self.wgrid = np.cast[float](self._table[0,:])
+            
+        return self._table
+        
+    @property 
+    def data(self):
+        return self.table[1:,:]
+        
+    def load_table(self, overwrite=False):
+        """Read the table from `cache_file` or compute it
+        """
+        if os.path.exists(self.cache_file) & (not overwrite):
+            return np.load(self.cache_file, mmap_mode='r')
+        
+        import eazy.igm
+        igm = eazy.igm.Inoue14(scale_tau=self.scale_tau)
+        
+        NW = int(np.round((self.wmax-self.wmin)/self.dw))+1
+        wgrid = self.wmin + np.arange(NW)*self.dw
+        
+        # Transmission is discontinuous at the Lyman series lines
+        lines = igm.lam.flatten()
+        wgrid = np.unique(np.hstack([wgrid, lines, lines-0.01]))
+        wgrid = wgrid[(wgrid >= self.wmin) & (wgrid <= self.wmax)]
+        
+        table = np.ones((self.NZ+1, len(wgrid)), dtype=np.float32)
+        table[0,:] = wgrid
+        for iz, z in enumerate(self.zgrid):
+            if z > 0:
+                table[iz+1,:] = igm.full_IGM(z, wgrid*(1+z))
+        
+        # Write to a temporary file first for parallel processes
+        tmp_file = self.cache_file + '.{0}.npy'.format(os.getpid())
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+                
+            np.save(tmp_file, table)
+            os.rename(tmp_file, self.cache_file)
+        except:
+            print('IGMTable: couldn\'t write {0}'.format(self.cache_file))
+            
+        return table
+        
+    def full_IGM(self, z, lobs):
+        """Bilinear interpolation of the IGM transmission 
+        
+        Same call signature as `eazy.igm.Inoue14.full_IGM`.
+        
+        Parameters
+        ----------
+        z : float
+            Redshift.
+        
+        lobs : array-like
+            Observed-frame wavelengths, Angstroms.
+        
+        Returns
+        -------
+        igmz : array-like
+            IGM transmission.
+            
+        """
+        data = self.data
+        wgrid = self.wgrid
+        
+        fz = np.clip((z - self.zmin)/self.dz, 0, self.NZ-1)
+        iz = int(np.minimum(fz, self.NZ-2))
+        tz = fz - iz
+        
+        wrest = np.asarray(lobs, dtype=float)/(1+z)
+        iw = np.searchsorted(wgrid, wrest, side='right') - 1
+        iw = np.clip(iw, 0, len(wgrid)-2)
+        tw = np.clip((wrest - wgrid[iw])/(wgrid[iw+1] - wgrid[iw]), 0, 1)
+        
+        lo = (1-tw)*data[iz,iw] + tw*data[iz,iw+1]
+        hi = (1-tw)*data[iz+1,iw] + tw*data[iz+1,iw+1]
+        
+        igmz = (1-tz)*lo + tz*hi
+        return np.where(wrest < self.wmax, igmz, 1.)
+
+def get_igm_table(**kwargs):
+    """Shared `IGMTable` object
+    
+    Parameters
+    ----------
+    kwargs : dict
+        Passed to `IGMTable` when the table is first initialized.
+    
+    Returns
+    -------
+    table : `IGMTable` or None
+        The table, which is computed on first use, or None if it isn't 
+        cached and `eazy.igm` is not available.
+        
+    """
+    global IGM_TABLE
+    if IGM_TABLE is None:
+        table = IGMTable(**kwargs)
+        if table.available:
+            IGM_TABLE = table
+    
+    return IGM_TABLE
+    
 class SpectrumTemplate(object):
     def __init__(self, wave=None, flux=None, central_wave=None, fwhm=None, velocity=False, fluxunits=FLAMBDA_CGS, waveunits=u.angstrom, name='template', lorentz=False, err=None):
         """Container for template spectra.   
@@ -1976,13 +2592,9 @@ class SpectrumTemplate(object):
             Redshifted and scaled spectrum.
             
         """
-        if apply_igm:
-            try:
-                import eazy.igm
-                igm = eazy.igm.Inoue14()
-                igmz = igm.full_IGM(z, self.wave*(1+z))
-            except:
-                igmz = 1.
+        igm = get_igm_table()
+        if apply_igm & (igm is not None):
+            igmz = igm.full_IGM(z, self.wave*(1+z))
         else:
             igmz = 1.
             
@@ -2171,10 +2783,210 @@ class SpectrumTemplate(object):
                 return temp_flux, temp_err
             else:
                 return temp_flux
+    
+    def integrate_filter_list(self, filters, abmag=False, use_wave='filter'):
+        """Integrate the template through a list of filters at once
+        
+        Uses the sparse filter response matrix of `FilterMatrix`, so that 
+        all of the filters are integrated with a single matrix product.
+        
+        Parameters
+        ----------
+        filters : list
+            Filter objects, see `integrate_filter`.
+        
+        abmag : bool
+            Return AB magnitudes rather than fnu fluxes.
+        
+        use_wave : 'filter', 'templ'
+            Integrate on the combined wavelength grid of the filters, 
+            resampling the template with 
+            `~grizli.utils_c.interp.interp_conserve_c`, or on the template 
+            wavelengths.
+            
+        Returns
+        -------
+        temp_flux : array
+            Fluxes in each filter, zero for filters not covered by the 
+            template.
+        
+        temp_err : array
+            Uncertainties propagated from `err`, if available.  Note that 
+            these are the uncertainties of the straight filter integrals, 
+            while `integrate_filter` computes an inverse-variance weighted 
+            mean when `err` is available.
+            
+        """
+        from .utils_c.interp import interp_conserve_c
+        
+        if use_wave == 'filter':
+            wave = filter_wave_grid(filters)
+            flux = np.zeros_like(wave)
+            err = None if self.err is None else np.zeros_like(wave)
+            
+            # interp_conserve_c needs overlapping wavelength ranges
+            if (self.wave.min() < wave[-1]) & (self.wave.max() > wave[0]):
+                flux = interp_conserve_c(wave, self.wave.astype(np.float), 
+                                         self.flux.astype(np.float))
+                if self.err is not None:
+                    err = interp_conserve_c(wave, self.wave.astype(np.float), 
+                                            self.err.astype(np.float))
+        else:
+            wave, flux, err = self.wave, self.flux, self.err
+            
+        fmat = get_filter_matrix(wave, filters)
+        out = fmat(flux, err=err)
+        
+        covered = fmat.covered(self.wave.min(), self.wave.max())
+        if err is None:
+            temp_flux = out*covered
+        else:
+            temp_flux, temp_err = out[0]*covered, out[1]*covered
+            
+        if abmag:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return -2.5*np.log10(temp_flux)-48.6
+        
+        if err is None:
+            return temp_flux
+        else:
+            return temp_flux, temp_err
+            
+# Directory for cached `load_templates` output.  If None, use 
+# grizli_cache_dir('templates')
+TEMPLATE_CACHE_DIR = None
 
+def template_cache_file(cache_key, files=[]):
+    """Filename of a cached template set
+    
+    Parameters
+    ----------
+    cache_key : list
+        Arguments that determine the template set, included in the hash 
+        with their `repr`.
+    
+    files : list
+        Template files.  Their paths, sizes and modification times are 
+        included in the hash, so that the cache is invalidated when they 
+        change.
+    
+    Returns
+    -------
+    file : str
+        ``templates_{md5}.npy`` in `TEMPLATE_CACHE_DIR`.  The template 
+        keys, names and FWHMs are in a ``.json`` file with the same root.
+        
+    """
+    import hashlib
+    from . import __version__
+    
+    md5 = hashlib.md5()
+    md5.update(repr([__version__, cache_key]).encode('utf-8'))
+    for file in files:
+        if os.path.exists(file):
+            st = os.stat(file)
+            md5.update(repr([file, st.st_size, st.st_mtime]).encode('utf-8'))
+        else:
+            md5.update(repr([file, None]).encode('utf-8'))
+    
+    if TEMPLATE_CACHE_DIR is None:
+        cache_dir = grizli_cache_dir('templates')
+    else:
+        cache_dir = TEMPLATE_CACHE_DIR
+        
+    return os.path.join(cache_dir, 'templates_{0}.npy'.format(md5.hexdigest()))
+
+def write_template_cache(file, templates):
+    """Write a template dictionary to a cache file
+    
+    The wavelengths and fluxes of all templates are concatenated in a 
+    single (2, N) array in `file` and the keys, names, FWHMs and array
+    offsets are written to a ``.json`` file.  Both are written to temporary
+    files first, so parallel processes don't read partial files.
+    
+    Returns
+    -------
+    status : bool
+        The files were written.
+    """
+    import json
+    
+    index = OrderedDict([('keys', []), ('names', []), ('fwhm', []), 
+                         ('offsets', [0])])
+    for key in templates:
+        t = templates[key]
+        index['keys'].append(key)
+        index['names'].append(t.name)
+        index['fwhm'].append(None if t.fwhm is None else float(t.fwhm))
+        index['offsets'].append(index['offsets'][-1] + len(t.wave))
+    
+    data = np.zeros((2, index['offsets'][-1]))
+    for i, key in enumerate(templates):
+        sl = slice(index['offsets'][i], index['offsets'][i+1])
+        data[0,sl] = templates[key].wave
+        data[1,sl] = templates[key].flux
+    
+    json_file = file.replace('.npy', '.json')
+    tmp = '.{0}'.format(os.getpid())
+    try:
+        if not os.path.exists(os.path.dirname(file)):
+            os.makedirs(os.path.dirname(file))
+            
+        np.save(file+tmp+'.npy', data)
+        os.rename(file+tmp+'.npy', file)
+        
+        with open(json_file+tmp, 'w') as fp:
+            json.dump(index, fp)
+        
+        os.rename(json_file+tmp, json_file)
+    except:
+        print('write_template_cache: couldn\'t write {0}'.format(file))
+        return False
+    
+    return True
+
+def read_template_cache(file, memmap=True):
+    """Read a template dictionary written by `write_template_cache`
+    
+    Returns
+    -------
+    templates : dict or None
+        Dictionary of `SpectrumTemplate` objects with wavelength and flux 
+        arrays that are views of the memory-mapped `file`, or None if the 
+        cache files don't exist.
+    """
+    import json
+    
+    json_file = file.replace('.npy', '.json')
+    if not (os.path.exists(file) & os.path.exists(json_file)):
+        return None
+    
+    try:
+        with open(json_file) as fp:
+            index = json.load(fp)
+        
+        data = np.load(file, mmap_mode='r' if memmap else None)
+    except:
+        return None
+        
+    templates = OrderedDict()
+    for i, key in enumerate(index['keys']):
+        sl = slice(index['offsets'][i], index['offsets'][i+1])
+        
+        t = SpectrumTemplate(wave=data[0,sl], flux=data[1,sl], 
+                             name=index['names'][i])
+        
+        # Keep the memory-mapped views rather than the copies 
+        t.wave, t.flux = data[0,sl], data[1,sl]
+        t.fwhm = index['fwhm'][i]
+        templates[key] = t
+        
+    return templates
+    
 def load_templates(fwhm=400, line_complexes=True, stars=False,
                    full_line_list=DEFAULT_LINE_LIST, continuum_list=None,
-                   fsps_templates=False, alf_template=False, lorentz=False):
+                   fsps_templates=False, alf_template=False, lorentz=False,
+                   use_cache=True):
     """Generate a list of templates for fitting to the grism spectra
     
     The different sets of continuum templates are stored in 
@@ -2215,6 +3027,11 @@ def load_templates(fwhm=400, line_complexes=True, stars=False,
     
     fsps_templates : bool
         If True, get the FSPS NMF templates.
+    
+    use_cache : bool
+        Read the templates from a cache file in `TEMPLATE_CACHE_DIR` if 
+        they were generated before with the same arguments and continuum 
+        template files (see `template_cache_file`), or write the cache.
         
     Returns
     -------
@@ -2310,6 +3127,29 @@ def load_templates(fwhm=400, line_complexes=True, stars=False,
             
         if continuum_list is not None:
             templates = continuum_list
+    
+    if use_cache:
+        files = [os.path.join(GRIZLI_PATH, 'templates', temp) 
+                 for temp in templates]
+        
+        cache_key = [templates, fwhm, line_complexes, stars, full_line_list,
+                     alf_template, lorentz, get_line_wavelengths()]
+        
+        cache_file = template_cache_file(cache_key, files=files)
+        temp_list = read_template_cache(cache_file)
+        if temp_list is not None:
+            return temp_list
+        
+        temp_list = load_templates(fwhm=fwhm, line_complexes=line_complexes,
+                                   stars=stars, 
+                                   full_line_list=full_line_list, 
+                                   continuum_list=continuum_list,
+                                   fsps_templates=fsps_templates, 
+                                   alf_template=alf_template, 
+                                   lorentz=lorentz, use_cache=False)
+        
+        write_template_cache(cache_file, temp_list)
+        return temp_list
         
     temp_list = OrderedDict()
     for temp in templates:
@@ -2376,6 +3216,516 @@ def load_templates(fwhm=400, line_complexes=True, stars=False,
                                  
     return temp_list    
 
+class TemplateBank(OrderedDict):
+    def __init__(self, templates=None, file=None, wmin=100., wmax=1.e5, dlogw=2.e-4, memmap=True):
+        """Templates resampled to a common logarithmic wavelength grid
+        
+        All of the templates are stored in a single contiguous array, 
+        `flux`, on the wavelength grid ``wave = exp(logw0 + i*dlogw)``.  The
+        bank can be written to a FITS file and read back memory-mapped, 
+        e.g., for sharing the same templates among many worker processes.  
+        Pickled copies of a bank read from a file just reopen the file.
+        
+        The object is also a dictionary of `SpectrumTemplate` objects whose
+        `flux` arrays are views of the rows of `flux` where the templates
+        are nonzero, so it can be used anywhere a template dictionary from 
+        `load_templates` is expected.
+        
+        Parameters
+        ----------
+        templates : dict
+            Dictionary of `SpectrumTemplate` objects.  Observed-frame 
+            templates (``bspl``, ``step``, ``poly``) are not supported.
+        
+        file : str
+            Read the bank from a file created with `write`.
+        
+        wmin, wmax, dlogw : float
+            Wavelength grid, in Angstroms.
+        
+        memmap : bool
+            Memory-map the `flux` array when reading from `file`.
+            
+        Attributes
+        ----------
+        wave : (NW) array
+            Wavelength grid.
+        
+        flux : (NTEMP, NW) array
+            Template fluxes.
+        
+        ranges : (NTEMP, 2) array
+            Ranges of the grid where the template fluxes are nonzero.
+            
+        """
+        OrderedDict.__init__(self)
+        self.file = file
+        
+        if file is not None:
+            self.read(file, memmap=memmap)
+        elif templates is not None:
+            self.resample(templates, wmin=wmin, wmax=wmax, dlogw=dlogw)
+    
+    def __reduce__(self):
+        if self.file is not None:
+            return (self.__class__, (None, self.file))
+        
+        state = {'logw0':self.logw0, 'dlogw':self.dlogw, 
+                 'keys':list(self.keys()), 
+                 'names':[self[k].name for k in self], 
+                 'fwhm':[self[k].fwhm for k in self], 
+                 'flux':np.asarray(self.flux), 'ranges':self.ranges}
+                 
+        return (self.__class__, (), state)
+    
+    def __setstate__(self, state):
+        self.file = None
+        self._set_grid(state['logw0'], state['dlogw'], 
+                       state['flux'].shape[1])
+        
+        self._init_templates(state['keys'], state['names'], state['fwhm'],
+                             state['flux'], state['ranges'])
+    
+    def __setitem__(self, key, value):
+        raise TypeError('TemplateBank templates can\'t be modified, make a new bank from a template dictionary.')
+    
+    def __delitem__(self, key):
+        raise TypeError('TemplateBank templates can\'t be modified, make a new bank from a template dictionary.')
+        
+    @property 
+    def NW(self):
+        return len(self.wave)
+        
+    def _set_grid(self, logw0, dlogw, NW):
+        self.logw0 = logw0
+        self.dlogw = dlogw
+        self.wave = np.exp(logw0 + np.arange(NW)*dlogw)
+        
+    def resample(self, templates, wmin=100., wmax=1.e5, dlogw=2.e-4):
+        """Resample a template dictionary to the logarithmic grid
+        """
+        from grizli.utils_c.interp import interp_conserve_c
+        
+        NW = int(np.ceil(np.log(wmax/wmin)/dlogw))+1
+        self._set_grid(np.log(wmin), dlogw, NW)
+        
+        flux = np.zeros((len(templates), NW))
+        for i, t in enumerate(templates):
+            if t.split()[0] in ['bspl', 'step', 'poly']:
+                raise ValueError('Observed-frame template "{0}" not supported in TemplateBank'.format(t))
+                
+            ti = templates[t]
+            flux[i,:] = interp_conserve_c(self.wave, 
+                                          np.cast[np.float](ti.wave),
+                                          np.cast[np.float](ti.flux))
+        
+        # Nonzero ranges, with a zero pixel on either side
+        ranges = np.zeros((len(templates), 2), dtype=int)
+        ranges[:,1] = NW
+        for i in range(len(templates)):
+            nz = np.where(flux[i,:] != 0)[0]
+            if len(nz) > 0:
+                ranges[i,:] = np.maximum(nz[0]-1, 0), np.minimum(nz[-1]+2, NW)
+        
+        names = [templates[t].name for t in templates]
+        fwhm = [templates[t].fwhm for t in templates]
+        
+        self._init_templates(list(templates), names, fwhm, flux, ranges)
+    
+    def _init_templates(self, keys, names, fwhm, flux, ranges):
+        """Set `flux` and the dictionary of `SpectrumTemplate` objects
+        """
+        self.flux = flux
+        self.ranges = ranges
+        
+        OrderedDict.clear(self)
+        for i, key in enumerate(keys):
+            i0, i1 = ranges[i]
+            if i1 <= i0:
+                i0, i1 = 0, self.NW
+                
+            templ = SpectrumTemplate(wave=self.wave[i0:i1], 
+                                     flux=flux[i,i0:i1], name=names[i])
+            
+            # Keep the views of the (memory-mapped) bank array rather than 
+            # the copies
+            templ.wave, templ.flux = self.wave[i0:i1], flux[i,i0:i1]
+            
+            if (fwhm[i] is not None) and np.isfinite(fwhm[i]):
+                templ.fwhm = fwhm[i]
+            
+            OrderedDict.__setitem__(self, key, templ)
+    
+    def write(self, file, overwrite=True):
+        """Write the bank to a FITS file
+        """
+        hdul = pyfits.HDUList([pyfits.PrimaryHDU()])
+        hdul[0].header['LOGW0'] = (self.logw0, 'log wavelength of first pixel')
+        hdul[0].header['DLOGW'] = (self.dlogw, 'log wavelength step')
+        hdul[0].header['NTEMP'] = (len(self), 'Number of templates')
+        
+        hdul.append(pyfits.ImageHDU(data=np.asarray(self.flux), name='FLUX'))
+        
+        tab = GTable()
+        tab['key'] = list(self.keys())
+        tab['name'] = [self[k].name for k in self]
+        tab['fwhm'] = [np.nan if self[k].fwhm is None else self[k].fwhm 
+                       for k in self]
+        tab['range'] = self.ranges
+        
+        hdu = pyfits.table_to_hdu(tab)
+        hdu.header['EXTNAME'] = 'TEMPLATES'
+        hdul.append(hdu)
+        
+        hdul.writeto(file, overwrite=overwrite)
+        self.file = file
+        
+    def read(self, file, memmap=True):
+        """Read a bank written with `write`
+        """
+        hdul = pyfits.open(file, memmap=memmap)
+        h = hdul[0].header
+        flux = hdul['FLUX'].data
+        
+        self._set_grid(h['LOGW0'], h['DLOGW'], flux.shape[1])
+        tab = GTable(hdul['TEMPLATES'].data)
+        
+        self._init_templates(list(tab['key']), list(tab['name']), 
+                             list(tab['fwhm']), flux, 
+                             np.array(tab['range']))
+        
+        if not memmap:
+            hdul.close()
+            
+        self.file = file
+
+# Cached `TemplateFilterGrid` objects, see `get_template_filter_grid`
+TEMPLATE_FILTER_GRIDS = OrderedDict()
+MAX_TEMPLATE_FILTER_GRIDS = 8
+
+def templates_hash(templates):
+    """MD5 hash of the keys, wavelengths and fluxes of a template dictionary
+    """
+    import hashlib
+    
+    md5 = hashlib.md5()
+    for key in templates:
+        md5.update(key.encode('utf-8'))
+        md5.update(np.ascontiguousarray(templates[key].wave, dtype=float))
+        md5.update(np.ascontiguousarray(templates[key].flux, dtype=float))
+    
+    return md5.hexdigest()
+
+def filters_hash(filters):
+    """MD5 hash of the wavelengths and throughputs of a list of filters
+    """
+    import hashlib
+    
+    md5 = hashlib.md5()
+    for filt in filters:
+        md5.update(np.ascontiguousarray(filt.wave, dtype=float))
+        md5.update(np.ascontiguousarray(filt.throughput, dtype=float))
+    
+    return md5.hexdigest()
+    
+# Cached `FilterMatrix` objects, see `get_filter_matrix`
+FILTER_MATRICES = OrderedDict()
+MAX_FILTER_MATRICES = 16
+
+def filter_wave_grid(filters):
+    """Sorted, unique wavelengths of a list of filters
+    """
+    return np.unique(np.hstack([np.asarray(filt.wave, dtype=float) 
+                                for filt in filters]))
+    
+class FilterMatrix(object):
+    def __init__(self, wave, filters):
+        """Sparse filter response matrix on a fixed wavelength grid
+        
+        The rows of `matrix` are the trapezoidal-rule weights of the 
+        integral ``int(fnu * T / lam dlam) / norm`` for f_lambda spectra 
+        sampled on `wave` (in Angstroms), i.e., the ``use_wave='templ'`` 
+        integral of `SpectrumTemplate.integrate_filter`.  Integrating ``M`` 
+        spectra through ``K`` filters is then a single sparse product.
+        
+        Parameters
+        ----------
+        wave : array-like
+            Wavelength grid, Angstroms.
+        
+        filters : list
+            Filter objects with `wave` and `throughput` attributes, and 
+            optionally `norm`.
+            
+        Attributes
+        ----------
+        matrix : `~scipy.sparse.csr_matrix`, (NFILT, NW)
+            Response matrix.
+        
+        limits : (NFILT, 2) array
+            Wavelength range where the throughput of each filter is nonzero.
+            
+        """
+        import scipy.sparse
+        from .utils_c.interp import interp_conserve_c
+        
+        self.wave = np.asarray(wave, dtype=float)
+        self.NFILT = len(filters)
+        
+        # Trapezoidal rule weights
+        dw = np.diff(self.wave)
+        trapz_w = np.zeros_like(self.wave)
+        trapz_w[:-1] += dw/2.
+        trapz_w[1:] += dw/2.
+        
+        rows, cols, vals = [], [], []
+        self.limits = np.zeros((self.NFILT, 2))
+        
+        for i, filt in enumerate(filters):
+            fwave = np.asarray(filt.wave, dtype=float)
+            fthru = np.asarray(filt.throughput, dtype=float)
+            ok = np.isfinite(fthru)
+            nonzero = fthru > 0
+            self.limits[i,:] = fwave[nonzero].min(), fwave[nonzero].max()
+            
+            # Empty row for filters outside of the wavelength grid
+            if ((self.limits[i,0] > self.wave[-1]) | 
+                (self.limits[i,1] < self.wave[0])):
+                continue
+                
+            thru = interp_conserve_c(self.wave, fwave[ok], fthru[ok], 
+                                     left=0, right=0)
+            weight = thru/self.wave
+            
+            if hasattr(filt, 'norm'):
+                norm = filt.norm
+            else:
+                norm = np.sum(weight*trapz_w)
+            
+            # f_lambda to f_nu
+            row = weight*trapz_w*self.wave**2/2.99792458e18/norm
+            ix = np.where(row != 0)[0]
+            rows.append(ix*0+i)
+            cols.append(ix)
+            vals.append(row[ix])
+            
+        if len(vals) == 0:
+            rows, cols, vals = [[]], [[]], [[]]
+            
+        self.matrix = scipy.sparse.csr_matrix((np.hstack(vals), 
+                                              (np.hstack(rows), 
+                                               np.hstack(cols))), 
+                                        shape=(self.NFILT, len(self.wave)))
+    
+    def covered(self, wmin, wmax):
+        """Filters covered by a spectrum defined over `wmin`, `wmax`
+        
+        Same test as `SpectrumTemplate.integrate_filter`: the blue end of 
+        the filter must be within the spectrum, while filters extending 
+        past the red end of the spectrum are integrated with the spectrum 
+        padded with zeros.
+        """
+        return (self.limits[:,0] >= wmin) & (self.limits[:,0] <= wmax)
+        
+    def __call__(self, flux, err=None):
+        """Integrate spectra through the filters
+        
+        Parameters
+        ----------
+        flux : (NW) or (M, NW) array
+            f_lambda spectra sampled on `wave`.
+        
+        err : array with the shape of `flux`, optional
+            Uncertainties of `flux`, propagated assuming that they are 
+            uncorrelated.
+            
+        Returns
+        -------
+        fnu : (NFILT) or (M, NFILT) array
+            Integrated fluxes.
+        
+        efnu : array
+            Propagated uncertainties, if `err` provided.
+            
+        """
+        fnu = self.matrix.dot(np.asarray(flux, dtype=float).T).T
+        if err is None:
+            return fnu
+            
+        err2 = np.asarray(err, dtype=float).T**2
+        efnu = np.sqrt(self.matrix.multiply(self.matrix).dot(err2)).T
+        return fnu, efnu
+        
+def get_filter_matrix(wave, filters):
+    """Shared `FilterMatrix` for a wavelength grid and list of filters
+    
+    The matrices are cached by hashes of `wave` and the filter curves 
+    (`filters_hash`) and the `MAX_FILTER_MATRICES` most recently used are 
+    kept.
+    """
+    import hashlib
+    
+    wave = np.ascontiguousarray(wave, dtype=float)
+    key = (hashlib.md5(wave).hexdigest(), filters_hash(filters))
+    
+    if key in FILTER_MATRICES:
+        fmat = FILTER_MATRICES.pop(key)
+    else:
+        fmat = FilterMatrix(wave, filters)
+        
+    FILTER_MATRICES[key] = fmat
+    while len(FILTER_MATRICES) > MAX_FILTER_MATRICES:
+        FILTER_MATRICES.popitem(last=False)
+    
+    return fmat
+    
+def integrate_templates(templates, filters, z=0, apply_igm=True):
+    """Integrate a set of redshifted templates through a list of filters
+    
+    Equivalent to 
+    ``templates[key].zscale(z).integrate_filter(filt)`` for each template
+    and filter, but the templates are resampled once to the combined 
+    wavelength grid of the filters (`filter_wave_grid`) and integrated 
+    through all of the filters with a single `FilterMatrix` product.
+    
+    Parameters
+    ----------
+    templates : dict
+        Dictionary of `SpectrumTemplate` objects.
+    
+    filters : list
+        Filter objects, see `SpectrumTemplate.integrate_filter`.
+    
+    z : float
+        Redshift.
+    
+    apply_igm : bool
+        Apply the IGM transmission (`get_igm_table`).
+        
+    Returns
+    -------
+    fnu : (NTEMP, NFILT) array
+        Integrated fluxes, zero for filters not covered by a template.
+        
+    """
+    from .utils_c.interp import interp_conserve_c
+    
+    wave = filter_wave_grid(filters)
+    fmat = get_filter_matrix(wave, filters)
+    
+    IGM = get_igm_table()
+    
+    flux = np.zeros((len(templates), len(wave)))
+    covered = np.zeros((len(templates), fmat.NFILT), dtype=bool)
+    
+    for i, key in enumerate(templates):
+        ti = templates[key]
+        wz = np.cast[np.float](ti.wave*(1+z))
+        fz = ti.flux/(1+z)
+        if apply_igm & (IGM is not None):
+            fz = fz*IGM.full_IGM(z, wz)
+        
+        covered[i,:] = fmat.covered(wz.min(), wz.max())
+        if (wz.min() < wave[-1]) & (wz.max() > wave[0]):
+            flux[i,:] = interp_conserve_c(wave, wz, np.cast[np.float](fz))
+    
+    fnu = fmat(flux)*covered
+    fnu[~np.isfinite(fnu)] = 0
+    return fnu
+    
+class TemplateFilterGrid(object):
+    def __init__(self, templates, filters, zgrid, apply_igm=True):
+        """Template fluxes integrated through filters on a redshift grid
+        
+        Parameters
+        ----------
+        templates : dict
+            Dictionary of `SpectrumTemplate` objects.
+        
+        filters : list
+            Filter objects, see `SpectrumTemplate.integrate_filter`.
+        
+        zgrid : array-like
+            Redshift grid.
+        
+        apply_igm : bool
+            Apply the IGM transmission when redshifting the templates.
+            
+        Attributes
+        ----------
+        grid : (NZ, NTEMP, NFILT) array
+            Template fluxes from `integrate_templates` for each redshift, 
+            template and filter.
+        
+        templates_hash : str
+            `templates_hash` of `templates`.
+            
+        """
+        self.zgrid = np.atleast_1d(zgrid)*1.
+        self.keys = list(templates)
+        self.templates_hash = templates_hash(templates)
+        self.NTEMP = len(templates)
+        self.NFILT = len(filters)
+        
+        self.grid = np.zeros((len(self.zgrid), self.NTEMP, self.NFILT))
+        for iz, z in enumerate(self.zgrid):
+            self.grid[iz] = integrate_templates(templates, filters, z=z, 
+                                                apply_igm=apply_igm)
+    
+    def in_range(self, z):
+        """`z` within the limits of `zgrid`
+        """
+        return (z >= self.zgrid[0]) & (z <= self.zgrid[-1])
+        
+    def __call__(self, z):
+        """Linear interpolation of `grid` at redshift `z`
+        
+        Returns
+        -------
+        fluxes : (NTEMP, NFILT) array
+        
+        """
+        if len(self.zgrid) == 1:
+            return self.grid[0]*1
+            
+        iz = np.clip(np.searchsorted(self.zgrid, z)-1, 0, len(self.zgrid)-2)
+        f = (z - self.zgrid[iz])/(self.zgrid[iz+1] - self.zgrid[iz])
+        f = np.clip(f, 0, 1)
+        
+        return self.grid[iz]*(1-f) + self.grid[iz+1]*f
+        
+def get_template_filter_grid(templates, filters, zgrid, apply_igm=True):
+    """Shared `TemplateFilterGrid` for a template set, filter list and grid
+    
+    The grids are cached by `templates_hash`, `filters_hash` and `zgrid` 
+    and the `MAX_TEMPLATE_FILTER_GRIDS` most recently used are kept.
+    
+    Parameters
+    ----------
+    templates, filters, zgrid, apply_igm : 
+        See `TemplateFilterGrid`.
+    
+    Returns
+    -------
+    grid : `TemplateFilterGrid`
+    
+    """
+    zgrid = np.atleast_1d(zgrid)
+    key = (templates_hash(templates), filters_hash(filters), 
+           len(zgrid), zgrid[0], zgrid[-1], apply_igm)
+    
+    if key in TEMPLATE_FILTER_GRIDS:
+        grid = TEMPLATE_FILTER_GRIDS.pop(key)
+    else:
+        grid = TemplateFilterGrid(templates, filters, zgrid, 
+                                  apply_igm=apply_igm)
+        
+    TEMPLATE_FILTER_GRIDS[key] = grid
+    while len(TEMPLATE_FILTER_GRIDS) > MAX_TEMPLATE_FILTER_GRIDS:
+        TEMPLATE_FILTER_GRIDS.popitem(last=False)
+        
+    return grid
+    
 def load_beta_templates(wave=np.arange(400, 2.5e4), betas=[-2, -1, 0]):
     """
     Step-function templates with f_lambda ~ (wave/1216.)**beta
@@ -2921,6 +4271,25 @@ def array_templates(templates, wave=None, max_R=5000, z=0, apply_igm=False):
     """
     from grizli.utils_c.interp import interp_conserve_c
     
+    if isinstance(templates, TemplateBank) & (wave is None):
+        # Already on a common grid
+        # Block-average to max_R
+        step = int(np.maximum(np.ceil(1./(templates.dlogw*max_R)), 1))
+        NW = templates.NW//step*step
+        NTEMP = len(templates)
+        
+        wave = templates.wave[:NW].reshape((-1, step)).mean(axis=1)
+        flux_arr = np.array(templates.flux[:,:NW], dtype=float)
+        flux_arr = flux_arr.reshape((NTEMP, -1, step)).mean(axis=2)
+        is_line = np.array([t.startswith('line ') for t in templates])
+        
+        IGM = get_igm_table()
+        if apply_igm & (IGM is not None):
+            lylim = wave < 1250
+            flux_arr[:,lylim] *= IGM.full_IGM(z, wave[lylim]*(1+z))
+        
+        return wave, flux_arr, is_line
+        
     if wave is None:
         wstack = []
         for t in templates:
@@ -2955,16 +4324,11 @@ def array_templates(templates, wave=None, max_R=5000, z=0, apply_igm=False):
     is_line = np.array([t.startswith('line ') for t in templates])
     
     # IGM
-    if apply_igm:
-        try:
-            import eazy.igm
-            IGM = eazy.igm.Inoue14()
-        
-            lylim = wave < 1250
-            igmz = np.ones_like(wave)
-            igmz[lylim] = IGM.full_IGM(z, wave[lylim]*(1+z))    
-        except:
-            igmz = 1.
+    IGM = get_igm_table()
+    if apply_igm & (IGM is not None):
+        lylim = wave < 1250
+        igmz = np.ones_like(wave)
+        igmz[lylim] = IGM.full_IGM(z, wave[lylim]*(1+z))    
     else:
         igmz = 1.
     
@@ -2986,6 +4350,70 @@ def array_templates(templates, wave=None, max_R=5000, z=0, apply_igm=False):
     
     return wave, flux_arr, is_line
     
+def interp_conserve_zgrid(x, wave, flux, zgrid):
+    """Flux-conserving interpolation of a template at many redshifts
+    
+    Vectorized version of 
+    
+        >>> from grizli.utils_c.interp import interp_conserve_c
+        >>> for i, z in enumerate(zgrid): # doctest: +SKIP
+        ...     out[i,:] = interp_conserve_c(x, wave*(1+z), flux/(1+z))
+        
+    computed from the analytic integral of the linearly-interpolated 
+    template.  The results are the same as `interp_conserve_c` to machine 
+    precision, except for output pixels that straddle the red edge of the 
+    template, which are integrated as zero beyond `wave.max()`.
+    
+    Parameters
+    ----------
+    x : array-like, (NX,)
+        Sorted output (observed-frame) wavelengths.
+    
+    wave : array-like, (NW,)
+        Sorted rest-frame template wavelengths.
+    
+    flux : array-like, (NW,) or (NZ, NW)
+        Template fluxes.  If 2D, then each row is used for the corresponding
+        redshift in `zgrid`, e.g., for a redshift-dependent IGM absorption.
+    
+    zgrid : array-like, (NZ,)
+        Redshifts.
+    
+    Returns
+    -------
+    out : `~numpy.ndarray`, (NZ, NX)
+        Interpolated fluxes, including the ``1/(1+z)`` factor.
+    """
+    zgrid = np.atleast_1d(zgrid)
+    flux = np.atleast_2d(flux).astype(np.float64)
+    NW = len(wave)
+    
+    # Bin edges, as in `~grizli.utils_c.interp.midpoint_c`
+    xmid = np.hstack([0, (x[1:]+x[:-1])/2., 0])
+    xmid[0] = 2*x[0]-xmid[1]
+    xmid[-1] = 2*x[-1]-xmid[-2]
+    rmid = xmid[None,:]/(1+zgrid[:,None])
+    
+    # Cumulative integral of the template at the nodes
+    dw = np.diff(wave)
+    slope = np.diff(flux, axis=1)/dw
+    cumul = np.zeros_like(flux)
+    cumul[:,1:] = np.cumsum((flux[:,1:]+flux[:,:-1])*dw/2., axis=1)
+    
+    ix = np.clip(np.searchsorted(wave, rmid, side='right')-1, 0, NW-2)
+    dx = np.clip(rmid, wave[0], wave[-1]) - wave[ix]
+    if flux.shape[0] == 1:
+        row = 0
+    else:
+        row = np.arange(len(zgrid))[:,None]
+        
+    integral = cumul[row, ix] + flux[row, ix]*dx + slope[row, ix]*dx**2/2.
+    
+    out = np.diff(integral, axis=1)/np.diff(rmid, axis=1)/(1+zgrid[:,None])
+    out[rmid[:,:-1] < wave[0]] = 0.
+    
+    return out
+    
 def compute_equivalent_widths(templates, coeffs, covar, max_R=5000, Ndraw=1000, seed=0, z=0, observed_frame=False):
     """Compute template-fit emission line equivalent widths
     
@@ -3597,6 +5025,140 @@ class WCSFootprint(object):
                 header['NAXIS{0}'.format(i)] = int(header['CRPIX{0}'.format(i)]*2)
                 
     
+class FootprintIndex(object):
+    def __init__(self, footprints=[], labels=None, file=None):
+        """Spatial index of sky footprints, e.g., of a set of exposures
+        
+        The footprints are projected to a plane tangent at the center of 
+        the whole set and the objects in a batch of positions are found with
+        a bounding-box selection followed by a point-in-polygon test of the 
+        candidates (`~matplotlib.path.Path.contains_points`).
+        
+        Parameters
+        ----------
+        footprints : list
+            List of (NV, 2) arrays of the (RA, Dec) vertices of each 
+            footprint polygon.  All polygons must have the same number of 
+            vertices to be written to a file.
+        
+        labels : list
+            Labels of the footprints, e.g., exposure filenames.
+            
+        file : str
+            Read the index from a file written with `write`.
+            
+        """
+        if file is not None:
+            self.read(file)
+        else:
+            self.fp = [np.asarray(fp, dtype=float) for fp in footprints]
+            if labels is None:
+                labels = ['{0}'.format(i) for i in range(len(self.fp))]
+                
+            self.labels = list(labels)
+            
+        self._init_index()
+    
+    @property
+    def N(self):
+        return len(self.fp)
+        
+    def _init_index(self):
+        """Tangent-plane polygons and bounding boxes
+        """
+        import matplotlib.path
+        
+        if self.N == 0:
+            self.ref = (0., 0.)
+            self.paths = []
+            self.bbox = np.zeros((0,4))
+            return None
+            
+        all_fp = np.vstack(self.fp)
+        self.ref = (all_fp[0,0], np.mean(all_fp[:,1]))
+        
+        self.paths = []
+        self.bbox = np.zeros((self.N, 4))
+        for i, fp in enumerate(self.fp):
+            xy = self.project(fp[:,0], fp[:,1])
+            self.paths.append(matplotlib.path.Path(xy))
+            self.bbox[i,:] = [xy[:,0].min(), xy[:,0].max(), 
+                              xy[:,1].min(), xy[:,1].max()]
+    
+    def project(self, ra, dec):
+        """Local (x, y) coordinates in degrees, tangent at `ref`
+        """
+        dra = (np.atleast_1d(ra) - self.ref[0] + 180) % 360 - 180
+        x = dra*np.cos(self.ref[1]/180*np.pi)
+        y = np.atleast_1d(dec) - self.ref[1]
+        return np.array([x, y]).T
+    
+    @classmethod
+    def from_flts(cls, flts, labels=None):
+        """Index of the padded direct-image areas of `~grizli.model.GrismFLT` objects
+        
+        The footprint of each exposure is the full (padded) extent of 
+        ``flt.direct``, so it includes objects outside of the detector that
+        disperse spectra onto it.
+        """
+        footprints = []
+        for flt in flts:
+            sh = flt.direct.sh
+            xy = np.array([[-0.5, -0.5], [sh[1]-0.5, -0.5], 
+                           [sh[1]-0.5, sh[0]-0.5], [-0.5, sh[0]-0.5]])
+            footprints.append(flt.direct.wcs.all_pix2world(xy, 0))
+        
+        if labels is None:
+            labels = [flt.grism.parent_file for flt in flts]
+        
+        return cls(footprints=footprints, labels=labels)
+        
+    def query(self, ra, dec):
+        """Footprints that contain a batch of positions
+        
+        Parameters
+        ----------
+        ra, dec : float or array-like
+            Sky coordinates, decimal degrees.
+        
+        Returns
+        -------
+        contains : (NOBJ, N) bool array
+            Object ``i`` is within footprint ``j``.
+            
+        """
+        xy = self.project(ra, dec)
+        contains = np.zeros((len(xy), self.N), dtype=bool)
+        for j in range(self.N):
+            x0, x1, y0, y1 = self.bbox[j]
+            cand = ((xy[:,0] >= x0) & (xy[:,0] <= x1) & 
+                    (xy[:,1] >= y0) & (xy[:,1] <= y1))
+            if cand.sum() > 0:
+                contains[cand, j] = self.paths[j].contains_points(xy[cand,:])
+        
+        return contains
+        
+    def query_indices(self, ra, dec):
+        """Indices of the footprints that contain a single position
+        """
+        return np.where(self.query(ra, dec)[0])[0]
+        
+    def write(self, file, overwrite=True):
+        """Write the labels and footprint vertices to a FITS table
+        """
+        tab = GTable()
+        tab['label'] = self.labels
+        tab['ra'] = np.array([fp[:,0] for fp in self.fp])
+        tab['dec'] = np.array([fp[:,1] for fp in self.fp])
+        tab.write(file, overwrite=overwrite)
+    
+    def read(self, file):
+        """Read a table written with `write`
+        """
+        tab = GTable.gread(file)
+        self.labels = [str(l) for l in tab['label']]
+        self.fp = [np.array([r, d]).T for r, d in zip(tab['ra'], tab['dec'])]
+        
 def reproject_faster(input_hdu, output, pad=10, **kwargs):
     """Speed up `reproject` module with array slices of the input image
     
@@ -6271,6 +7833,186 @@ def fill_masked_covar(covar, mask):
             covar_full[ii,jj] = covar[i,j]
     
     return covar_full
+
+def normal_equations_lsq(AtA, Atb, lower=None, upper=None, x0=None, free=None, tol=1.e-10, max_iter=None, max_cond=1.e10):
+    """Bounded least squares from the normal equations with an active set
+    
+    Solves 
+    
+        min |A.x - b|**2, lower <= x <= upper 
+    
+    with the Lawson & Hanson (1974) / Stark & Parker (1995) active set
+    algorithm working on the precomputed normal equations, ``A.T.A`` and
+    ``A.T.b``.  The active set can be warm-started from the solution of a 
+    similar problem, e.g., the template fit at a neighboring redshift, 
+    in which case often only the unconstrained solve for the free 
+    variables is needed.
+    
+    Parameters
+    ----------
+    AtA : (N,N) `~numpy.ndarray`
+        ``A.T.dot(A)``
+    
+    Atb : (N,) `~numpy.ndarray`
+        ``A.T.dot(b)``
+    
+    lower, upper : (N,) `~numpy.ndarray` or None
+        Bounds on the parameters.  Default is non-negative least squares,
+        ``lower=0``, ``upper=inf``.
+    
+    x0 : (N,) `~numpy.ndarray` or None
+        Starting guess, clipped to the bounds.
+    
+    free : (N,) bool `~numpy.ndarray` or None
+        Initial set of unconstrained parameters.  Parameters not in `free` 
+        are set to their closest bound.
+    
+    tol : float
+        Tolerance of the Kuhn-Tucker optimality test, relative to the 
+        scale of the gradient terms.
+    
+    max_iter : int or None
+        Maximum number of outer iterations, default ``10*N``.
+    
+    max_cond : float
+        Maximum condition number of the (column-normalized) normal matrix 
+        of the free parameters.  The condition number of ``A.T.A`` is the 
+        square of that of ``A``, so the solution of an ill-conditioned 
+        problem can be inaccurate without the solver failing.
+        
+    Returns
+    -------
+    x : (N,) `~numpy.ndarray`
+        Solution.
+    
+    free : (N,) bool `~numpy.ndarray`
+        Parameters not at their bounds.
+    
+    Raises
+    ------
+    `~numpy.linalg.LinAlgError` if a sub-problem is singular or 
+    ill-conditioned, or if the iterations don't converge.
+    
+    """
+    import scipy.linalg
+    
+    N = len(Atb)
+    if lower is None:
+        lower = np.zeros(N)
+    
+    if upper is None:
+        upper = np.ones(N)*np.inf
+    
+    if max_iter is None:
+        max_iter = 10*N
+    
+    if x0 is None:
+        x = np.zeros(N)
+    else:
+        x = np.asarray(x0, dtype=float)*1
+    
+    # Normalize the columns of A for better conditioning
+    diag = AtA.diagonal()
+    scl = np.ones(N)
+    scl[diag > 0] = 1./np.sqrt(diag[diag > 0])
+    
+    AtA = AtA*scl*scl[:,None]
+    Atb = Atb*scl
+    lower, upper, x = lower/scl, upper/scl, x/scl
+    
+    x = np.clip(x, lower, upper)
+    
+    # Unbounded parameters are always free
+    unbounded = ~np.isfinite(lower) & ~np.isfinite(upper)
+    if free is None:
+        free = unbounded*1
+    
+    free = (np.asarray(free, dtype=bool) & (lower < upper)) | unbounded
+    
+    # Constrained parameters at the closest bound
+    to_upper = ~np.isfinite(lower) | (np.abs(upper-x) < np.abs(x-lower))
+    x[~free] = np.where(to_upper, upper, lower)[~free]
+    
+    skip = np.zeros(N, dtype=bool)
+    new_free = -1
+    
+    for it in range(max_iter):
+        # Solve for the free parameters, stepping back to the feasible 
+        # region if necessary
+        while free.sum() > 0:
+            F = free
+            rhs = Atb[F] - AtA[F,:][:,~F].dot(x[~F])
+            AtA_F = AtA[F,:][:,F]
+            if np.linalg.cond(AtA_F) > max_cond:
+                raise np.linalg.LinAlgError('Ill-conditioned normal equations')
+                
+            z = scipy.linalg.solve(AtA_F, rhs, assume_a='pos', 
+                                   check_finite=False)
+            
+            lo, hi, xf = lower[F], upper[F], x[F]
+            bad = (z < lo) | (z > hi)
+            if bad.sum() == 0:
+                x[F] = z
+                break
+            
+            # Newly freed parameter immediately moves the wrong way, e.g., 
+            # from roundoff.  Put it back and try the next one.
+            if new_free >= 0:
+                zj = z[np.cumsum(F)[new_free]-1]
+                at_lo = (x[new_free] <= lower[new_free])
+                at_hi = (x[new_free] >= upper[new_free])
+                if ((at_lo & (zj < lower[new_free])) | 
+                    (at_hi & (zj > upper[new_free]))):
+                    free[new_free] = False
+                    skip[new_free] = True
+                    new_free = -1
+                    break
+            
+            step = np.ones_like(z)
+            dz = z - xf
+            below, above = z < lo, z > hi
+            step[below] = (lo - xf)[below]/dz[below]
+            step[above] = (hi - xf)[above]/dz[above]
+            alpha = np.clip(step[bad].min(), 0, 1)
+            
+            xf = xf + alpha*dz
+            
+            # Parameters that hit a bound
+            hit_lo = (bad & (step <= alpha) & (z < lo)) | (xf <= lo)
+            hit_hi = (bad & (step <= alpha) & (z > hi)) | (xf >= hi)
+            xf[hit_lo] = lo[hit_lo]
+            xf[hit_hi] = hi[hit_hi]
+            
+            x[F] = xf
+            idx = np.where(F)[0]
+            free[idx[hit_lo | hit_hi]] = False
+            new_free = -1
+            skip[:] = False
+        
+        # Solution changed
+        if new_free >= 0:
+            skip[:] = False
+            new_free = -1
+        
+        # Kuhn-Tucker test with the negative gradient
+        w = Atb - AtA.dot(x)
+        wscale = np.maximum(np.abs(Atb), np.abs(AtA).dot(np.abs(x))).max()
+        
+        viol = np.zeros(N)
+        at_lo = ~free & (x <= lower)
+        at_hi = ~free & (x >= upper)
+        viol[at_lo] = w[at_lo]
+        viol[at_hi] = -w[at_hi]
+        viol[skip] = 0
+        
+        j = np.argmax(viol)
+        if viol[j] <= tol*wscale:
+            return x*scl, free
+        
+        free[j] = True
+        new_free = j
+    
+    raise np.linalg.LinAlgError('normal_equations_lsq: no convergence after {0} iterations'.format(max_iter))
     
 def log_scale_ds9(im, lexp=1.e12, cmap=[7.97917, 0.8780493], scale=[-0.1,10]):
     """
@@ -16,6 +16,7 @@ ctypedef np.int32_t FINT_t
 ctypedef np.float32_t FTYPE_t
 
 import cython
+from cython.parallel import prange
 
 cdef extern from "math.h":
     double sqrt(double x)
@@ -71,6 +72,119 @@ def disperse_grism_object(np.ndarray[FTYPE_t, ndim=2] flam,
     
     return True
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _disperse_one(FTYPE_t[:] flam, FTYPE_t[:] segm, FTYPE_t seg_id,
+                        Py_ssize_t thumb_start, Py_ssize_t nx_thumb,
+                        Py_ssize_t x0y, Py_ssize_t x0x, 
+                        Py_ssize_t shdy, Py_ssize_t shdx,
+                        LINT_t[:] idxl, DTYPE_t[:] yfrac, DTYPE_t[:] ysens,
+                        Py_ssize_t trace_start, Py_ssize_t nk,
+                        DTYPE_t[:] full, Py_ssize_t full_start, 
+                        Py_ssize_t nl, Py_ssize_t shgx) nogil:
+    """Disperse a single object for `disperse_grism_objects`
+    """
+    cdef Py_ssize_t i, j, k, k1, k2, pix
+    cdef double fl_ij
+    
+    for i in range(-x0x, x0x):
+        if (x0x+i < 0) or (x0x+i >= shdx):
+            continue
+            
+        for j in range(-x0y, x0y):
+            if (x0y+j < 0) or (x0y+j >= shdy):
+                continue
+            
+            pix = thumb_start + (x0y+j)*nx_thumb + x0x+i
+            fl_ij = flam[pix]
+            if (fl_ij == 0) or (segm[pix] != seg_id):
+                continue
+                
+            for k in range(trace_start, trace_start+nk):
+                k1 = idxl[k]+j*shgx+i
+                if (k1 >= 0) and (k1 < nl):
+                    full[full_start+k1] += ysens[k]*fl_ij*yfrac[k]
+                    
+                k2 = idxl[k]+(j-1)*shgx+i
+                if (k2 >= 0) and (k2 < nl):
+                    full[full_start+k2] += ysens[k]*fl_ij*(1-yfrac[k])
+                    
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.embedsignature(True)
+def disperse_grism_objects(FTYPE_t[:] flam, FTYPE_t[:] segm, 
+                           FTYPE_t[:] seg_id, LINT_t[:] thumb_offset, 
+                           LINT_t[:,:] x0, LINT_t[:,:] shd,
+                           LINT_t[:] idxl, DTYPE_t[:] yfrac, 
+                           DTYPE_t[:] ysens, LINT_t[:] trace_offset,
+                           DTYPE_t[:] full, LINT_t[:] full_offset, 
+                           LINT_t[:,:] shg, int num_threads=0):
+    """Compute dispersed 2D spectra of many objects in parallel
+    
+    Same calculation as `disperse_grism_object`, where the per-object arrays
+    are concatenated into flat arrays with "offset" index arrays of length
+    N+1 giving the start and end of each object, e.g., the thumbnail of 
+    object `n` is ``flam[thumb_offset[n]:thumb_offset[n+1]]``.  The objects
+    are distributed over threads with `prange` and each writes to its own 
+    section of `full`, so there are no write conflicts between threads.
+    
+    Parameters
+    ----------
+    flam, segm: ndarray (np.float32)
+        Flattened direct and segmentation thumbnails
+    
+    seg_id: ndarray (np.float32)
+        Segmentation IDs, shape (N,)
+    
+    thumb_offset: ndarray (np.int64)
+        Offsets of the thumbnails in `flam` and `segm`, shape (N+1,)
+        
+    x0, shd: ndarray (np.int64)
+        Thumbnail centers and shapes, shape (N,2)
+    
+    idxl, yfrac, ysens: ndarray
+        Concatenated trace indices, fractional pixel offsets and scaled 
+        sensitivities
+    
+    trace_offset: ndarray (np.int64)
+        Offsets of the trace arrays, shape (N+1,)
+    
+    full: ndarray (np.double)
+        Concatenated flattened 2D spectra, updated in place
+    
+    full_offset: ndarray (np.int64)
+        Offsets of the 2D spectra in `full`, shape (N+1,)
+    
+    shg: ndarray (np.int64)
+        Shapes of the 2D spectra, shape (N,2)
+    
+    num_threads: int
+        Number of OpenMP threads.  If <= 0, use the OpenMP default.
+    """
+    cdef Py_ssize_t n, N
+    
+    N = seg_id.shape[0]
+    
+    if num_threads <= 0:
+        for n in prange(N, nogil=True, schedule='dynamic'):
+            _disperse_one(flam, segm, seg_id[n], thumb_offset[n], shd[n,1],
+                          x0[n,0], x0[n,1], shd[n,0], shd[n,1], 
+                          idxl, yfrac, ysens, trace_offset[n], 
+                          trace_offset[n+1]-trace_offset[n], 
+                          full, full_offset[n], 
+                          full_offset[n+1]-full_offset[n], shg[n,1])
+    else:
+        for n in prange(N, nogil=True, schedule='dynamic', 
+                        num_threads=num_threads):
+            _disperse_one(flam, segm, seg_id[n], thumb_offset[n], shd[n,1],
+                          x0[n,0], x0[n,1], shd[n,0], shd[n,1], 
+                          idxl, yfrac, ysens, trace_offset[n], 
+                          trace_offset[n+1]-trace_offset[n], 
+                          full, full_offset[n], 
+                          full_offset[n+1]-full_offset[n], shg[n,1])
+                          
+    return True
+    
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.embedsignature(True)
@@ -12,6 +12,7 @@ import builtins
 import subprocess
 
 import os
+import sys
 import numpy
 
 try:
@@ -30,6 +31,19 @@ else:
 
 print('C extension: {0}'.format(cext))
 
+# OpenMP for the multi-threaded `disperse.disperse_grism_objects`.  Off by 
+# default on OSX where the system clang doesn't provide it, but can be 
+# forced with, e.g., GRIZLI_OPENMP=1 
+if 'GRIZLI_OPENMP' in os.environ:
+    USE_OPENMP = os.environ['GRIZLI_OPENMP'] not in ['0', '']
+else:
+    USE_OPENMP = sys.platform.startswith('linux')
+
+if USE_OPENMP:
+    OPENMP_FLAGS = ['-fopenmp']
+else:
+    OPENMP_FLAGS = []
+    
 if os.name == 'nt':
     # Windows
     extensions = [
@@ -48,7 +62,9 @@ else:
         
         Extension("grizli.utils_c.disperse", ["grizli/utils_c/disperse"+cext],
             include_dirs = [numpy.get_include()],
-            libraries=["m"]),
+            libraries=["m"], 
+            extra_compile_args=OPENMP_FLAGS,
+            extra_link_args=OPENMP_FLAGS),
     ] 
 
 if 0:      